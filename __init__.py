@@ -1,6 +1,25 @@
+'''
+otter's public functions are loaded from otter.otter the first time they are used; see
+otter/__init__.py.
+'''
 
-from otter.otter import (build_info, build_version, build_main, build_towns_code, build_industry_code,
-                          build_canal_code, build_signs_code, bother, georef_png, add_land, add_water,
-                          create_random_points, get_map_coords, get_latlong_from_map, town_data_to_json)
+import importlib
 
 
+_PUBLIC_FUNCTIONS = ('build_info', 'build_version', 'build_main', 'build_towns_code', 'build_industry_code',
+                     'build_canal_code', 'build_signs_code', 'bother', 'bother_batch', 'georef_png', 'add_land',
+                     'add_water', 'create_random_points', 'get_map_coords', 'get_latlong_from_map',
+                     'town_data_to_json')
+
+__all__ = list(_PUBLIC_FUNCTIONS)
+
+
+def __getattr__(name):
+    if name in _PUBLIC_FUNCTIONS:
+        value = getattr(importlib.import_module(f'{__name__}.otter'), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,3 @@
+"""Offline benchmarks for otter.  Each module can be run with
+python -m otter.benchmarks.<module>; see the module docstrings.
+"""
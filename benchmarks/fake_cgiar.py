@@ -0,0 +1,139 @@
+"""A local stand-in for the CGIAR SRTM website, serving synthetic
+srtm_XX_YY.zip files over HTTP so that the download path can be tested
+and benchmarked without a network connection.
+"""
+
+import io
+import time
+import zipfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, Iterable, Tuple, Dict, Set
+
+import numpy as np
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+
+from otter.bother_utils.srtm import ZIP_FNAME, TIF_FNAME, SRTM_NODATA, get_tile_bounds
+
+
+def make_tile_zip(x: int, y: int, size: int = 600, seed: int = 0) -> bytes:
+    """Return the bytes of a zip file containing a synthetic GeoTIFF for
+    tile x, y, with size x size pixels covering the tile's bounds.
+    """
+    left, bottom, right, top = get_tile_bounds(x, y)
+    rng = np.random.default_rng(seed + x * 100 + y)
+    # Smooth random terrain compresses roughly as well as real SRTM data
+    coarse = rng.integers(0, 3000, size=(size // 50 + 2, size // 50 + 2))
+    data = np.kron(coarse, np.ones((50, 50)))[:size, :size].astype(np.int16)
+    data += rng.integers(0, 10, size=data.shape, dtype=np.int16)
+    profile = {
+        'driver': 'GTiff',
+        'width': size,
+        'height': size,
+        'count': 1,
+        'dtype': 'int16',
+        'crs': 'EPSG:4326',
+        'transform': from_origin(left, top, (right - left) / size, (top - bottom) / size),
+        'nodata': SRTM_NODATA
+    }
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dst:
+            dst.write(data, 1)
+        tif_bytes = memfile.read()
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(TIF_FNAME.format(x=x, y=y), tif_bytes)
+    return buf.getvalue()
+
+
+class FakeCGIARServer:
+    """Serve synthetic tiles from a background thread on 127.0.0.1.
+
+    tiles are served as valid zip files; ocean tiles (and anything else)
+    get HTTP 404; truncated tiles advertise their full Content-Length but
+    the connection is closed halfway through the body.  bandwidth limits
+    each response to that many bytes per second and latency delays the
+    start of each response by that many seconds.
+    """
+
+    def __init__(self, tiles: Iterable[Tuple[int, int]], truncated: Iterable[Tuple[int, int]] = (),
+                 tile_size: int = 600, bandwidth: Optional[float] = None, latency: float = 0.0):
+        self.files: Dict[str, bytes] = {}
+        for x, y in tiles:
+            self.files[ZIP_FNAME.format(x=x, y=y)] = make_tile_zip(x, y, tile_size)
+        self.truncated: Set[str] = set()
+        for x, y in truncated:
+            fname = ZIP_FNAME.format(x=x, y=y)
+            self.files[fname] = make_tile_zip(x, y, tile_size)
+            self.truncated.add(fname)
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.requests: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address
+        return f'http://{host}:{port}/'
+
+    @property
+    def request_count(self) -> int:
+        return sum(self.requests.values())
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fname = self.path.rsplit('/', 1)[-1]
+                with server._lock:
+                    server.requests[fname] = server.requests.get(fname, 0) + 1
+                if server.latency:
+                    time.sleep(server.latency)
+                body = server.files.get(fname)
+                if body is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/zip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if fname in server.truncated:
+                    self.wfile.write(body[:len(body) // 2])
+                    self.close_connection = True
+                    return
+                if server.bandwidth is None:
+                    self.wfile.write(body)
+                    return
+                chunk_size = max(1, int(server.bandwidth / 20))
+                for i in range(0, len(body), chunk_size):
+                    self.wfile.write(body[i:i+chunk_size])
+                    time.sleep(chunk_size / server.bandwidth)
+
+        return Handler
+
+    def start(self) -> 'FakeCGIARServer':
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
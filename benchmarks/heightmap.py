@@ -0,0 +1,195 @@
+"""Benchmark the functions in bother_utils.heightmap on reproducible
+synthetic DEMs, with no network access or SRTM data needed:
+
+    python -m otter.benchmarks.heightmap [--sizes 512 2048 8192] [--json results.json] [--compare baseline.json]
+                                         [--scratch DIR]
+
+Each DEM has rolling hills with flat plateaus, lakes, land below sea
+level and a nodata ocean.  For each function, the wall time, CPU time
+and peak memory traced by tracemalloc are recorded (using the same
+Profiler as bother(profile=True)).  With --compare, results are checked
+against an earlier --json file and the benchmark exits with a non-zero
+status if any function got slower by more than --tolerance.  With
+--scratch, the functions' outputs are memory-mapped files in DIR (see
+bother_utils.scratch), so peak memory only counts what they allocate in
+memory.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from contextlib import nullcontext, redirect_stdout
+from typing import Optional, List
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+
+from otter.bother_utils.srtm import SRTM_NODATA, TILE_RES
+from otter.bother_utils.raster import Raster
+from otter.bother_utils.profiling import Profiler, profile_stage
+from otter.bother_utils.scratch import ScratchSpace
+from otter.bother_utils.heightmap import (resample, reproject_raster, get_all_lakes, set_lakes_to_elev,
+                                          raise_undersea_land, raise_low_pixels, to_png, crop_image, scale_image_f)
+
+
+DEFAULT_SIZES = [512, 1024, 2048, 4096, 8192]
+
+
+def make_dem(size: int, seed: int = 0, nodata: int = SRTM_NODATA) -> np.ndarray:
+    """Create a reproducible size x size int16 DEM with hills, flat
+    plateaus, lakes, land below sea level and a nodata ocean.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.ogrid[0:size, 0:size]
+    y, x = y / size, x / size
+    surface = np.zeros((size, size), dtype=np.float32)
+    for _ in range(6):
+        fx, fy, phase = rng.uniform(1, 6), rng.uniform(1, 6), rng.uniform(0, 2 * np.pi)
+        surface += np.sin(2 * np.pi * (fx * x + fy * y) + phase).astype(np.float32)
+    dem = surface * 150 + 200
+    dem += rng.normal(0, 3, (size, size)).astype(np.float32)
+
+    # Plateaus: clip the tops of the highest hills
+    dem = np.minimum(dem, np.percentile(dem, 95))
+    # Land below sea level in a depression near one corner
+    depression = ((x - 0.75) ** 2 + (y - 0.25) ** 2) < 0.01
+    dem = np.where(depression, dem - 400, dem)
+    # Lakes: flat discs of various sizes
+    for _ in range(max(size // 16, 1)):
+        row, col, radius = rng.integers(0, size), rng.integers(0, size), rng.uniform(3, size / 64 + 4)
+        r = int(radius)
+        window = np.s_[max(row - r, 0):min(row + r + 1, size), max(col - r, 0):min(col + r + 1, size)]
+        rows, cols = np.ogrid[window]
+        dem[window][(rows - row) ** 2 + (cols - col) ** 2 <= radius ** 2] = dem[row, col]
+    dem = dem.round().astype(np.int16)
+    # Ocean along the western and southern edges
+    ocean = (x + (1 - y)) < 0.3
+    dem[np.broadcast_to(ocean, dem.shape)] = nodata
+    return dem
+
+def make_raster(size: int, seed: int = 0) -> Raster:
+    """Wrap make_dem in a Raster with SRTM's resolution and CRS."""
+    transform = from_origin(10, 50, TILE_RES, TILE_RES)
+    return Raster(make_dem(size, seed), transform, CRS.from_epsg(4326), SRTM_NODATA)
+
+def get_version() -> Optional[str]:
+    """The git commit of the code being benchmarked, if known."""
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def get_cases(size: int, max_legacy_size: int):
+    """Return (name, function) pairs to benchmark at size; each function
+    takes the synthetic raster.
+    """
+    half = size // 2
+    cases = [
+        ('resample', lambda r: resample(r, 0.5)),
+        ('reproject_raster', lambda r: reproject_raster(r, 'EPSG:3857')),
+        ('set_lakes_to_elev', lambda r: set_lakes_to_elev(r, 80)),
+        ('raise_undersea_land', lambda r: raise_undersea_land(r)),
+        ('raise_low_pixels', lambda r: raise_low_pixels(r)),
+        ('to_png', lambda r: to_png(r, True)),
+        ('crop_image', lambda r: crop_image(to_png(r, True), half, half, 'c')),
+        ('scale_image_f', lambda r: scale_image_f(to_png(r, True), half, half))
+    ]
+    if size <= max_legacy_size:
+        cases.insert(2, ('get_all_lakes', lambda r: get_all_lakes(r.data, 80)))
+    return cases
+
+def _profile(name: str, func, raster: Raster, trace_memory: bool, scratch_dir: Optional[str] = None) -> dict:
+    scratch_space = ScratchSpace(scratch_dir) if scratch_dir else nullcontext()
+    with Profiler(trace_memory) as profiler, scratch_space, redirect_stdout(io.StringIO()):
+        with profile_stage(name, raster) as stage:
+            stage.set_output(func(raster))
+    return profiler.report()['stages'][0]
+
+def run_size(size: int, max_legacy_size: int, repeat: int = 1, scratch_dir: Optional[str] = None) -> List[dict]:
+    """Benchmark each function on a size x size DEM.  Times are the best
+    of repeat runs without tracemalloc (which slows down pure Python
+    code); memory is measured in one further run with it.
+    """
+    raster = make_raster(size)
+    results = []
+    for name, func in get_cases(size, max_legacy_size):
+        best = min((_profile(name, func, raster, False, scratch_dir) for _ in range(repeat)),
+                   key=lambda r: r['wall_s'])
+        traced = _profile(name, func, raster, True, scratch_dir)
+        results.append({
+            'function': name,
+            'size': size,
+            'wall_s': best['wall_s'],
+            'cpu_s': best['cpu_s'],
+            'peak_mb': traced['traced_peak_bytes'] / 1e6,
+            'output': best['output']
+        })
+        print(f'{name:<22}{size:>6}{best["wall_s"]:>10.3f}{best["cpu_s"]:>10.3f}{results[-1]["peak_mb"]:>11.1f}')
+    return results
+
+def compare(results: List[dict], baseline: dict, tolerance: float, min_seconds: float = 0.01) -> List[str]:
+    """Return a description of each function that is slower than in
+    baseline by more than a factor of tolerance (and by more than
+    min_seconds, to ignore noise in very short timings).
+    """
+    before = {(r['function'], r['size']): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        old = before.get((r['function'], r['size']))
+        if old is not None and r['wall_s'] > max(old['wall_s'] * tolerance, old['wall_s'] + min_seconds):
+            regressions.append(f'{r["function"]} at {r["size"]}x{r["size"]} took {r["wall_s"]:.3f}s, '
+                               f'up from {old["wall_s"]:.3f}s in {baseline.get("version")}.')
+    return regressions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark bother_utils.heightmap on synthetic DEMs.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Width and height of each synthetic DEM.')
+    parser.add_argument('--max-legacy-size', type=int, default=512,
+                        help='Largest DEM on which to run the pure Python get_all_lakes.')
+    parser.add_argument('--repeat', type=int, default=1, help='Run each function this many times and keep the best.')
+    parser.add_argument('--json', help='Write the results to this JSON file.')
+    parser.add_argument('--scratch', help='Memory-map the outputs of the functions in this directory.')
+    parser.add_argument('--compare', help='JSON file written by an earlier run to compare the results against.')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='Report a regression if a function is slower than this factor of the baseline.')
+    parser.add_argument('--min-seconds', type=float, default=0.01,
+                        help='Ignore slowdowns smaller than this many seconds.')
+    args = parser.parse_args(argv)
+
+    print(f'{"function":<22}{"size":>6}{"wall (s)":>10}{"cpu (s)":>10}{"peak (MB)":>11}')
+    results = []
+    for size in args.sizes:
+        results.extend(run_size(size, args.max_legacy_size, args.repeat, args.scratch))
+
+    output = {
+        'version': get_version(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'rasterio': rasterio.__version__,
+        'machine': platform.machine(),
+        'scratch': bool(args.scratch),
+        'results': results
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=1)
+    regressions = []
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_seconds)
+    for regression in regressions:
+        print(f'REGRESSION: {regression}')
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,98 @@
+"""Benchmark the cold-start cost of importing otter, and check that
+importing it (or using the light functions build_info and build_version)
+does not load any heavy dependency:
+
+    python -m otter.benchmarks.import_time [--repeat 5] [--budget 0.2] [--json results.json]
+
+Each scenario is run in a fresh interpreter, and its time is reported
+net of the time taken to start an interpreter that imports nothing.
+Exits with a non-zero status if a light scenario loads a heavy module
+or takes longer than --budget seconds.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from typing import Optional, List
+
+
+HEAVY_MODULES = ('geopandas', 'shapely', 'fiona', 'rasterio', 'pyproj', 'pandas', 'numpy', 'scipy', 'PIL',
+                 'requests', 'tqdm')
+
+# (name, code, whether the scenario must stay light)
+SCENARIOS = [
+    ('import otter', 'import otter', True),
+    ('otter.build_info', 'import otter; otter.build_info', True),
+    ('otter.build_version', 'import otter; otter.build_version', True),
+    ('otter.bother', 'import otter; otter.bother', False),
+    ('otter.get_map_coords', 'import otter; otter.get_map_coords', False)
+]
+
+_REPORT = ('; import sys, json; '
+           'print(json.dumps([m for m in {heavy!r} if m in sys.modules]))')
+
+
+def _run(code: str) -> (float, List[str]):
+    """Run code in a fresh interpreter, with the same sys.path as this
+    one, and return the wall time and the heavy modules it loaded.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', code + _REPORT.format(heavy=HEAVY_MODULES)], env=env,
+                         capture_output=True, text=True, check=True).stdout
+    elapsed = time.perf_counter() - start
+    return elapsed, json.loads(out.strip().splitlines()[-1])
+
+def run_benchmarks(repeat: int = 5) -> List[dict]:
+    baseline = statistics.median(_run('pass')[0] for _ in range(repeat))
+    results = []
+    for name, code, light in SCENARIOS:
+        runs = [_run(code) for _ in range(repeat)]
+        results.append({
+            'scenario': name,
+            'light': light,
+            'seconds': max(statistics.median(t for t, _ in runs) - baseline, 0.0),
+            'heavy_modules': runs[-1][1]
+        })
+    return results
+
+def check(results: List[dict], budget: float) -> List[str]:
+    failures = []
+    for r in results:
+        if not r['light']:
+            continue
+        if r['heavy_modules']:
+            failures.append(f'{r["scenario"]} loaded {", ".join(r["heavy_modules"])}.')
+        if r['seconds'] > budget:
+            failures.append(f'{r["scenario"]} took {r["seconds"]:.3f}s, over the budget of {budget:.3f}s.')
+    return failures
+
+def print_results(results: List[dict]):
+    print(f'{"scenario":<24}{"seconds":>9}  heavy modules loaded')
+    for r in results:
+        print(f'{r["scenario"]:<24}{r["seconds"]:>9.3f}  {", ".join(r["heavy_modules"]) or "-"}')
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the time taken to import otter.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of fresh interpreters per scenario.')
+    parser.add_argument('--budget', type=float, default=0.2,
+                        help='Maximum seconds (net of interpreter start-up) for the light scenarios.')
+    parser.add_argument('--json', help='Write the results to this JSON file.')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.repeat)
+    print_results(results)
+    failures = check(results, args.budget)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'results': results, 'failures': failures}, f, indent=1)
+    for failure in failures:
+        print(f'FAILED: {failure}')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
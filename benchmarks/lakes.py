@@ -0,0 +1,147 @@
+"""Benchmark lake detection (get_lake_mask) against the original flood
+fill implementation (get_all_lakes) on synthetic terraced DEMs:
+
+    python -m otter.benchmarks.lakes [--sizes 250 500 4000] [--min-size 80] [--workers 4] [--json results.json]
+
+Lakes are also found tile by tile (find_lakes_tiled) with --workers
+processes, and checked against the single-tile answer.  The original
+flood fill is only run on rasters up to --max-legacy-size pixels wide,
+as it takes minutes on larger ones.  Exits with a non-zero status if any
+of the implementations find different lakes on any raster.
+
+The time taken to find water by filling depressions (find_water, which
+finds different lakes by design) is reported alongside, with the time
+and peak memory taken by fill_depressions alone.  That uses about 150
+bytes per pixel on rasters up to FILL_MEMORY_BUDGET / 150 pixels, and a
+slower Priority-Flood using about 8 bytes per pixel on larger ones, on
+which peak memory is not measured.
+"""
+
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from typing import Optional, List
+
+import numpy as np
+
+from otter.bother_utils.srtm import SRTM_NODATA
+from otter.bother_utils.heightmap import (LAKE_TILE_SIZE, MST_BYTES_PER_PIXEL, FILL_MEMORY_BUDGET, get_all_lakes,
+                                          get_lake_mask, fill_depressions, find_water)
+
+
+def make_dem(size: int, seed: int = 0, nodata: int = SRTM_NODATA) -> np.ndarray:
+    """Create a size x size int16 DEM with terraces (flat regions of many
+    sizes, some of them lakes), noisy hillsides and a nodata border, like
+    SRTM data at the edge of a tile.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    surface = np.zeros((size, size))
+    for _ in range(6):
+        fx, fy, phase = rng.uniform(1, 8), rng.uniform(1, 8), rng.uniform(0, 2 * np.pi)
+        surface += np.sin(2 * np.pi * (fx * x + fy * y) + phase)
+    dem = (surface * size / 20).round()
+    noisy = surface > 1
+    dem[noisy] += rng.integers(-3, 4, np.count_nonzero(noisy))
+    # Lakes of all sizes either side of the usual minimum, some of them touching
+    for _ in range(size // 5):
+        row, col, radius = rng.integers(0, size), rng.integers(0, size), rng.uniform(2, 10)
+        r = int(radius)
+        window = np.s_[max(row - r, 0):min(row + r + 1, size), max(col - r, 0):min(col + r + 1, size)]
+        rows, cols = np.ogrid[window]
+        dem[window][(rows - row) ** 2 + (cols - col) ** 2 <= radius ** 2] = dem[row, col]
+    dem = dem.astype(np.int16)
+    dem[:, :size // 20] = nodata
+    return dem
+
+def legacy_mask(data: np.ndarray, min_size: int) -> np.ndarray:
+    mask = np.zeros(data.shape, dtype=np.bool_)
+    for lake in get_all_lakes(data, min_size):
+        rows, cols = zip(*lake)
+        mask[rows, cols] = True
+    return mask
+
+def run_size(size: int, min_size: int, legacy: bool, tile_size: int = LAKE_TILE_SIZE, workers: int = 1) -> dict:
+    dem = make_dem(size)
+    start = time.perf_counter()
+    mask = get_lake_mask(dem, min_size)
+    vectorized = time.perf_counter() - start
+    start = time.perf_counter()
+    tiled_mask = get_lake_mask(dem, min_size, tile_size=tile_size, workers=workers)
+    tiled = time.perf_counter() - start
+    start = time.perf_counter()
+    fill_depressions(dem)
+    fill = time.perf_counter() - start
+    # Tracing memory slows the Priority-Flood loop down many times over, so
+    # it is only measured when filling with the minimum spanning tree
+    fill_peak = None
+    if (size + 2) ** 2 * MST_BYTES_PER_PIXEL <= FILL_MEMORY_BUDGET:
+        tracemalloc.start()
+        fill_depressions(dem)
+        fill_peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    start = time.perf_counter()
+    water_mask, _ = find_water(dem, min_size)
+    flood = time.perf_counter() - start
+    result = {
+        'size': size,
+        'min_size': min_size,
+        'lake_pixels': int(np.count_nonzero(mask)),
+        'vectorized_s': vectorized,
+        'tile_size': tile_size,
+        'workers': workers,
+        'tiled_s': tiled,
+        'tiled_match': bool((tiled_mask == mask).all()),
+        'water_pixels': int(np.count_nonzero(water_mask)),
+        'fill_s': fill,
+        'fill_peak_mb': fill_peak,
+        'flood_s': flood,
+        'legacy_s': None,
+        'match': None
+    }
+    if legacy:
+        start = time.perf_counter()
+        expected = legacy_mask(dem, min_size)
+        result['legacy_s'] = time.perf_counter() - start
+        result['match'] = bool((mask == expected).all())
+    return result
+
+def print_results(results: List[dict]):
+    print(f'{"size":>6}{"lake px":>10}{"vectorized (s)":>16}{"tiled (s)":>11}{"legacy (s)":>12}{"speedup":>9}'
+          f'{"match":>7}{"water px":>10}{"fill (s)":>10}{"fill (MB)":>11}{"flood (s)":>11}')
+    for r in results:
+        legacy = f'{r["legacy_s"]:.2f}' if r['legacy_s'] is not None else '-'
+        speedup = f'{r["legacy_s"] / r["vectorized_s"]:.0f}x' if r['legacy_s'] is not None else '-'
+        fill_peak = f'{r["fill_peak_mb"]:.0f}' if r['fill_peak_mb'] is not None else '-'
+        match = {None: '-', True: 'yes', False: 'NO'}[r['match'] if r['tiled_match'] else False]
+        print(f'{r["size"]:>6}{r["lake_pixels"]:>10}{r["vectorized_s"]:>16.3f}{r["tiled_s"]:>11.3f}{legacy:>12}'
+              f'{speedup:>9}{match:>7}{r["water_pixels"]:>10}{r["fill_s"]:>10.3f}{fill_peak:>11}'
+              f'{r["flood_s"]:>11.3f}')
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark lake detection against the original flood fill.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[250, 500, 1000, 4000],
+                        help='Width and height of each synthetic DEM.')
+    parser.add_argument('--min-size', type=int, default=80, help='Minimum lake size in pixels.')
+    parser.add_argument('--max-legacy-size', type=int, default=1000,
+                        help='Largest DEM on which to run the original flood fill.')
+    parser.add_argument('--tile-size', type=int, default=LAKE_TILE_SIZE, help='Tile size for tiled lake detection.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes for tiled lake detection.')
+    parser.add_argument('--json', help='Write the results to this JSON file.')
+    args = parser.parse_args(argv)
+
+    results = [run_size(size, args.min_size, size <= args.max_legacy_size, args.tile_size, args.workers)
+               for size in args.sizes]
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'results': results}, f, indent=1)
+    failures = [r for r in results if (r['match'] is False) or not r['tiled_match']]
+    for r in failures:
+        print(f'FAILED: lakes differ between implementations on the {r["size"]}x{r["size"]} DEM.')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,139 @@
+"""Benchmark the SRTM download path (fetch_all_zips and the HTTP tile
+source) against a local fake CGIAR server, so that it can be run in CI
+with no network access:
+
+    python -m otter.benchmarks.srtm_fetch [--tiles 8] [--tile-size 1200] [--json results.json]
+
+Reports throughput, time to first tile and the cost of a warm cache for
+fast and slow links, and checks that ocean (404) tiles are not requested
+twice and that truncated downloads are never cached.  Exits with a
+non-zero status if any of those checks fail.
+"""
+
+import os
+import sys
+import json
+import shutil
+import time
+import tempfile
+import argparse
+from typing import Optional, List
+
+from otter.bother_utils.srtm import ZIP_FNAME, fetch_all_zips, is_cached
+from otter.bother_utils.sources import HTTPTileSource
+from otter.benchmarks.fake_cgiar import FakeCGIARServer
+
+
+class TimedTileSource(HTTPTileSource):
+    """HTTPTileSource that records when each tile finished downloading."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.finished = []
+
+    def fetch(self, fname, save_path, pbar=None):
+        fpath = super().fetch(fname, save_path, pbar)
+        self.finished.append(time.perf_counter())
+        return fpath
+
+
+def _fnames(tiles) -> dict:
+    return {(x, y): ZIP_FNAME.format(x=x, y=y) for x, y in tiles}
+
+def run_fetch(name: str, server: FakeCGIARServer, tiles, workers: int, cache_dir: str) -> dict:
+    """Fetch tiles from server into cache_dir and return timings for the
+    run.
+    """
+    requests_before = server.request_count
+    source = TimedTileSource(server.url, workers)
+    start = time.perf_counter()
+    with source:
+        fpaths = fetch_all_zips(_fnames(tiles), cache_dir, workers, source)
+    elapsed = time.perf_counter() - start
+    size = sum(len(server.files[ZIP_FNAME.format(x=x, y=y)]) for (x, y), fpath in fpaths.items()
+               if fpath is not None) if source.finished else 0
+    first = (min(source.finished) - start) if source.finished else None
+    return {
+        'name': name,
+        'tiles': len(tiles),
+        'workers': workers,
+        'bytes': size,
+        'seconds': elapsed,
+        'mb_per_s': (size / 1e6 / elapsed) if size else None,
+        'time_to_first_tile': first,
+        'requests': server.request_count - requests_before
+    }
+
+def run_benchmarks(n_tiles: int = 8, tile_size: int = 1200, slow_bandwidth: float = 20e6,
+                   slow_latency: float = 0.05) -> (List[dict], List[str]):
+    """Run all benchmark scenarios and return their results and a list of
+    failed checks.
+    """
+    tiles = [(x, 5) for x in range(10, 10 + n_tiles)]
+    ocean = [(x, 1) for x in range(10, 12)]
+    results = []
+    failures = []
+    root = tempfile.mkdtemp(prefix='bother_bench_')
+    cache_dir = lambda name: os.path.join(root, name)
+
+    try:
+        with FakeCGIARServer(tiles, tile_size=tile_size) as server:
+            results.append(run_fetch('cold, serial', server, tiles, 1, cache_dir('serial')))
+            results.append(run_fetch('cold, parallel', server, tiles, 4, cache_dir('parallel')))
+            warm = run_fetch('warm cache', server, tiles, 4, cache_dir('parallel'))
+            results.append(warm)
+            if warm['requests']:
+                failures.append(f'Warm cache made {warm["requests"]} requests.')
+
+            results.append(run_fetch('ocean tiles, first run', server, ocean, 4, cache_dir('ocean')))
+            second = run_fetch('ocean tiles, second run', server, ocean, 4, cache_dir('ocean'))
+            results.append(second)
+            if second['requests']:
+                failures.append(f'Known ocean tiles were requested {second["requests"]} more times.')
+
+        with FakeCGIARServer(tiles, tile_size=tile_size, bandwidth=slow_bandwidth, latency=slow_latency) as server:
+            results.append(run_fetch('slow link, serial', server, tiles, 1, cache_dir('slow_serial')))
+            results.append(run_fetch('slow link, parallel', server, tiles, 4, cache_dir('slow_parallel')))
+
+        truncated = [(40, 5)]
+        with FakeCGIARServer([], truncated, tile_size=tile_size) as server:
+            try:
+                fetch_all_zips(_fnames(truncated), cache_dir('truncated'), 1, server.url)
+                failures.append('Truncated download did not raise an error.')
+            except Exception as e:
+                print(f'Truncated download raised {type(e).__name__}, as expected.')
+            if is_cached(ZIP_FNAME.format(x=40, y=5), cache_dir('truncated')):
+                failures.append('Truncated download was cached.')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    return results, failures
+
+def print_results(results: List[dict]):
+    print(f'{"scenario":<26}{"tiles":>6}{"workers":>8}{"MB":>8}{"s":>8}{"MB/s":>8}{"first (s)":>10}{"requests":>9}')
+    for r in results:
+        mb_per_s = f'{r["mb_per_s"]:.1f}' if r['mb_per_s'] is not None else '-'
+        first = f'{r["time_to_first_tile"]:.2f}' if r['time_to_first_tile'] is not None else '-'
+        print(f'{r["name"]:<26}{r["tiles"]:>6}{r["workers"]:>8}{r["bytes"] / 1e6:>8.1f}{r["seconds"]:>8.2f}'
+              f'{mb_per_s:>8}{first:>10}{r["requests"]:>9}')
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the SRTM download path against a local fake server.')
+    parser.add_argument('--tiles', type=int, default=8, help='Number of tiles to download per scenario.')
+    parser.add_argument('--tile-size', type=int, default=1200, help='Width and height of each synthetic tile.')
+    parser.add_argument('--slow-bandwidth', type=float, default=20e6,
+                        help='Bytes per second per connection for the slow link scenarios.')
+    parser.add_argument('--json', help='Write the results to this JSON file.')
+    args = parser.parse_args(argv)
+
+    results, failures = run_benchmarks(args.tiles, args.tile_size, args.slow_bandwidth)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'results': results, 'failures': failures}, f, indent=1)
+    for failure in failures:
+        print(f'FAILED: {failure}')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
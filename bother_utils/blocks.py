@@ -0,0 +1,208 @@
+"""Run pointwise raster stages block by block, so that only a few blocks
+of a raster need to be in memory at once and blocks can be processed in
+parallel threads.
+
+A pointwise stage computes each output pixel from the same input pixel
+only, but may depend on global statistics of its input (eg, remove_sea
+needs the minimum elevation).  Those statistics are gathered in an
+extra pass over the blocks, which re-applies the kernels of any earlier
+stages on the fly, so a chain of stages never writes an intermediate
+raster.  Sources and destinations may be numpy arrays (including
+memory-mapped ones) or rasterio datasets.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+from typing import Callable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import rasterio
+from rasterio.dtypes import in_dtype_range
+from rasterio.windows import Window
+
+from otter.bother_utils import scratch
+
+
+BLOCK_SHAPE = (1024, 1024)
+BLOCK_THREADS = min(4, os.cpu_count() or 1)
+
+Kernel = Callable[[np.ndarray], np.ndarray]
+BlockWindow = Tuple[slice, slice]
+
+
+class PointwiseStage(NamedTuple):
+    """A pointwise stage.  make_kernel returns the function applied to
+    each block; if needs_stats is set, it is called with the minimum and
+    maximum of the stage's whole input, and otherwise with no arguments.
+    """
+    make_kernel: Callable[..., Kernel]
+    needs_stats: bool = False
+
+
+def iter_windows(shape: Tuple[int, int], block_shape: Tuple[int, int] = BLOCK_SHAPE) -> Iterator[BlockWindow]:
+    """Yield (row slice, column slice) pairs covering an array of the
+    given shape in blocks of block_shape.
+    """
+    height, width = shape
+    block_height, block_width = block_shape
+    for row in range(0, height, block_height):
+        for col in range(0, width, block_width):
+            yield np.s_[row:min(row + block_height, height), col:min(col + block_width, width)]
+
+def get_block_shape(src) -> Tuple[int, int]:
+    """Block shape to use for src: the internal tiling of a rasterio
+    dataset (with strips grouped into blocks of about BLOCK_SHAPE rows),
+    or BLOCK_SHAPE for arrays.
+    """
+    if isinstance(src, np.ndarray):
+        return BLOCK_SHAPE
+    block_height, block_width = src.block_shapes[0]
+    if block_width == src.width and block_height < BLOCK_SHAPE[0]:
+        block_height *= max(BLOCK_SHAPE[0] // block_height, 1)
+    return block_height, block_width
+
+def _read(src, window: BlockWindow, lock: threading.Lock) -> np.ndarray:
+    if isinstance(src, np.ndarray):
+        return src[window]
+    # rasterio datasets must not be used from several threads at once
+    with lock:
+        return src.read(1, window=Window.from_slices(*window))
+
+def _write(dst, window: BlockWindow, data: np.ndarray, lock: threading.Lock):
+    if isinstance(dst, np.ndarray):
+        dst[window] = data
+    else:
+        with lock:
+            dst.write(data, 1, window=Window.from_slices(*window))
+
+def _shape(src) -> Tuple[int, int]:
+    return src.shape if isinstance(src, np.ndarray) else (src.height, src.width)
+
+def _map_blocks(func: Callable[[BlockWindow], object], windows: Sequence[BlockWindow], threads: int) -> list:
+    if threads > 1 and len(windows) > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            return list(executor.map(func, windows))
+    return [func(window) for window in windows]
+
+def fuse(kernels: Sequence[Kernel]) -> Kernel:
+    """Return a kernel that applies each of kernels in turn."""
+    return lambda block: reduce(lambda data, kernel: kernel(data), kernels, block)
+
+def block_min_max(src, kernel: Optional[Kernel] = None, block_shape: Optional[Tuple[int, int]] = None,
+                  threads: int = BLOCK_THREADS):
+    """Return the minimum and maximum of src (after applying kernel to
+    each block, if given), reading it block by block.
+    """
+    lock = threading.Lock()
+    kernel = kernel or (lambda block: block)
+
+    def min_max(window):
+        block = kernel(_read(src, window, lock))
+        return block.min(), block.max()
+
+    windows = list(iter_windows(_shape(src), block_shape or get_block_shape(src)))
+    stats = _map_blocks(min_max, windows, threads)
+    return min(s[0] for s in stats), max(s[1] for s in stats)
+
+def block_histogram(src, kernel: Optional[Kernel] = None, block_shape: Optional[Tuple[int, int]] = None,
+                    threads: int = BLOCK_THREADS) -> Tuple[int, np.ndarray]:
+    """Return a histogram of the integer values of src (after applying
+    kernel to each block, if given), reading it block by block, as the
+    value of the first bin and the count of each value from there on.
+    """
+    lock = threading.Lock()
+    kernel = kernel or (lambda block: block)
+
+    def histogram(window):
+        block = kernel(_read(src, window, lock))
+        if not block.size:
+            return None
+        low = int(block.min())
+        return low, np.bincount((block.astype(np.int64) - low).ravel())
+
+    windows = list(iter_windows(_shape(src), block_shape or get_block_shape(src)))
+    histograms = [h for h in _map_blocks(histogram, windows, threads) if h is not None]
+    low = min(h[0] for h in histograms)
+    counts = np.zeros(max(h[0] + len(h[1]) for h in histograms) - low, dtype=np.int64)
+    for offset, block_counts in histograms:
+        counts[offset - low:offset - low + len(block_counts)] += block_counts
+    return low, counts
+
+def block_map(src, kernel: Kernel, dst, block_shape: Optional[Tuple[int, int]] = None,
+              threads: int = BLOCK_THREADS):
+    """Apply kernel to src block by block, writing the results to dst
+    (which may be src itself).  Returns dst.
+    """
+    read_lock = threading.Lock()
+    write_lock = read_lock if dst is src else threading.Lock()
+
+    def apply(window):
+        _write(dst, window, kernel(_read(src, window, read_lock)), write_lock)
+
+    windows = list(iter_windows(_shape(src), block_shape or get_block_shape(src)))
+    _map_blocks(apply, windows, threads)
+    return dst
+
+def get_stats(src, stages: Sequence[PointwiseStage], block_shape: Optional[Tuple[int, int]] = None,
+              threads: int = BLOCK_THREADS) -> List[Optional[Tuple[float, float]]]:
+    """Return the statistics (minimum and maximum of its input) that each
+    of stages needs when run over src, or None for stages that do not
+    need any.
+    """
+    kernels: List[Kernel] = []
+    stats: List[Optional[Tuple[float, float]]] = []
+    for stage in stages:
+        stats.append(block_min_max(src, fuse(kernels), block_shape, threads) if stage.needs_stats else None)
+        kernels.append(stage.make_kernel(*(stats[-1] or ())))
+    return stats
+
+def get_kernel(src, stages: Sequence[PointwiseStage], block_shape: Optional[Tuple[int, int]] = None,
+               threads: int = BLOCK_THREADS, stats: Optional[Sequence] = None) -> Kernel:
+    """Gather the statistics needed by stages from src (unless given as
+    stats, as returned by get_stats) and return the fused kernel of all
+    of them.
+    """
+    if stats is not None:
+        return fuse([stage.make_kernel(*(s or ())) for stage, s in zip(stages, stats)])
+    kernels: List[Kernel] = []
+    for stage in stages:
+        if stage.needs_stats:
+            kernels.append(stage.make_kernel(*block_min_max(src, fuse(kernels), block_shape, threads)))
+        else:
+            kernels.append(stage.make_kernel())
+    return fuse(kernels)
+
+def run_pointwise(src, stages: Sequence[PointwiseStage], dst=None, dtype=None,
+                  block_shape: Optional[Tuple[int, int]] = None, threads: int = BLOCK_THREADS,
+                  stats: Optional[Sequence] = None):
+    """Run stages over src block by block and return the result, written
+    to dst if given and otherwise to a new array of the given dtype (by
+    default, that of src).  If stats is given (see get_stats), the stages
+    use those statistics rather than those of src, eg when src is a crop
+    of a larger raster.
+    """
+    kernel = get_kernel(src, stages, block_shape, threads, stats)
+    if dst is None:
+        if dtype is None:
+            dtype = src.dtype if isinstance(src, np.ndarray) else src.dtypes[0]
+        dst = scratch.empty(_shape(src), dtype)
+    return block_map(src, kernel, dst, block_shape, threads)
+
+def run_pointwise_file(infile: str, outfile: str, stages: Sequence[PointwiseStage], dtype=None,
+                       threads: int = BLOCK_THREADS) -> str:
+    """Run stages over the GeoTIFF infile block by block, writing the
+    result to outfile.  Memory use is bounded by the block size, so this
+    works for rasters larger than memory.  If dtype cannot hold the nodata
+    value of infile (eg, uint8 greyscale), outfile has no nodata value.
+    """
+    with rasterio.open(infile) as src:
+        profile = src.profile.copy()
+        profile.update({'count': 1, 'dtype': dtype or src.dtypes[0], 'tiled': True,
+                        'blockxsize': BLOCK_SHAPE[1], 'blockysize': BLOCK_SHAPE[0], 'BIGTIFF': 'IF_SAFER'})
+        if profile.get('nodata') is not None and not in_dtype_range(profile['nodata'], profile['dtype']):
+            profile['nodata'] = None
+        with rasterio.open(outfile, 'w', **profile) as dst:
+            run_pointwise(src, stages, dst, threads=threads)
+    return outfile
@@ -0,0 +1,137 @@
+"""Map elevations to greyscale brightness through a lookup table.
+
+A histogram of the (integer) elevations is built in one pass over the
+raster, block by block.  A brightness curve is then evaluated once for
+each elevation in the histogram's range and quantised to a uint8 lookup
+table, so converting the raster only takes one more pass, indexing that
+table, instead of several full-size float temporaries.
+
+Curves are given as strings:
+
+    linear                      Stretch the lowest to the highest elevation (as bother always has).
+    percentile[:LOW,HIGH]       Stretch the LOW to the HIGH percentile (default 0,99.9), so that a few
+                                outlying peaks do not flatten the rest of the map.
+    gamma[:GAMMA]               Linear stretch raised to the power GAMMA (default 0.5); below 1
+                                brightens lowlands, above 1 brightens highlands.
+    piecewise:E:B,E:B,...       Interpolate between control points of elevation E and brightness B.
+"""
+
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from otter.bother_utils.blocks import BLOCK_THREADS, Kernel, block_histogram
+
+
+CURVES = ('linear', 'percentile', 'gamma', 'piecewise')
+DEFAULT_PERCENTILES = (0.0, 99.9)
+DEFAULT_GAMMA = 0.5
+
+
+class Histogram(NamedTuple):
+    """The number of pixels of each integer elevation from offset on."""
+    offset: int
+    counts: np.ndarray
+
+    @property
+    def min(self) -> int:
+        return self.offset + int(np.flatnonzero(self.counts)[0])
+
+    @property
+    def max(self) -> int:
+        return self.offset + int(np.flatnonzero(self.counts)[-1])
+
+    def including(self, elev: int) -> 'Histogram':
+        """This histogram with at least one pixel of elevation elev, so that
+        elev is within its range.
+        """
+        offset = min(self.offset, elev)
+        counts = np.zeros(max(self.offset + len(self.counts), elev + 1) - offset, dtype=self.counts.dtype)
+        counts[self.offset - offset:self.offset - offset + len(self.counts)] = self.counts
+        counts[elev - offset] = max(counts[elev - offset], 1)
+        return Histogram(offset, counts)
+
+    def percentile(self, q: float) -> int:
+        """Lowest elevation at or below which at least q percent of pixels lie."""
+        cumulative = np.cumsum(self.counts)
+        rank = max(q / 100 * cumulative[-1], 1)
+        return self.offset + int(np.searchsorted(cumulative, rank))
+
+
+def get_histogram(src, kernel: Optional[Kernel] = None, threads: int = BLOCK_THREADS) -> Histogram:
+    """Histogram of the elevations of src (an integer array or rasterio
+    dataset), after applying kernel if given, built block by block.
+    """
+    return Histogram(*block_histogram(src, kernel, threads=threads))
+
+def linear_kernel(min_elev, max_elev, max_brightness: int = 255) -> Kernel:
+    """Kernel stretching min_elev to max_elev linearly to brightness 0 to
+    max_brightness.
+    """
+    scale_factor = max_brightness / (max_elev - min_elev)
+    if min_elev > 0:
+        # If everywhere on the map is above sea level, we should scale
+        # such that the lowest parts of the map appear slightly above sea level.
+        floor = min_elev + 1
+    else:
+        floor = min_elev
+    return lambda data: ((data - floor) * scale_factor).astype(np.uint8)
+
+def parse_curve(spec: str) -> Tuple[str, dict]:
+    """Parse a curve given as a string (see the module docstring) into its
+    name and keyword arguments for get_lut.
+    """
+    name, _, args = spec.partition(':')
+    name = name.strip().lower()
+    try:
+        if name == 'percentile':
+            low, high = (float(a) for a in args.split(',')) if args else DEFAULT_PERCENTILES
+            if not 0 <= low < high <= 100:
+                raise ValueError
+            return name, {'low': low, 'high': high}
+        elif name == 'gamma':
+            gamma = float(args) if args else DEFAULT_GAMMA
+            if gamma <= 0:
+                raise ValueError
+            return name, {'gamma': gamma}
+        elif name == 'piecewise':
+            points = [tuple(float(v) for v in point.split(':')) for point in args.split(',')]
+            if (len(points) < 2) or any(len(p) != 2 for p in points):
+                raise ValueError
+            return name, {'points': sorted(points)}
+        elif (name == 'linear') and not args:
+            return name, {}
+    except ValueError:
+        pass
+    raise ValueError(f'Invalid brightness curve {spec}; must be one of {", ".join(CURVES)} (see bother_utils.brightness).')
+
+def get_lut(histogram: Histogram, max_brightness: int = 255, curve: str = 'linear', low: float = 0.0,
+            high: float = 100.0, gamma: float = 1.0, points: Optional[Sequence[Tuple[float, float]]] = None,
+            dtype=np.int64) -> np.ndarray:
+    """Return the uint8 brightness of each elevation from histogram.offset
+    to histogram.max, for curve (one of CURVES, with its parameters as
+    returned by parse_curve).  dtype is that of the elevations, so that
+    the linear curve gives exactly the same result as linear_kernel.
+    """
+    min_elev, max_elev = histogram.min, histogram.max
+    elevs = np.arange(histogram.offset, max_elev + 1).astype(dtype)
+    if curve == 'linear':
+        return linear_kernel(np.dtype(dtype).type(min_elev), np.dtype(dtype).type(max_elev), max_brightness)(elevs)
+    elevs = elevs.astype(np.float64)
+    if curve == 'piecewise':
+        brightness = np.interp(elevs, [p[0] for p in points], [p[1] for p in points])
+    else:
+        if curve == 'percentile':
+            min_elev, max_elev = histogram.percentile(low), histogram.percentile(high)
+        elif curve != 'gamma':
+            raise ValueError(f'Unknown brightness curve {curve}.')
+        scaled = np.clip((elevs - min_elev) / max(max_elev - min_elev, 1), 0, 1)
+        brightness = max_brightness * scaled ** gamma
+    return np.floor(np.clip(brightness, 0, max_brightness)).astype(np.uint8)
+
+def lut_kernel(lut: np.ndarray, offset: int) -> Kernel:
+    """Kernel looking up the brightness of each elevation in lut, which
+    starts at elevation offset.  Elevations outside the table get the
+    brightness of its nearest end.
+    """
+    return lambda data: lut[np.clip(data.astype(np.intp) - offset, 0, len(lut) - 1)]
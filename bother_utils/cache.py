@@ -0,0 +1,136 @@
+"""Functions to keep the SRTM cache within a size budget, evicting the
+least recently used tiles first while keeping pinned regions warm.
+"""
+
+import os
+import json
+from typing import Optional, Iterable, Tuple, List, Set
+
+from otter.bother_utils.catalog import get_catalog, STATUS_PRESENT, STATUS_CORRUPT
+from otter.bother_utils.srtm import CACHE_DIR, TIF_FNAME, get_all_zip_fnames, get_extract_dir, get_decoded_dir
+
+
+DEFAULT_CACHE_SIZE = 2 * 1024 ** 3  # 2 GiB
+PINNED_FNAME = 'pinned.json'
+
+Bounds = Tuple[float, float, float, float]
+
+
+def get_pinned_regions(cache_dir: str = CACHE_DIR) -> List[Bounds]:
+    """Return the (left, bottom, right, top) bounds of all regions pinned
+    in cache_dir.  The list is stored in the cache directory itself, so
+    hosts sharing a cache directory share their pinned regions too.
+    """
+    try:
+        with open(os.path.join(cache_dir, PINNED_FNAME), 'r') as f:
+            return [tuple(b) for b in json.load(f)['regions']]
+    except FileNotFoundError:
+        return []
+
+def _save_pinned_regions(regions: Iterable[Bounds], cache_dir: str):
+    os.makedirs(cache_dir, exist_ok=True)
+    fpath = os.path.join(cache_dir, PINNED_FNAME)
+    with open(fpath + '.part', 'w') as f:
+        json.dump({'regions': [list(b) for b in regions]}, f, indent=1)
+    os.replace(fpath + '.part', fpath)
+
+def pin_region(left: float, bottom: float, right: float, top: float, cache_dir: str = CACHE_DIR):
+    """Pin the region within the given bounds, so that the tiles covering
+    it are never evicted from the cache.
+    """
+    regions = get_pinned_regions(cache_dir)
+    bounds = (left, bottom, right, top)
+    if bounds not in regions:
+        print(f'Pinning region {bounds} in {cache_dir}.')
+        regions.append(bounds)
+        _save_pinned_regions(regions, cache_dir)
+
+def unpin_region(left: float, bottom: float, right: float, top: float, cache_dir: str = CACHE_DIR):
+    """Unpin a region previously pinned with pin_region."""
+    regions = get_pinned_regions(cache_dir)
+    bounds = (left, bottom, right, top)
+    if bounds in regions:
+        print(f'Unpinning region {bounds} in {cache_dir}.')
+        regions.remove(bounds)
+        _save_pinned_regions(regions, cache_dir)
+
+def get_pinned_tiles(cache_dir: str = CACHE_DIR) -> Set[str]:
+    """Return the zip filenames of all tiles covering a pinned region."""
+    fnames = set()
+    for bounds in get_pinned_regions(cache_dir):
+        fnames.update(get_all_zip_fnames(*bounds).values())
+    return fnames
+
+def get_tile_fpaths(fname: str, cache_dir: str = CACHE_DIR) -> List[str]:
+    """Return the paths of all files in the cache that belong to the
+    tile with zip filename fname (ie, the zip file and any decoded copies
+    of the tile), whether or not they exist.
+    """
+    tif_fname = os.path.splitext(fname)[0] + os.path.splitext(TIF_FNAME)[1]
+    return [
+        os.path.join(cache_dir, fname),
+        os.path.join(get_extract_dir(cache_dir), tif_fname),
+        os.path.join(get_decoded_dir(cache_dir), tif_fname)
+    ]
+
+def get_tile_size(fname: str, cache_dir: str = CACHE_DIR) -> int:
+    """Return the number of bytes used in the cache by tile fname."""
+    size = 0
+    for fpath in get_tile_fpaths(fname, cache_dir):
+        try:
+            size += os.path.getsize(fpath)
+        except FileNotFoundError:
+            pass
+    return size
+
+def get_cache_size(cache_dir: str = CACHE_DIR) -> int:
+    """Return the number of bytes used by all tiles in the cache."""
+    catalog = get_catalog(cache_dir)
+    return sum(get_tile_size(f, cache_dir) for f in catalog.files(STATUS_PRESENT) + catalog.files(STATUS_CORRUPT))
+
+def evict_tile(fname: str, cache_dir: str = CACHE_DIR):
+    """Remove all files belonging to tile fname from the cache."""
+    for fpath in get_tile_fpaths(fname, cache_dir):
+        try:
+            os.remove(fpath)
+        except FileNotFoundError:
+            pass
+    get_catalog(cache_dir).forget(fname)
+
+def enforce_cache_limit(max_size: int = DEFAULT_CACHE_SIZE, cache_dir: str = CACHE_DIR,
+                        pinned: Optional[Iterable[str]] = None) -> List[str]:
+    """Evict tiles from the cache, least recently used first, until it
+    uses at most max_size bytes.  Corrupt tiles are always evicted first.
+    Tiles covering a pinned region (or listed in pinned, if given) are
+    never evicted, even if that means the cache stays over budget.
+    Returns the zip filenames of the evicted tiles.
+    """
+    catalog = get_catalog(cache_dir)
+    if pinned is None:
+        pinned = get_pinned_tiles(cache_dir)
+    pinned = set(pinned)
+
+    sizes = {f: get_tile_size(f, cache_dir) for f in catalog.files(STATUS_PRESENT) + catalog.files(STATUS_CORRUPT)}
+    total = sum(sizes.values())
+
+    evicted = []
+    for fname in catalog.files(STATUS_CORRUPT):
+        evict_tile(fname, cache_dir)
+        total -= sizes.pop(fname)
+        evicted.append(fname)
+
+    candidates = sorted((f for f in sizes if f not in pinned), key=lambda f: catalog.get(f)['atime'])
+    for fname in candidates:
+        if total <= max_size:
+            break
+        evict_tile(fname, cache_dir)
+        total -= sizes[fname]
+        evicted.append(fname)
+
+    if evicted:
+        print(f'Evicted {len(evicted)} tiles from {cache_dir}; cache now uses {total / 1e6:.1f} MB.')
+        catalog.save()
+    if total > max_size:
+        print(f'WARNING: Cache uses {total / 1e6:.1f} MB, which is over the limit of {max_size / 1e6:.1f} MB, '
+              f'because of pinned tiles.')
+    return evicted
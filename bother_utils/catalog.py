@@ -0,0 +1,241 @@
+"""A small on-disk catalog of the SRTM tiles held in a cache directory,
+so that the state of the cache can be looked up without scanning the
+directory or probing the server.
+"""
+
+import os
+import json
+import time
+import hashlib
+import zipfile
+import threading
+from contextlib import contextmanager
+from typing import Optional, Set, Tuple, Dict, List
+
+
+CATALOG_FNAME = 'catalog.json'
+
+STATUS_PRESENT = 'present'  # The zip file is in the cache and is complete
+STATUS_OCEAN = 'ocean'      # The server has no such tile (HTTP 404), ie, there is no land there
+STATUS_CORRUPT = 'corrupt'  # The zip file is in the cache but could not be read
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# A lock file older than this (in seconds) was left by a process that died while saving
+STALE_LOCK_AGE = 30
+
+_catalogs: Dict[str, 'TileCatalog'] = {}
+_catalogs_lock = threading.Lock()
+
+
+def file_sha256(fpath: str) -> str:
+    """Return the hex SHA-256 digest of the file at fpath."""
+    h = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+@contextmanager
+def _lock_file(fpath: str, poll: float = 0.01):
+    """Hold the lock file fpath, so that only one process at a time (on
+    any platform) reads, merges and replaces the file it guards.
+    """
+    while True:
+        try:
+            os.close(os.open(fpath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(fpath) > STALE_LOCK_AGE:
+                    os.remove(fpath)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(poll)
+    try:
+        yield
+    finally:
+        os.remove(fpath)
+
+def is_valid_zip(fpath: str) -> bool:
+    """Check that the file at fpath is a complete, readable zip file."""
+    try:
+        with zipfile.ZipFile(fpath, 'r') as zf:
+            return zf.testzip() is None
+    except (OSError, zipfile.BadZipFile):
+        return False
+
+
+class TileCatalog:
+    """Records the status, size, checksum, last access time and bounds of
+    each tile in a cache directory, keyed by zip filename, and persists
+    them to a JSON file in that directory.  Use get_catalog to get the
+    (shared) catalog for a directory.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.fpath = os.path.join(cache_dir, CATALOG_FNAME)
+        self.tiles: Dict[str, dict] = {}
+        # Tiles recorded or forgotten in this process since the catalog was last saved
+        self._changed: Set[str] = set()
+        self._mtime = None
+        self._lock = threading.RLock()
+        self.load()
+
+    def _read(self) -> Dict[str, dict]:
+        with open(self.fpath, 'r') as f:
+            return json.load(f)['tiles']
+
+    def _merge_changes(self, tiles: Dict[str, dict]) -> Dict[str, dict]:
+        """Apply the unsaved changes made in this process to tiles (as read
+        from disk, where other processes may have changed other tiles).
+        """
+        for fname in self._changed:
+            if fname in self.tiles:
+                tiles[fname] = self.tiles[fname]
+            else:
+                tiles.pop(fname, None)
+        return tiles
+
+    def load(self):
+        """Load the catalog from disk, keeping any unsaved changes.  If
+        there is no catalog file yet, any zip files already in the cache
+        directory are adopted.
+        """
+        with self._lock:
+            try:
+                self.tiles = self._merge_changes(self._read())
+                self._mtime = os.path.getmtime(self.fpath)
+            except FileNotFoundError:
+                self._adopt_existing()
+            except (ValueError, KeyError):
+                print(f'WARNING: Could not read tile catalog {self.fpath}; rebuilding it.')
+                self._adopt_existing()
+
+    def _adopt_existing(self):
+        try:
+            fnames = [f for f in os.listdir(self.cache_dir) if f.endswith('.zip')]
+        except FileNotFoundError:
+            return
+        for fname in fnames:
+            self.record_present(fname, os.path.join(self.cache_dir, fname))
+        if fnames:
+            self.save()
+
+    def reload_if_changed(self):
+        """Reload the catalog if the file has been changed by another
+        process since it was last loaded or saved.
+        """
+        try:
+            mtime = os.path.getmtime(self.fpath)
+        except FileNotFoundError:
+            return
+        if mtime != self._mtime:
+            self.load()
+
+    def save(self):
+        """Write the catalog to disk atomically, if it has changed.  The
+        changes are merged into the catalog on disk, so that those saved
+        by other processes using the same cache are kept.
+        """
+        with self._lock:
+            if not self._changed:
+                return
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with _lock_file(self.fpath + '.lock'):
+                try:
+                    self.tiles = self._merge_changes(self._read())
+                except (FileNotFoundError, ValueError, KeyError):
+                    pass
+                temp_fpath = f'{self.fpath}.{os.getpid()}.{threading.get_ident()}.part'
+                with open(temp_fpath, 'w') as f:
+                    json.dump({'tiles': self.tiles}, f, indent=1, sort_keys=True)
+                os.replace(temp_fpath, self.fpath)
+                self._mtime = os.path.getmtime(self.fpath)
+            self._changed.clear()
+
+    def get(self, fname: str) -> Optional[dict]:
+        return self.tiles.get(fname)
+
+    def status(self, fname: str) -> Optional[str]:
+        entry = self.tiles.get(fname)
+        if entry is not None:
+            return entry['status']
+
+    def is_present(self, fname: str) -> bool:
+        """Check whether a complete copy of fname is in the cache."""
+        return (self.status(fname) == STATUS_PRESENT
+                and os.path.exists(os.path.join(self.cache_dir, fname)))
+
+    def is_ocean(self, fname: str) -> bool:
+        """Check whether fname is known not to exist on the server."""
+        return self.status(fname) == STATUS_OCEAN
+
+    def files(self, status: str = STATUS_PRESENT, ext: str = '') -> List[str]:
+        return [f for f, entry in self.tiles.items() if (entry['status'] == status) and f.endswith(ext)]
+
+    def _record(self, fname: str, status: str, bounds: Optional[Tuple[float, float, float, float]] = None,
+                **kwargs):
+        with self._lock:
+            entry = self.tiles.get(fname, {})
+            entry.update(kwargs)
+            entry['status'] = status
+            entry['atime'] = time.time()
+            if bounds is not None:
+                entry['bounds'] = list(bounds)
+            self.tiles[fname] = entry
+            self._changed.add(fname)
+
+    def record_present(self, fname: str, fpath: str, bounds: Optional[Tuple[float, float, float, float]] = None,
+                       sha256: Optional[str] = None):
+        """Record that fname has been downloaded to fpath."""
+        if sha256 is None:
+            sha256 = file_sha256(fpath)
+        self._record(fname, STATUS_PRESENT, bounds, size=os.path.getsize(fpath), sha256=sha256)
+
+    def record_ocean(self, fname: str, bounds: Optional[Tuple[float, float, float, float]] = None):
+        """Record that the server has no tile fname (ie, it contains no
+        land), so that it is never requested again.
+        """
+        self._record(fname, STATUS_OCEAN, bounds, size=0, sha256=None)
+
+    def record_corrupt(self, fname: str):
+        """Record that the cached copy of fname cannot be read, so that it
+        is downloaded again.
+        """
+        self._record(fname, STATUS_CORRUPT)
+
+    def touch(self, fname: str):
+        """Update the last access time of fname."""
+        with self._lock:
+            if fname in self.tiles:
+                self.tiles[fname]['atime'] = time.time()
+                self._changed.add(fname)
+
+    def forget(self, fname: str):
+        with self._lock:
+            self.tiles.pop(fname, None)
+            self._changed.add(fname)
+
+
+def get_catalog(cache_dir: str) -> TileCatalog:
+    """Get the catalog for cache_dir.  Catalogs are loaded once per
+    process and shared, and are reloaded if changed on disk.
+    """
+    key = os.path.abspath(cache_dir)
+    with _catalogs_lock:
+        catalog = _catalogs.get(key)
+        if catalog is None:
+            catalog = _catalogs[key] = TileCatalog(cache_dir)
+        else:
+            catalog.reload_if_changed()
+    return catalog
+
+def forget_catalog(cache_dir: str):
+    """Drop the in-memory catalog for cache_dir (eg, after the directory
+    has been deleted).
+    """
+    with _catalogs_lock:
+        _catalogs.pop(os.path.abspath(cache_dir), None)
@@ -1,25 +1,53 @@
 """Functions to manipulate TIF files and convert them into heightmaps."""
 
 
+import array
+import heapq
 import logging
 import math
 import time
 import tempfile
 import zipfile
-from typing import Optional, Set, Tuple, List
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Set, Tuple, List, Union
 
 import numpy as np
 from PIL import Image
 
-import rasterio
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio import windows
+from rasterio.warp import calculate_default_transform, reproject, transform_bounds, Resampling
 from rasterio.io import MemoryFile
+from rasterio.transform import Affine
 
 from otter.bother_utils.srtm import SRTM_NODATA
+from otter.bother_utils.raster import Grid, Raster, as_raster
+from otter.bother_utils.blocks import BLOCK_THREADS, PointwiseStage, run_pointwise, block_map
+from otter.bother_utils import scratch
+from otter.bother_utils.brightness import Histogram, get_histogram, linear_kernel, parse_curve, get_lut, lut_kernel
 
 
 WGS84 = 'EPSG:4326' # Mercator - The default CRS used in the STRM data
 
+# Each stage accepts an in-memory Raster (or, for backwards compatibility, a
+# MemoryFile containing a GeoTIFF) and returns a Raster.  By default its input
+# is left unchanged; stages taking inplace modify the input's data and return
+# a Raster sharing it when that is set.  Encoding to GeoTIFF only happens if a
+# raster is written out.
+RasterLike = Union[Raster, MemoryFile]
+
+# Default width and height of the tiles in which lakes are found when tiling
+LAKE_TILE_SIZE = 2048
+
+# Share of the pixels of a flat region that must have been raised by
+# fill_depressions for find_water to count the region as water
+MIN_FILL_FRACTION = 0.5
+
+# Approximate memory taken by fill_depressions_mst per pixel, in bytes, and
+# the most fill_depressions lets it take before using fill_depressions_queue
+MST_BYTES_PER_PIXEL = 150
+FILL_MEMORY_BUDGET = 2 ** 30
+
 #def handle_nodata(memfile: MemoryFile, set_to: int = 0, nodata: int = SRTM_NODATA) -> MemoryFile:
 #    
 #    with memfile.open() as src:
@@ -34,7 +62,109 @@ WGS84 = 'EPSG:4326' # Mercator - The default CRS used in the STRM data
 #
 #        return dst_memfile
     
-def remove_sea(memfile: MemoryFile, min_elev: int = 1) -> MemoryFile:
+def label_nodata(data: np.ndarray, nodata: int = SRTM_NODATA) -> Tuple[np.ndarray, np.ndarray]:
+    """Label each contiguous (8-connected) region of nodata pixels in
+    data.  Returns the labels (0 for pixels with data) and a boolean array
+    saying whether each label is ocean, ie, touches the edge of the
+    raster.  The other regions are voids enclosed by land.
+    """
+    # Imported here as scipy is only needed for some stages
+    from scipy import ndimage
+    
+    labels, n_labels = ndimage.label(data == nodata, structure=np.ones((3, 3), dtype=np.bool_))
+    is_ocean = np.zeros(n_labels + 1, dtype=np.bool_)
+    is_ocean[np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]])] = True
+    is_ocean[0] = False
+    return labels, is_ocean
+
+def classify_nodata(data: np.ndarray, nodata: int = SRTM_NODATA) -> Tuple[np.ndarray, np.ndarray]:
+    """Return boolean masks of the nodata pixels in data that are ocean
+    (connected to the edge of the raster) and of those in enclosed voids.
+    """
+    labels, is_ocean = label_nodata(data, nodata)
+    ocean = is_ocean[labels]
+    return ocean, (labels > 0) & ~ocean
+
+def _upsample(data: np.ndarray, height: int, width: int) -> np.ndarray:
+    """Bilinearly upsample data by a factor of 2, to height x width."""
+    for axis, size in ((0, height), (1, width)):
+        data = np.moveaxis(data, axis, 0)
+        before = np.concatenate([data[:1], data[:-1]])
+        after = np.concatenate([data[1:], data[-1:]])
+        upsampled = np.empty((2 * len(data),) + data.shape[1:], dtype=data.dtype)
+        upsampled[0::2] = 0.75 * data + 0.25 * before
+        upsampled[1::2] = 0.75 * data + 0.25 * after
+        data = np.moveaxis(upsampled[:size], 0, axis)
+    return data
+
+def push_pull(values: np.ndarray, known: np.ndarray) -> np.ndarray:
+    """Interpolate the pixels of values (a float array) that are not
+    known from those that are, with a push-pull pyramid: known values are
+    averaged into ever coarser grids until every pixel is covered, and
+    the coarse grids are then bilinearly upsampled back to fill the gaps
+    at each finer level.
+    """
+    if known.all() or not known.any():
+        return values
+    height, width = values.shape
+    even_height, even_width = height + height % 2, width + width % 2
+    total = np.zeros((even_height, even_width), dtype=values.dtype)
+    total[:height, :width][known] = values[known]
+    count = np.zeros((even_height, even_width), dtype=values.dtype)
+    count[:height, :width] = known
+    total = total.reshape(even_height // 2, 2, even_width // 2, 2).sum(axis=(1, 3))
+    count = count.reshape(even_height // 2, 2, even_width // 2, 2).sum(axis=(1, 3))
+    coarse_known = count > 0
+    coarse = push_pull(np.divide(total, count, out=np.zeros_like(total), where=coarse_known), coarse_known)
+    return np.where(known, values, _upsample(coarse, height, width))
+
+def fill_nodata_voids(raster: RasterLike, nodata: int = SRTM_NODATA, max_void_size: Optional[int] = None) -> Raster:
+    """Fill the voids in a raster (regions of nodata enclosed by land, as
+    opposed to ocean; see label_nodata) by interpolating from the land
+    around them (see push_pull), so that they are not rendered as sea.
+    Each void is interpolated within a window around it padded by its own
+    size.  Voids of more than max_void_size pixels are left as nodata.
+    """
+    
+    # Imported here as scipy is only needed for some stages
+    from scipy import ndimage
+    
+    raster = as_raster(raster)
+    labels, is_ocean = label_nodata(raster.data, nodata)
+    known = labels == 0
+    data = scratch.copy(raster.data)
+    n_voids = 0
+    n_pixels = 0
+    for label, (rows, cols) in enumerate(ndimage.find_objects(labels), 1):
+        if is_ocean[label]:
+            continue
+        pad = max(rows.stop - rows.start, cols.stop - cols.start, 2)
+        window = np.s_[max(rows.start - pad, 0):rows.stop + pad, max(cols.start - pad, 0):cols.stop + pad]
+        void = labels[window] == label
+        size = int(np.count_nonzero(void))
+        if (max_void_size is not None) and (size > max_void_size):
+            continue
+        filled = push_pull(data[window].astype(np.float32), known[window])
+        if np.issubdtype(data.dtype, np.integer):
+            filled = np.rint(filled)
+        data[window][void] = filled[void]
+        n_voids += 1
+        n_pixels += size
+    print(f'Filled {n_voids} voids ({n_pixels} pixels); {np.count_nonzero(is_ocean[labels])} nodata pixels are ocean.')
+    
+    return raster.replace(data)
+
+def remove_sea_stage(min_elev: int = 1) -> PointwiseStage:
+    """Pointwise stage for remove_sea."""
+    
+    def make_kernel(min_data, max_data):
+        offset = -(min_data - min_elev)
+        print(f'Increasing elevation by {offset}.')
+        return lambda data: (data + offset).astype(data.dtype, copy=False)
+    
+    return PointwiseStage(make_kernel, needs_stats=True)
+
+def remove_sea(raster: RasterLike, min_elev: int = 1, threads: int = BLOCK_THREADS, inplace: bool = False) -> Raster:
     """Offset elevation data so that lowest value is equal to min_elev.
     Useful for when real-world data includes land below sea level but no
     sea (eg, an in-land NL map).
@@ -43,22 +173,77 @@ def remove_sea(memfile: MemoryFile, min_elev: int = 1) -> MemoryFile:
     conjunction with raise_low_pixels to actually render as land.
     """
     
-    with memfile.open() as src:
-        
-        data = src.read(1)
-        offset = -(data.min() - min_elev)
-        
-        print(f'Increasing elevation by {offset}.')
-        data += offset
-        
-        dst_memfile = MemoryFile()
-        kwargs = src.profile.copy()
-        with dst_memfile.open(**kwargs) as dst:
-            dst.write(data, 1)
+    raster = as_raster(raster)
+    dst = raster.data if inplace else None
+    return raster.replace(run_pointwise(raster.data, [remove_sea_stage(min_elev)], dst, threads=threads))
+
+def as_dtype(raster: RasterLike, dtype, nodata: int = SRTM_NODATA, threads: int = BLOCK_THREADS) -> Raster:
+    """Convert raster to dtype, eg to hold a float32 GeoTIFF as int16
+    (like SRTM data) for half the memory.  Elevations are rounded to
+    whole numbers and clipped to the range of an integer dtype, and
+    nodata (or NaN) pixels are set to nodata.
+    """
+    
+    raster = as_raster(raster)
+    dtype = np.dtype(dtype)
+    if raster.dtype == dtype:
+        return raster
+    print(f'Converting raster from {raster.dtype} to {dtype}.')
+    
+    def kernel(data):
+        if np.issubdtype(dtype, np.integer) and not np.issubdtype(data.dtype, np.integer):
+            missing = np.isnan(data)
+            if raster.nodata is not None:
+                missing |= data == raster.nodata
+            info = np.iinfo(dtype)
+            data = np.clip(np.rint(data), info.min, info.max)
+            data[missing] = nodata
+        return data.astype(dtype)
+    
+    data = block_map(raster.data, kernel, scratch.empty(raster.shape, dtype), threads=threads)
+    return raster.replace(data, nodata=nodata)
+
+def get_resample_grid(grid: Grid, scale_factor: float) -> Grid:
+    """Grid output by resample for a raster with the given grid."""
+    height = int(grid.height * scale_factor)
+    width = int(grid.width * scale_factor)
+    # scale image transform so that the resampled raster covers the same bounds
+    transform = grid.transform * Affine.scale(grid.width / width, grid.height / height)
+    return Grid(transform, width, height, grid.crs)
+
+def get_reproject_grid(grid: Grid, dst_crs: str, src_crs: Optional[str] = None, width: Optional[int] = None,
+                       height: Optional[int] = None) -> Grid:
+    """Grid output by reproject_raster (or, given width and height, by
+    warp_to_grid) for a raster with the given grid.
+    """
+    transform, width, height = calculate_default_transform(src_crs or grid.crs, dst_crs, grid.width, grid.height,
+                                                           *grid.bounds, dst_width=width, dst_height=height)
+    return Grid(transform, width, height, dst_crs)
 
-        return dst_memfile
+def reproject_to_grid(raster: RasterLike, grid: Grid, resampling: Resampling = Resampling.bilinear,
+                      src_crs: Optional[str] = None) -> Raster:
+    """Reproject raster (with CRS src_crs, by default its own) onto grid.
+    grid may be a window of the grid that the whole raster would be
+    reprojected to, in which case only that window is computed and raster
+    need only cover the window of it that get_source_window returns.
+    """
+    
+    raster = as_raster(raster)
+    data = scratch.full(grid.shape, 0 if raster.nodata is None else raster.nodata, raster.dtype)
+    reproject(
+        source=raster.data,
+        destination=data,
+        src_transform=raster.transform,
+        src_crs=src_crs or raster.crs,
+        src_nodata=raster.nodata,
+        dst_transform=grid.transform,
+        dst_crs=grid.crs,
+        dst_nodata=raster.nodata,
+        resampling=resampling
+    )
+    return raster.replace(data, transform=grid.transform, crs=grid.crs)
 
-def resample(memfile: MemoryFile, scale_factor: float) -> MemoryFile:
+def resample(raster: RasterLike, scale_factor: float) -> Raster:
     """Resample raster by a factor of scale_factor.
         scale_factor > 1:  Upsample
         scale factor < 1:  Downsample
@@ -66,67 +251,74 @@ def resample(memfile: MemoryFile, scale_factor: float) -> MemoryFile:
 
     print(f'Resampling raster with scaling factor of {scale_factor}.')
 
-    with memfile.open() as src:
-        
-        print(f'Source raster has shape {src.shape}.')
-        
-        # resample data to target shape
-        height = int(src.height * scale_factor)
-        width = int(src.width * scale_factor)
-
-        data = src.read(
-            out_shape=(src.count, height, width),
-            resampling=Resampling.bilinear
-        )
-        # scale image transform
-        transform = src.transform * src.transform.scale(width, height)
-
-        kwargs = src.profile.copy()
-        kwargs.update({
-            'height': height,
-            'width': width
-        })
-        dst_memfile = MemoryFile()
-        with dst_memfile.open(**kwargs) as dst:
-            for i in range(1, src.count+1):
-                dst.write(data)
-        
-            print(f'Resampled raster has shape {dst.shape}.') 
-        
-        return dst_memfile
+    raster = as_raster(raster)
+    print(f'Source raster has shape {raster.shape}.')
+    raster = reproject_to_grid(raster, get_resample_grid(raster.grid, scale_factor))
+    print(f'Resampled raster has shape {raster.shape}.') 
+    return raster
 
-def reproject_raster(memfile: MemoryFile, dst_crs: str, src_crs: str = WGS84) -> MemoryFile:
+def reproject_raster(raster: RasterLike, dst_crs: str, src_crs: str = WGS84) -> Raster:
     """Reproject raster with CRS src_crs to new CRS dst_crs."""
     
     print(f'Reprojecting raster from {src_crs} to {dst_crs}.')
-    with memfile.open() as src:
-        print(f'Source raster has shape {src.shape}.')
-        transform, width, height = calculate_default_transform(src_crs, dst_crs, src.width, src.height, *src.bounds)
-        kwargs = src.profile.copy()
-        kwargs.update({
-            'crs': dst_crs,
-            'transform': transform,
-            'width': width,
-            'height': height
-        })
-        
-        dst_memfile = MemoryFile()
-
-        with dst_memfile.open(**kwargs) as dst:
-            for i in range(1, src.count+1):
-                reproject(
-                    source=rasterio.band(src, i),
-                    destination=rasterio.band(dst, i),
-                    src_transform=src.transform,
-                    src_crs=src_crs,
-                    dst_transform=transform,
-                    dst_crs=dst_crs,
-                    resampling=Resampling.bilinear
-                )
-        
-            print(f'Reprojected raster has shape {dst.shape}.')
-        
-        return dst_memfile
+    raster = as_raster(raster)
+    print(f'Source raster has shape {raster.shape}.')
+    raster = reproject_to_grid(raster, get_reproject_grid(raster.grid, dst_crs, src_crs), src_crs=src_crs)
+    print(f'Reprojected raster has shape {raster.shape}.')
+    return raster
+
+def get_resampling(resampling: Union[str, Resampling, None], src_shape: Tuple[int, int],
+                   dst_shape: Tuple[int, int]) -> Resampling:
+    """Return the Resampling method named by resampling (eg, 'average').
+    If resampling is None, use average when the destination has fewer
+    pixels than the source and bilinear otherwise.
+    """
+    if resampling is None:
+        if dst_shape[0] * dst_shape[1] < src_shape[0] * src_shape[1]:
+            return Resampling.average
+        return Resampling.bilinear
+    if isinstance(resampling, str):
+        try:
+            return Resampling[resampling.lower()]
+        except KeyError:
+            raise ValueError(f'Unknown resampling method {resampling}.')
+    return Resampling(resampling)
+
+def warp_to_grid(raster: RasterLike, width: int, height: int, dst_crs: Optional[str] = None,
+                 src_crs: Optional[str] = None, resampling: Union[str, Resampling, None] = None) -> Raster:
+    """Reproject raster to dst_crs (by default, its own CRS) and resample
+    it to exactly width x height pixels in a single pass, in place of
+    resample, reproject_raster and scale_image_f.  See get_resampling for
+    the choice of resampling method.
+    """
+    
+    raster = as_raster(raster)
+    src_crs = src_crs or raster.crs
+    dst_crs = dst_crs or src_crs
+    resampling = get_resampling(resampling, raster.shape, (height, width))
+    print(f'Warping raster from {src_crs} to {dst_crs} with size {width}x{height} using {resampling.name} resampling.')
+    print(f'Source raster has shape {raster.shape}.')
+    grid = get_reproject_grid(raster.grid, dst_crs, src_crs, width, height)
+    raster = reproject_to_grid(raster, grid, resampling, src_crs)
+    print(f'Warped raster has shape {raster.shape}.')
+    return raster
+
+def get_source_window(grid: Grid, src_grid: Grid, src_crs: Optional[str] = None, margin: int = 4) -> windows.Window:
+    """Return the window of src_grid (with CRS src_crs, by default its
+    own) holding the pixels needed to reproject onto grid.  The window is
+    padded by margin pixels, scaled up when grid is coarser than
+    src_grid, so that it covers the whole footprint of any of the
+    resampling kernels.
+    """
+    left, bottom, right, top = transform_bounds(grid.crs, src_crs or src_grid.crs, *grid.bounds, densify_pts=21)
+    window = windows.from_bounds(left, bottom, right, top, src_grid.transform)
+    ratio = max(window.width / grid.width, window.height / grid.height, 1)
+    pad = margin * math.ceil(ratio) + margin
+    col_start = max(math.floor(window.col_off) - pad, 0)
+    row_start = max(math.floor(window.row_off) - pad, 0)
+    col_stop = min(math.ceil(window.col_off + window.width) + pad, src_grid.width)
+    row_stop = min(math.ceil(window.row_off + window.height) + pad, src_grid.height)
+    return windows.Window(col_start, row_start, max(col_stop - col_start, 0), max(row_stop - row_start, 0))
 
 def get_lake(data: np.ndarray, row: int, col: int, checked: np.ndarray, min_size: int) -> Optional[Set[Tuple[int, int]]]:
     """Check if the pixel at data[row, col] belongs to a lake and, if so,
@@ -136,6 +328,9 @@ def get_lake(data: np.ndarray, row: int, col: int, checked: np.ndarray, min_size
     that have exactly identical elevation.  This is similar to the
     algorithm (apparently) used by the MicroDEM software: see
     https://freegeographytools.com/2007/modifying-the-terrain-reflectance-display-in-microdem
+
+    This is the original pure Python implementation, which is very slow
+    on large rasters; it is kept as a reference for get_lake_mask.
     """
     elev = data[row, col]
     candidates = {(row,col)}
@@ -151,23 +346,27 @@ def get_lake(data: np.ndarray, row: int, col: int, checked: np.ndarray, min_size
             continue
         if candidate_elev == elev:
             lake.add((_row, _col))
-            if row > 0:
+            if _row > 0:
                 candidates.add((_row-1,_col))
             candidates.add((_row+1,_col))
-            if col > 0:
+            if _col > 0:
                 candidates.add((_row,_col-1))
             candidates.add((_row,_col+1))
-        checked[_row, _col] = 1
+            # Only pixels in the lake are marked as checked, so that a
+            # neighbouring region of a different elevation can still be
+            # found in full later.
+            checked[_row, _col] = 1
     if len(lake) >= min_size:
         #print(f'Found lake of size {len(lake)}.')
         return lake
 
 def get_all_lakes(data: np.ndarray, min_size: int, nodata: int = SRTM_NODATA) -> List[Set[Tuple[int, int]]]:
     """Find all lakes in the data.  A lake is defined as a contiguous
-    region of at least min_size pixels of the exact same elevation."""
+    region of at least min_size pixels of the exact same elevation.
+    Reference implementation of get_lake_mask, which should be used instead."""
 
     height, width = data.shape
-    checked = np.zeros((height+2, width+2))
+    checked = np.zeros((height+2, width+2), dtype=np.bool_)
     lakes = []
     for c in range(width):
         if (data[:,c] == nodata).all():
@@ -182,119 +381,486 @@ def get_all_lakes(data: np.ndarray, min_size: int, nodata: int = SRTM_NODATA) ->
             checked[r, c] = 1
     return lakes
 
-def set_lakes_to_elev(memfile: MemoryFile, min_lake_size: int, fill_lakes_as: int = None,
-                      nodata: int = SRTM_NODATA) -> MemoryFile:
+def label_flat_regions(data: np.ndarray, nodata: int = SRTM_NODATA) -> Tuple[np.ndarray, np.ndarray]:
+    """Label each contiguous (4-connected) region of pixels with exactly
+    the same elevation.  Returns an array of the same shape as data giving
+    each pixel's label, and an array giving the number of pixels with each
+    label (which is 0 for the labels of nodata pixels).
+
+    Adjacent pixels of equal elevation are joined by an edge in a sparse
+    graph, whose connected components are the regions.
+    """
+    # Imported here as scipy is only needed for lake detection
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    
+    height, width = data.shape
+    valid = data != nodata
+    index = np.arange(height * width, dtype=np.int32 if height * width < 2 ** 31 else np.int64).reshape(height, width)
+    right = (data[:, :-1] == data[:, 1:]) & valid[:, :-1]
+    down = (data[:-1] == data[1:]) & valid[:-1]
+    heads = np.concatenate([index[:, :-1][right], index[:-1][down]])
+    tails = np.concatenate([index[:, 1:][right], index[1:][down]])
+    del right, down
+
+    graph = coo_matrix((np.ones(len(heads), dtype=np.bool_), (heads, tails)), shape=(height * width, height * width))
+    n_labels, labels = connected_components(graph, directed=False)
+    del graph, heads, tails
+
+    sizes = np.bincount(labels[valid.ravel()], minlength=n_labels)
+    return labels.reshape(height, width), sizes
+
+def _label_lake_tile(tile: np.ndarray, min_size: int, nodata: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Label the flat regions in one tile of a raster, keeping only those
+    that are already lakes or that touch the edge of the tile (and so may
+    become lakes when joined with regions in neighbouring tiles).  Other
+    pixels are labelled 0.  Returns the labels (numbered from 1) and the
+    number of pixels in the tile with each label.
+    """
+    labels, sizes = label_flat_regions(tile, nodata)
+    keep = sizes >= max(min_size, 1)
+    for edge in (labels[0], labels[-1], labels[:, 0], labels[:, -1]):
+        keep[edge] = True
+    keep &= sizes > 0
+    compact = np.cumsum(keep, dtype=np.int32) * keep
+    return compact[labels], sizes[keep]
+
+def _find_roots(pairs: np.ndarray, n: int) -> np.ndarray:
+    """Union-find over n labels, joining each pair of labels in pairs.
+    Returns an array mapping each label to the root label of its set.
+    """
+    parent = {}
+
+    def find(x):
+        root = x
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while x != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for a, b in pairs.tolist():
+        a, b = find(a), find(b)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    roots = np.arange(n)
+    if parent:
+        nodes = np.fromiter(parent.keys(), dtype=np.int64, count=len(parent))
+        roots[nodes] = [find(x) for x in nodes.tolist()]
+    return roots
+
+def find_lakes_tiled(data: np.ndarray, min_size: int, nodata: int = SRTM_NODATA, tile_size: int = LAKE_TILE_SIZE,
+                     workers: int = 1) -> Tuple[np.ndarray, int]:
+    """Find lakes tile by tile, labelling tiles in up to workers processes.
+    Regions that meet across a tile seam are merged with a union-find pass
+    before min_size is applied, so the result is the same as for
+    find_lakes on the whole raster.
+    """
+    height, width = data.shape
+    windows = [(r, c) for r in range(0, height, tile_size) for c in range(0, width, tile_size)]
+    tiles = (data[r:r+tile_size, c:c+tile_size] for r, c in windows)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_label_lake_tile, tiles, repeat(min_size), repeat(nodata)))
+    else:
+        results = [_label_lake_tile(tile, min_size, nodata) for tile in tiles]
+
+    # Number labels across the whole raster, with 0 for pixels that cannot be in a lake
+    n_labels = 1 + sum(len(sizes) for _, sizes in results)
+    labels = np.zeros(data.shape, dtype=np.int32 if n_labels < 2 ** 31 else np.int64)
+    sizes = np.zeros(n_labels, dtype=np.int64)
+    offset = 0
+    for (r, c), (tile_labels, tile_sizes) in zip(windows, results):
+        labels[r:r+tile_size, c:c+tile_size] = np.where(tile_labels > 0, tile_labels.astype(labels.dtype) + offset, 0)
+        sizes[offset+1:offset+1+len(tile_sizes)] = tile_sizes
+        offset += len(tile_sizes)
+    del results
+
+    # Join regions of equal elevation either side of each seam
+    pairs = []
+    for r in range(tile_size, height, tile_size):
+        joined = (data[r-1] == data[r]) & (labels[r-1] > 0) & (labels[r] > 0)
+        pairs.append(np.stack([labels[r-1][joined], labels[r][joined]], axis=1))
+    for c in range(tile_size, width, tile_size):
+        joined = (data[:, c-1] == data[:, c]) & (labels[:, c-1] > 0) & (labels[:, c] > 0)
+        pairs.append(np.stack([labels[:, c-1][joined], labels[:, c][joined]], axis=1))
+    pairs = np.unique(np.concatenate(pairs), axis=0) if pairs else np.zeros((0, 2), dtype=np.int64)
+    roots = _find_roots(pairs, n_labels)
+
+    lake_sizes = np.bincount(roots, weights=sizes, minlength=n_labels)
+    is_lake = lake_sizes >= max(min_size, 1)
+    is_lake[0] = False
+    return is_lake[roots][labels], int(np.count_nonzero(is_lake))
+
+def find_lakes(data: np.ndarray, min_size: int, nodata: int = SRTM_NODATA, tile_size: Optional[int] = None,
+               workers: int = 1) -> Tuple[np.ndarray, int]:
+    """Return a boolean mask of the pixels in data that belong to a lake,
+    and the number of lakes found.  If tile_size is given or workers is
+    more than 1, the raster is processed in tiles (see find_lakes_tiled).
+    """
+    if (tile_size is not None) or (workers > 1):
+        return find_lakes_tiled(data, min_size, nodata, tile_size or LAKE_TILE_SIZE, workers)
+    labels, sizes = label_flat_regions(data, nodata)
+    is_lake = sizes >= max(min_size, 1)
+    return is_lake[labels], int(np.count_nonzero(is_lake))
+
+def get_lake_mask(data: np.ndarray, min_size: int, nodata: int = SRTM_NODATA, tile_size: Optional[int] = None,
+                  workers: int = 1) -> np.ndarray:
+    """Return a boolean mask of the pixels in data that belong to a lake,
+    ie, a contiguous region of at least min_size pixels of the exact same
+    elevation.  Gives the same lakes as get_all_lakes, much faster.
+    """
+    return find_lakes(data, min_size, nodata, tile_size, workers)[0]
+
+def set_lakes_to_elev(raster: RasterLike, min_lake_size: int, fill_lakes_as: int = None,
+                      nodata: int = SRTM_NODATA, tile_size: Optional[int] = None, workers: int = 1,
+                      inplace: bool = False) -> Raster:
     """Find all lakes in the data for a raster and set the elevation of
-    the relevant pixels to fill_lakes_as.
+    the relevant pixels to fill_lakes_as.  For large rasters, use
+    tile_size and/or workers to find lakes tile by tile in several
+    processes.  If inplace is set, raster's data is modified rather than
+    copied.
     """
     
     if fill_lakes_as is None:
         fill_lakes_as = nodata
     
     print(f'Finding lakes with minimum size of {min_lake_size} and setting elevation to {fill_lakes_as}.')
-    with memfile.open() as src:
-        data = src.read(1)
-        lakes = get_all_lakes(data, min_lake_size)
-        print(f'Found {len(lakes)} lakes.')
-        for lake in lakes:
-            for row, col in lake:
-                data[row, col] = fill_lakes_as
-        
-        dst_memfile = MemoryFile()
-        kwargs = src.profile.copy()
-        with dst_memfile.open(**kwargs) as dst:
-            dst.write(data, 1)
+    raster = as_raster(raster)
+    data = raster.data if inplace else scratch.copy(raster.data)
+    mask, n_lakes = find_lakes(data, min_lake_size, nodata, tile_size, workers)
+    print(f'Found {n_lakes} lakes.')
+    data[mask] = fill_lakes_as
+    
+    return raster.replace(data)
+
+def fill_depressions(data: np.ndarray, nodata: int = SRTM_NODATA,
+                     memory_budget: Optional[int] = FILL_MEMORY_BUDGET) -> np.ndarray:
+    """Return a copy of data with every depression filled up to the level
+    at which it would spill over, ie, with each pixel raised to the lowest
+    elevation from which water could flow from it to the edge of the
+    raster or to a nodata pixel.
 
-        return dst_memfile
+    Rasters that fill_depressions_mst would need no more than memory_budget
+    bytes for (or any raster if it is None) are filled with it, and larger
+    ones with the slower but more compact fill_depressions_queue.  Both
+    give the same result.
+    """
+    height, width = data.shape
+    if memory_budget is None or (height + 2) * (width + 2) * MST_BYTES_PER_PIXEL <= memory_budget:
+        return fill_depressions_mst(data, nodata)
+    return fill_depressions_queue(data, nodata)
 
-def raise_undersea_land(memfile: MemoryFile, raise_to: int = 1, nodata: int = SRTM_NODATA):
+def fill_depressions_mst(data: np.ndarray, nodata: int = SRTM_NODATA) -> np.ndarray:
+    """fill_depressions using a minimum spanning tree.
+
+    The level to which a pixel is filled is the lowest, over all
+    8-connected paths from the pixel to the edge or to nodata, of the
+    highest elevation on the path.  Such paths all lie on a minimum
+    spanning tree of the graph joining neighbouring pixels by an edge
+    weighted with the higher of their elevations, so the tree is built
+    (with scipy) and the highest elevation on each pixel's path to the
+    edge found by pointer jumping, in O(log N) passes over the array.
+    Takes O(N log N) time, but about MST_BYTES_PER_PIXEL bytes of memory
+    per pixel.
+    """
+    # Imported here as scipy is only needed for lake detection
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import minimum_spanning_tree, breadth_first_order
+    
+    # Pad with nodata, so that the edge of the raster is treated as nodata
+    padded = np.pad(data, 1, constant_values=nodata)
+    closed = padded == nodata
+    # Work with the rank of each elevation, from 2 up (scipy ignores edges
+    # weighted 0, and nodata pixels are given 1)
+    values, ranks = np.unique(padded[~closed], return_inverse=True)
+    level = np.ones(padded.size + 1, dtype=np.int32)
+    level[:-1][~closed.ravel()] = ranks + 2
+    del ranks
+    
+    # Join each pixel to its neighbours to the east, south-east, south and
+    # south-west, and each nodata pixel to an extra "outside" node (numbered
+    # padded.size) from which the tree is walked
+    outside = padded.size
+    index = np.arange(outside, dtype=np.int32 if outside < 2 ** 31 - 1 else np.int64).reshape(padded.shape)
+    grid_level = level[:-1].reshape(padded.shape)
+    heads, tails, weights = [np.flatnonzero(closed).astype(index.dtype)], [], []
+    tails.append(np.full(len(heads[0]), outside, dtype=index.dtype))
+    weights.append(np.ones(len(heads[0]), dtype=np.int32))
+    for head, tail in ((np.s_[:, :-1], np.s_[:, 1:]), (np.s_[:-1, :-1], np.s_[1:, 1:]),
+                       (np.s_[:-1, :], np.s_[1:, :]), (np.s_[:-1, 1:], np.s_[1:, :-1])):
+        # Nodata pixels are already joined through the outside node
+        keep = ~(closed[head] & closed[tail])
+        heads.append(index[head][keep])
+        tails.append(index[tail][keep])
+        weights.append(np.maximum(grid_level[head][keep], grid_level[tail][keep]))
+    del index, grid_level, keep, closed
+    graph = coo_matrix((np.concatenate(weights), (np.concatenate(heads), np.concatenate(tails))),
+                       shape=(outside + 1, outside + 1)).tocsr()
+    del heads, tails, weights
+    tree = minimum_spanning_tree(graph)
+    del graph
+    _, parent = breadth_first_order(tree, outside, directed=False)
+    del tree
+    
+    # Each pixel's level becomes the highest level on its path to the
+    # outside node, doubling the length of path covered on each pass
+    parent[outside] = outside
+    while (parent != outside).any():
+        np.maximum(level, level[parent], out=level)
+        parent = parent[parent]
+    
+    filled = level[:-1].reshape(padded.shape)[1:-1, 1:-1] - 2
+    return np.where(data == nodata, data, values[np.maximum(filled, 0)] if len(values) else data).astype(data.dtype)
+
+
+def fill_depressions_queue(data: np.ndarray, nodata: int = SRTM_NODATA) -> np.ndarray:
+    """fill_depressions using the Priority-Flood algorithm (Barnes, Lehman
+    & Mulla, 2014).
+
+    Pixels are taken from a priority queue in order of elevation, starting
+    from those next to the edge or to nodata.  A neighbour no higher than
+    the pixel it is reached from is in a depression, so it is raised to
+    that pixel's level and put on a plain "pit" stack instead, which saves
+    a heap operation for each pixel within a depression.  Takes O(N log N)
+    time, and besides the queues, which only hold the pixels at the edge
+    of the flood and within the depression being filled, about 8 bytes of
+    memory per pixel for 8 and 16-bit integer rasters (40 for others, whose
+    elevations are ranked with np.unique).
+    """
+    height, width = data.shape
+    padded_width = width + 2
+    # Pad with nodata, so that no pixel needs its neighbours bounds checked
+    padded = np.pad(data, 1, constant_values=nodata)
+    closed = padded == nodata
+    # Work with integer levels, which for integer rasters are the
+    # elevations above the lowest, and otherwise the rank of each elevation
+    values = None
+    if np.issubdtype(data.dtype, np.integer) and data.dtype.itemsize <= 2:
+        lowest = int(padded[~closed].min()) if not closed.all() else 0
+        levels = padded.astype(np.int32)
+        levels -= lowest
+    else:
+        values, ranks = np.unique(padded[~closed], return_inverse=True)
+        levels = np.zeros(padded.shape, dtype=np.int32)
+        levels[~closed] = ranks
+        del ranks
+    del padded
+
+    # Seed the queue with the pixels next to the edge or to nodata
+    seeds = np.zeros(closed.shape, dtype=np.bool_)
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            seeds[1:-1, 1:-1] |= closed[1+dr:height+1+dr, 1+dc:width+1+dc]
+    seeds &= ~closed
+    seeds = np.flatnonzero(seeds)
+    closed.ravel()[seeds] = True
+
+    # Pixels are read and written through memoryviews, which are much
+    # faster to index from Python than the arrays themselves
+    n = levels.size
+    elev = memoryview(levels.ravel())
+    done = memoryview(closed.view(np.uint8).ravel())
+    offsets = (-padded_width - 1, -padded_width, -padded_width + 1, -1, 1,
+               padded_width - 1, padded_width, padded_width + 1)
+    queue = (levels.ravel()[seeds].astype(np.int64) * n + seeds).tolist()
+    del seeds
+    heapq.heapify(queue)
+    pit = array.array('q')
+    while queue or pit:
+        if pit:
+            pixel = pit.pop()
+            level = elev[pixel]
+        else:
+            level, pixel = divmod(heapq.heappop(queue), n)
+        for offset in offsets:
+            neighbour = pixel + offset
+            if done[neighbour]:
+                continue
+            done[neighbour] = 1
+            if elev[neighbour] <= level:
+                elev[neighbour] = level
+                pit.append(neighbour)
+            else:
+                heapq.heappush(queue, elev[neighbour] * n + neighbour)
+    del elev, done, closed
+
+    filled = levels[1:-1, 1:-1]
+    if values is None:
+        # Nodata pixels are never raised, so come back as nodata
+        filled += lowest
+        return filled.astype(data.dtype)
+    if not len(values):
+        return data.copy()
+    return np.where(data == nodata, data, values[filled]).astype(data.dtype)
+
+def find_water(data: np.ndarray, min_size: int, nodata: int = SRTM_NODATA,
+               min_fill_fraction: float = MIN_FILL_FRACTION) -> Tuple[np.ndarray, int]:
+    """Return a boolean mask of the pixels in data that are water, and the
+    number of bodies of water found.  Depressions are filled (see
+    fill_depressions), and water is any flat region of the filled
+    elevations with at least min_size pixels, of which at least
+    min_fill_fraction were raised by filling.
+
+    Unlike find_lakes, this finds lakes whose surface is noisy (which fill
+    to a flat one) and ignores flat land that is not a basin.
+    """
+    filled = fill_depressions(data, nodata)
+    labels, sizes = label_flat_regions(filled, nodata)
+    raised = np.bincount(labels.ravel(), weights=(filled > data).ravel(), minlength=len(sizes))
+    is_water = (sizes >= max(min_size, 1)) & (raised >= min_fill_fraction * sizes)
+    return is_water[labels], int(np.count_nonzero(is_water))
+
+def set_water_to_elev(raster: RasterLike, min_size: int, fill_water_as: int = None, nodata: int = SRTM_NODATA,
+                      min_fill_fraction: float = MIN_FILL_FRACTION, inplace: bool = False) -> Raster:
+    """Find all water in the data for a raster (see find_water) and set
+    the elevation of the relevant pixels to fill_water_as.  An
+    alternative to set_lakes_to_elev.  If inplace is set, raster's data
+    is modified rather than copied.
+    """
+    
+    if fill_water_as is None:
+        fill_water_as = nodata
+    
+    print(f'Filling depressions to find water with minimum size of {min_size} and setting elevation to {fill_water_as}.')
+    raster = as_raster(raster)
+    data = raster.data if inplace else scratch.copy(raster.data)
+    mask, n_water = find_water(data, min_size, nodata, min_fill_fraction)
+    print(f'Found {n_water} bodies of water.')
+    data[mask] = fill_water_as
+    
+    return raster.replace(data)
+
+def raise_undersea_stage(raise_to: int = 1, nodata: int = SRTM_NODATA) -> PointwiseStage:
+    """Pointwise stage for raise_undersea_land."""
+    
+    def make_kernel():
+        print(f'Raising pixels of elevation <= 0 to {raise_to} (ignoring NODATA).')
+        return lambda data: np.where((data != nodata) & (data <= 0), raise_to, data).astype(data.dtype, copy=False)
+    
+    return PointwiseStage(make_kernel)
+
+def raise_undersea_land(raster: RasterLike, raise_to: int = 1, nodata: int = SRTM_NODATA,
+                        threads: int = BLOCK_THREADS, inplace: bool = False) -> Raster:
     """Raise land with zero or negative elevation (ie, land that is at or
     below sea level) to raise_to. Probably shouldn't be called before
     set_lakes_to_elev, otherwise the newly raised land will be picked up
     as a lake by that function.
     """
     
-    with memfile.open() as src:
-        data = src.read(1)
-        
-        print(f'Raising pixels of elevation <= 0 to {raise_to} (ignoring NODATA).')
-        data = np.where((data != nodata) & (data <= 0), raise_to, data)
+    raster = as_raster(raster)
+    dst = raster.data if inplace else None
+    return raster.replace(run_pointwise(raster.data, [raise_undersea_stage(raise_to, nodata)], dst, threads=threads))
+
+def raise_low_stage(max_no_raise: float = 0.0, max_brightness: int = 255, noisy: bool = False) -> PointwiseStage:
+    """Pointwise stage for raise_low_pixels."""
     
-        dst_memfile = MemoryFile()
-        kwargs = src.profile.copy()
-        with dst_memfile.open(**kwargs) as dst:
-            dst.write(data, 1)
+    def make_kernel(min_data, max_data):
+        # Maximum once all values are floored at 0
+        max_elev = max(max_data, 0)
+        min_visible = math.ceil(max_elev / max_brightness) # Minimum value that will be rounded to 1 in a greyscale image
+        print(f'Raising pixels of {max_no_raise} < elevation < {min_visible} to {min_visible}.')
         
-        return dst_memfile
+        def kernel(data):
+            # Floor all values at 0 (in a new array, which is then modified in place)
+            data = np.maximum(data, 0)
+            raise_to = min_visible
+            if noisy:
+                # Add a small value to each affected pixel's elevation, which is proportionate to that pixel's original
+                # elevation.  This ensures that fixed areas do not have a uniform elevation (unless they originally had
+                # a uniform elevation), so that they are not picked up by Microdem as lakes.  Integer division keeps
+                # integer data in its own dtype and gives the same result once truncated to it.
+                raise_to = (data // 10 if np.issubdtype(data.dtype, np.integer) else data / 10) + min_visible
+            low = (data > max_no_raise) & (data < raise_to)
+            data[low] = raise_to[low] if noisy else raise_to
+            return data
+        
+        return kernel
+    
+    return PointwiseStage(make_kernel, needs_stats=True)
 
-def raise_low_pixels(memfile: MemoryFile, max_no_raise: float = 0.0, max_brightness: int = 255,
-                     noisy: bool = False) -> MemoryFile:
+def raise_low_pixels(raster: RasterLike, max_no_raise: float = 0.0, max_brightness: int = 255,
+                     noisy: bool = False, threads: int = BLOCK_THREADS, stats: Optional[List] = None,
+                     inplace: bool = False) -> Raster:
     """Detect very low (but above sea level) elevations in a raster and
     increase the elevation of the relevant pixels such that, when the
     file is converted to a greyscale image, those pixels will be given
-    a value of 1, rather than rounded down to 0.
+    a value of 1, rather than rounded down to 0.  If raster is a crop of
+    a larger region, pass that region's statistics for raise_low_stage
+    (see blocks.get_stats) as stats.
     """
     
-    with memfile.open() as src:
-        data = src.read(1)
-        # Floor all values at 0
-        data *= (data > 0)
-        max_elev = data.max()
-        min_visible = math.ceil(max_elev / max_brightness) # Minimum value that will be rounded to 1 in a greyscale image
-        print(f'Raising pixels of {max_no_raise} < elevation < {min_visible} to {min_visible}.')
-        if noisy:
-            # Add a small value to each affected pixel's elevation, which is proportionate to that pixel's original
-            # elevation.  This ensures that fixed areas do not have a uniform elevation (unless they originally had
-            # a uniform elevation), so that they are not picked up by Microdem as lakes.
-            min_visible = (data / 10) + min_visible
-        data = np.where((data > max_no_raise) & (data < min_visible), min_visible, data)
-    
-        dst_memfile = MemoryFile()
-        kwargs = src.profile.copy()
-        with dst_memfile.open(**kwargs) as dst:
-            dst.write(data, 1)
-        
-        return dst_memfile
+    raster = as_raster(raster)
+    stage = raise_low_stage(max_no_raise, max_brightness, noisy)
+    dst = raster.data if inplace else None
+    return raster.replace(run_pointwise(raster.data, [stage], dst, threads=threads, stats=stats))
+
+def to_png_stages(zero_floor: bool = False, max_brightness: int = 255,
+                  nodata: int = SRTM_NODATA) -> List[PointwiseStage]:
+    """Pointwise stages converting elevations to greyscale values for to_png."""
+    
+    def make_floor_kernel():
+        def kernel(data):
+            data = np.where(data == nodata, 0, data).astype(data.dtype, copy=False)
+            if zero_floor:
+                np.maximum(data, 0, out=data)
+            return data
+        return kernel
+    
+    def make_scale_kernel(min_elev, max_elev):
+        return linear_kernel(min_elev, max_elev, max_brightness)
+    
+    return [PointwiseStage(make_floor_kernel), PointwiseStage(make_scale_kernel, needs_stats=True)]
 
-def to_png(memfile: MemoryFile, zero_floor: bool = False, max_brightness: int = 255, nodata: int = SRTM_NODATA):
+def to_png(raster: RasterLike, zero_floor: bool = False, max_brightness: int = 255, nodata: int = SRTM_NODATA,
+           threads: int = BLOCK_THREADS, curve: str = 'linear', histogram: Optional[Histogram] = None):
     """Save raster as a greyscale PNG file to to_file.  If set_negative
     is set, any elevation values below zero are set to that value (which
     should be in the range 0-255).
+    
+    Elevations are mapped to brightness with curve (see
+    bother_utils.brightness), through a lookup table built from their
+    histogram.  If raster is a crop of a larger region, pass the
+    histogram of that region's elevations (after the first of
+    to_png_stages) as histogram, so that brightness is mapped across the
+    whole region.
     """
     
     print(f'Converting raster to PNG image.')
-    with memfile.open() as src:
-        data = src.read(1)
-        data[data == nodata] = 0
-        if zero_floor:
-            data[data < 0] = 0
-        max_elev = data.max()
-        min_elev = data.min()
-        scale_factor = max_brightness / (max_elev - min_elev)
-        if min_elev > 0:
-            # If everywhere on the map is above sea level, we should scale
-            # such that the lowest parts of the map appear slightly above sea level.
-            floor = min_elev + 1
+    data = as_raster(raster).data
+    name, params = parse_curve(curve)
+    if not np.issubdtype(data.dtype, np.integer):
+        if (name != 'linear') or (histogram is not None):
+            # Elevations need to be whole numbers for the lookup table
+            data = np.rint(data).astype(np.int32)
         else:
-            floor = min_elev
-        data = ((data - floor) * scale_factor).astype(np.uint8)
-        im = Image.fromarray(data, mode='L')
-        width, height = im.size
-        print(f'Image size is {width}x{height}.')
-        return im
+            stages = to_png_stages(zero_floor, max_brightness, nodata)
+            return _to_image(run_pointwise(data, stages, dtype=np.uint8, threads=threads))
+    floor_kernel = to_png_stages(zero_floor, max_brightness, nodata)[0].make_kernel()
+    if histogram is None:
+        histogram = get_histogram(data, floor_kernel, threads)
+    lut = get_lut(histogram, max_brightness, name, dtype=data.dtype, **params)
+    kernel = lut_kernel(lut, histogram.offset)
+    return _to_image(block_map(data, lambda block: kernel(floor_kernel(block)), scratch.empty(data.shape, np.uint8),
+                               threads=threads))
+
+def _to_image(data: np.ndarray) -> Image:
+    im = Image.fromarray(data, mode='L')
+    width, height = im.size
+    print(f'Image size is {width}x{height}.')
+    return im
 
 crop_modes = {'nw', 'n', 'ne', 'w', 'c', 'e', 'sw', 's', 'se'}
-def crop_image(im: Image, width: int, height: int, mode: str) -> Image:
-    """Crop an image to width x height. Where in the image to crop to is
-    determined by mode.
+def get_crop_box(im_width: int, im_height: int, width: int, height: int, mode: str) -> List[int]:
+    """Return the box (left, top, right, bottom) to which crop_image
+    crops an image of im_width x im_height.
     """
     
     mode = mode.lower()
     
-    width = min(width, im.width)
-    height = min(height, im.height)
-    
-    print(f'Cropping image to {width}x{height} using mode {mode}.')
+    width = min(width, im_width)
+    height = min(height, im_height)
     
     #       left top right bottom
     box =  [0, 0, 0, 0]
@@ -302,19 +868,30 @@ def crop_image(im: Image, width: int, height: int, mode: str) -> Image:
     if mode.startswith('n'):
         box[1] = 0
     elif mode.startswith('s'):
-        box[1] = im.height - height
+        box[1] = im_height - height
     else:
-        box[1] = (im.height - height) // 2
+        box[1] = (im_height - height) // 2
     box[3] = box[1] + height
     
     if mode.endswith('w'):
         box[0] = 0
     elif mode.endswith('e'):
-        box[0] = im.width - width
+        box[0] = im_width - width
     else:
-        box[0] = (im.width - width) // 2
+        box[0] = (im_width - width) // 2
     box[2] = box[0] + width
     
+    return box
+
+def crop_image(im: Image, width: int, height: int, mode: str) -> Image:
+    """Crop an image to width x height. Where in the image to crop to is
+    determined by mode.
+    """
+    
+    box = get_crop_box(im.width, im.height, width, height, mode)
+    width = box[2] - box[0]
+    height = box[3] - box[1]
+    print(f'Cropping image to {width}x{height} using mode {mode.lower()}.')
 
     # Image.crop chokes on large images unless we increase the max size
     size = width * height
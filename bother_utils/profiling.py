@@ -0,0 +1,198 @@
+"""Instrumentation for the stages of the bother pipeline.
+
+Code wraps each stage in profile_stage, which does nothing (beyond one
+global lookup) unless a Profiler is active.  While a Profiler is active,
+it records the wall time, CPU time, memory use and the shape and dtype
+of the input and output of every stage, which can be returned as a
+report or written as JSON or as a Chrome trace (which can be opened in
+chrome://tracing or https://ui.perfetto.dev).
+"""
+
+import os
+import json
+import time
+import threading
+import tracemalloc
+from typing import Optional
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+_active = None
+
+
+def describe(obj) -> Optional[dict]:
+    """Describe the shape and type of a raster, array or image."""
+    data = obj if isinstance(obj, np.ndarray) else getattr(obj, 'data', obj)
+    if isinstance(data, np.ndarray):
+        return {'shape': list(data.shape), 'dtype': str(data.dtype), 'nbytes': int(data.nbytes)}
+    if hasattr(obj, 'size') and hasattr(obj, 'mode'):
+        return {'shape': [obj.size[1], obj.size[0]], 'mode': obj.mode}
+    return None
+
+def get_rss() -> Optional[int]:
+    """Current resident set size of this process in bytes, if known."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def get_max_rss() -> Optional[int]:
+    """Peak resident set size of this process so far in bytes, if known."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _NullStage:
+    """Stands in for a stage record when no Profiler is active."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def set_output(self, obj):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+
+    def __init__(self, profiler: 'Profiler', name: str, src=None):
+        self.profiler = profiler
+        self.record = {'name': name, 'input': describe(src) if src is not None else None, 'output': None}
+
+    def set_output(self, obj):
+        self.record['output'] = describe(obj)
+
+    def __enter__(self):
+        if self.profiler.trace_memory:
+            self.traced_start, peak = tracemalloc.get_traced_memory()
+            self.peak_seen = self.traced_start
+            # tracemalloc has a single peak, so keep track of the peak so far
+            # of any enclosing stages before resetting it
+            with self.profiler._lock:
+                for stage in self.profiler._open:
+                    stage.peak_seen = max(stage.peak_seen, peak)
+                self.profiler._open.append(self)
+            tracemalloc.reset_peak()
+        self.record['thread'] = threading.get_ident()
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        wall_end = time.perf_counter()
+        record = self.record
+        record['start_s'] = self.wall_start - self.profiler.start_time
+        record['wall_s'] = wall_end - self.wall_start
+        record['cpu_s'] = time.process_time() - self.cpu_start
+        if self.profiler.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            with self.profiler._lock:
+                self.profiler._open.remove(self)
+            peak = max(peak, self.peak_seen)
+            record['traced_peak_bytes'] = max(peak - self.traced_start, 0)
+            record['traced_delta_bytes'] = current - self.traced_start
+        record['rss_bytes'] = get_rss()
+        record['max_rss_bytes'] = get_max_rss()
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        self.profiler.add(record)
+
+
+class Profiler:
+    """Records every stage run while it is active (ie, within a with
+    block).  If trace_memory is set, tracemalloc is used to measure the
+    peak memory allocated during each stage; this slows down pure Python
+    code somewhat.
+    """
+
+    def __init__(self, trace_memory: bool = True):
+        self.trace_memory = trace_memory
+        self.records = []
+        self.start_time = None
+        self._lock = threading.Lock()
+        self._open = []
+        self._started_tracemalloc = False
+
+    def add(self, record: dict):
+        with self._lock:
+            self.records.append(record)
+
+    def stage(self, name: str, src=None) -> _Stage:
+        return _Stage(self, name, src)
+
+    def __enter__(self):
+        global _active
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self.start_time = time.perf_counter()
+        self._previous = _active
+        _active = self
+        return self
+
+    def __exit__(self, *args):
+        global _active
+        _active = self._previous
+        self.total_s = time.perf_counter() - self.start_time
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def report(self) -> dict:
+        """Return the recorded stages, in the order they started."""
+        return {
+            'total_s': getattr(self, 'total_s', None),
+            'max_rss_bytes': get_max_rss(),
+            'stages': sorted(self.records, key=lambda r: r['start_s'])
+        }
+
+    def write_json(self, fpath: str) -> str:
+        with open(fpath, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+        return fpath
+
+    def write_chrome_trace(self, fpath: str) -> str:
+        """Write the stages in the Chrome trace event format."""
+        pid = os.getpid()
+        events = []
+        for r in self.records:
+            args = {k: v for k, v in r.items() if k not in ('name', 'start_s', 'wall_s', 'thread')}
+            events.append({'name': r['name'], 'cat': 'bother', 'ph': 'X', 'pid': pid, 'tid': r['thread'],
+                           'ts': r['start_s'] * 1e6, 'dur': r['wall_s'] * 1e6, 'args': args})
+        with open(fpath, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return fpath
+
+    def print_summary(self):
+        print(f'{"stage":<28}{"wall (s)":>10}{"cpu (s)":>10}{"peak (MB)":>11}{"out (MB)":>10}{"out shape":>16}'
+              f'{"dtype":>9}')
+        for r in self.report()['stages']:
+            peak = f'{r["traced_peak_bytes"] / 1e6:.1f}' if 'traced_peak_bytes' in r else '-'
+            out = r['output'] or {}
+            nbytes = f'{out["nbytes"] / 1e6:.1f}' if 'nbytes' in out else '-'
+            shape = 'x'.join(str(n) for n in out.get('shape', [])) or '-'
+            dtype = out.get('dtype', out.get('mode', '-'))
+            print(f'{r["name"]:<28}{r["wall_s"]:>10.3f}{r["cpu_s"]:>10.3f}{peak:>11}{nbytes:>10}{shape:>16}{dtype:>9}')
+
+
+def profile_stage(name: str, src=None):
+    """Context manager recording a stage named name, with input src, in
+    the active Profiler (if any).  Call set_output on the value it returns
+    to record the stage's output.
+    """
+    if _active is None:
+        return _NULL_STAGE
+    return _active.stage(name, src)
@@ -0,0 +1,147 @@
+"""A lightweight in-memory raster that is passed between the stages of
+the heightmap pipeline, so that GeoTIFF files only need to be encoded
+when a raster is actually written out.
+"""
+
+from typing import NamedTuple, Optional, Union
+
+import numpy as np
+import rasterio
+from rasterio import windows
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine, array_bounds
+from rasterio.coords import BoundingBox
+
+from otter.bother_utils import scratch
+
+
+class Grid(NamedTuple):
+    """The pixel grid of a raster, without its data, so that the grids
+    output by later stages can be worked out before running them.
+    """
+    transform: Affine
+    width: int
+    height: int
+    crs: object = None
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    @property
+    def bounds(self) -> BoundingBox:
+        return BoundingBox(*array_bounds(self.height, self.width, self.transform))
+
+    def window(self, window: windows.Window) -> 'Grid':
+        """Return the grid of the pixels in window (which must have
+        integer offsets and size).
+        """
+        return Grid(windows.transform(window, self.transform), int(window.width), int(window.height), self.crs)
+
+
+class Raster:
+    """A single band of elevation data together with its transform, CRS
+    and nodata value.  profile holds any other creation options (eg,
+    driver or block size) to use when the raster is written out.
+    """
+
+    def __init__(self, data: np.ndarray, transform: Affine, crs, nodata: Optional[float] = None,
+                 profile: Optional[dict] = None):
+        self.data = data
+        self.transform = transform
+        self.crs = crs
+        self.nodata = nodata
+        self._profile = dict(profile or {})
+
+    @classmethod
+    def from_dataset(cls, src: rasterio.io.DatasetReader) -> 'Raster':
+        data = src.read(1, out=scratch.empty(src.shape, src.dtypes[0])) if scratch.is_active() else src.read(1)
+        return cls(data, src.transform, src.crs, src.nodata, src.profile)
+
+    @classmethod
+    def from_file(cls, fpath: str) -> 'Raster':
+        with rasterio.open(fpath) as src:
+            return cls.from_dataset(src)
+
+    @classmethod
+    def from_memfile(cls, memfile: MemoryFile) -> 'Raster':
+        with memfile.open() as src:
+            return cls.from_dataset(src)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def height(self) -> int:
+        return self.data.shape[0]
+
+    @property
+    def width(self) -> int:
+        return self.data.shape[1]
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def bounds(self) -> BoundingBox:
+        return BoundingBox(*array_bounds(self.height, self.width, self.transform))
+
+    @property
+    def grid(self) -> Grid:
+        return Grid(self.transform, self.width, self.height, self.crs)
+
+    @property
+    def profile(self) -> dict:
+        """Profile with which to write this raster with rasterio."""
+        profile = self._profile.copy()
+        profile.setdefault('driver', 'GTiff')
+        profile.update({
+            'count': 1,
+            'height': self.height,
+            'width': self.width,
+            'dtype': self.data.dtype,
+            'transform': self.transform,
+            'crs': self.crs,
+            'nodata': self.nodata
+        })
+        return profile
+
+    def replace(self, data: Optional[np.ndarray] = None, **kwargs) -> 'Raster':
+        """Return a new Raster with the same attributes as this one, except
+        for data and any of transform, crs or nodata given as keyword
+        arguments.
+        """
+        attrs = {'transform': self.transform, 'crs': self.crs, 'nodata': self.nodata, 'profile': self._profile}
+        attrs.update(kwargs)
+        return Raster(self.data if data is None else data, **attrs)
+
+    def window(self, window: windows.Window) -> 'Raster':
+        """Return the pixels in window (which must have integer offsets and
+        size) as a new Raster, sharing data with this one.
+        """
+        rows, cols = window.toslices()
+        return self.replace(self.data[rows, cols], transform=windows.transform(window, self.transform))
+
+    def to_memfile(self) -> MemoryFile:
+        memfile = MemoryFile()
+        with memfile.open(**self.profile) as dst:
+            dst.write(self.data, 1)
+        return memfile
+
+    def to_file(self, fpath: str) -> str:
+        with rasterio.open(fpath, 'w', **self.profile) as dst:
+            dst.write(self.data, 1)
+        return fpath
+
+
+def as_raster(src: Union[Raster, MemoryFile, str]) -> Raster:
+    """Return src as a Raster, reading it if it is a MemoryFile or the
+    path to a raster file.
+    """
+    if isinstance(src, Raster):
+        return src
+    elif isinstance(src, MemoryFile):
+        return Raster.from_memfile(src)
+    return Raster.from_file(src)
@@ -0,0 +1,91 @@
+"""Scratch space for the intermediate rasters of the bother pipeline.
+
+Stages allocate their output arrays through empty, full and copy, which
+return ordinary in-memory arrays unless a ScratchSpace is active.  While
+one is active (ie, within a with block), they return arrays memory-mapped
+from anonymous files in its directory instead, so that the OS page cache
+decides which parts of each raster are kept in memory and jobs whose
+rasters do not fit in RAM can still finish.  Stages read and write the
+mapped arrays directly, without copying them into memory.
+
+The files are unlinked as soon as they are created (on Windows, when
+they are closed), so they are removed once the arrays mapped from them
+are no longer used, even if bother is interrupted.  Temporary arrays used
+within a stage (eg, the labels used to find lakes) are still allocated in
+memory.
+"""
+
+import os
+import tempfile
+from typing import Optional
+
+import numpy as np
+
+
+_active = None
+
+
+class ScratchSpace:
+    """Allocates arrays as memory-mapped files in scratch_dir (by
+    default, the system's temporary directory) while it is active.
+    nbytes is the total size of the arrays allocated so far.
+    """
+
+    def __init__(self, scratch_dir: Optional[str] = None):
+        self.scratch_dir = scratch_dir
+        self.nbytes = 0
+
+    def empty(self, shape, dtype) -> np.ndarray:
+        dtype = np.dtype(dtype)
+        if not int(np.prod(shape)):
+            # Empty files cannot be mapped
+            return np.empty(shape, dtype=dtype)
+        if self.scratch_dir is not None:
+            os.makedirs(self.scratch_dir, exist_ok=True)
+        with tempfile.TemporaryFile(prefix='bother_', suffix='.dat', dir=self.scratch_dir) as f:
+            # The mapping keeps the file open after f is closed
+            data = np.memmap(f, dtype=dtype, mode='w+', shape=shape)
+        self.nbytes += data.nbytes
+        return data
+
+    def __enter__(self):
+        global _active
+        self._previous = _active
+        _active = self
+        return self
+
+    def __exit__(self, *args):
+        global _active
+        _active = self._previous
+
+
+def is_active() -> bool:
+    return _active is not None
+
+def empty(shape, dtype) -> np.ndarray:
+    """Return an uninitialised array, memory-mapped if a ScratchSpace is
+    active.
+    """
+    if _active is None:
+        return np.empty(shape, dtype=dtype)
+    return _active.empty(shape, dtype)
+
+def full(shape, fill_value, dtype) -> np.ndarray:
+    """Return an array filled with fill_value, memory-mapped if a
+    ScratchSpace is active.
+    """
+    if _active is None:
+        return np.full(shape, fill_value, dtype=dtype)
+    data = _active.empty(shape, dtype)
+    if fill_value != 0:
+        # New files are already filled with zeros
+        data.fill(fill_value)
+    return data
+
+def copy(data: np.ndarray) -> np.ndarray:
+    """Return a copy of data, memory-mapped if a ScratchSpace is active."""
+    if _active is None:
+        return data.copy()
+    dst = _active.empty(data.shape, data.dtype)
+    np.copyto(dst, data)
+    return dst
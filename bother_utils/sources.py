@@ -0,0 +1,216 @@
+"""Sources from which SRTM tile zip files can be fetched: the CGIAR
+website (or any other HTTP server laid out in the same way), a local
+directory mirroring it, or nowhere at all (offline mode).
+"""
+
+import os
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+from typing import Optional, Union
+
+import requests
+from tqdm import tqdm
+
+
+TILE_SOURCE_ENV_VAR = 'BOTHER_TILE_SOURCE'
+OFFLINE = 'offline'
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_WORKERS = 4
+
+
+class TileSourceError(Exception):
+    """Raised when a tile cannot be obtained from a tile source."""
+
+
+def get_session(pool_size: int = DOWNLOAD_WORKERS) -> requests.Session:
+    """Create a requests.Session whose connection pool is large enough
+    to keep one keep-alive connection open per download worker.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def _add_to_total(pbar: tqdm, size: int):
+    if size:
+        with pbar.get_lock():
+            pbar.total = (pbar.total or 0) + size
+            pbar.refresh()
+
+def download_zip(url: str, save_path: str, chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+                 session: Optional[requests.Session] = None, pbar: Optional[tqdm] = None) -> Optional[str]:
+    """Download the zip file at url to save_path and return save_path,
+    or None if the server responds with HTTP 404.  If session is given,
+    it is used for the request (so that connections can be reused across
+    downloads).  If pbar is given, progress is reported to that bar
+    rather than to a new one.
+    """
+    getter = requests.get if session is None else session.get
+    r = getter(url, stream=True)
+    if not r.ok:
+        if r.status_code == 404:
+            # 404 can be returned if we try fetch a tile that corresponds to
+            # a part of the world with no land, which is okay.
+            return None
+        else:
+            r.raise_for_status()
+    r.raise_for_status()
+    total_size_in_bytes = int(r.headers.get('content-length', 0))
+
+    own_pbar = pbar is None
+    if own_pbar:
+        pbar = tqdm(total=total_size_in_bytes, unit='iB', unit_scale=True)
+    else:
+        _add_to_total(pbar, total_size_in_bytes)
+
+    # Write to a temporary file so that incompletely downloaded tiles are
+    # not considered to have been cached
+    temp_save_path = save_path + ".part"
+    try:
+        with open(temp_save_path, 'wb') as fd:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                pbar.update(len(chunk))
+                fd.write(chunk)
+    finally:
+        r.close()
+        if own_pbar:
+            pbar.close()
+    os.replace(temp_save_path, save_path)
+    return save_path
+
+
+class TileSource:
+    """Base class for tile sources.  Subclasses implement fetch, which
+    saves a tile's zip file to the cache and returns its path, or returns
+    None if the source has no such tile.  If the source is authoritative,
+    that means the tile contains no land, which is recorded in the cache's
+    catalog; otherwise the tile is only skipped for the current run.
+    """
+
+    offline = False
+    authoritative = True
+
+    def describe(self, fname: str) -> str:
+        """Describe where fname will be fetched from, for log messages."""
+        raise NotImplementedError
+
+    def fetch(self, fname: str, save_path: str, pbar: Optional[tqdm] = None) -> Optional[str]:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class HTTPTileSource(TileSource):
+    """Fetch tiles over HTTP from base_url, using one keep-alive session
+    shared by up to workers concurrent downloads.
+    """
+
+    def __init__(self, base_url: str, workers: int = DOWNLOAD_WORKERS,
+                 chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+        if not base_url.endswith('/'):
+            base_url += '/'
+        self.base_url = base_url
+        self.chunk_size = chunk_size
+        self.session = get_session(workers)
+
+    def describe(self, fname: str) -> str:
+        return self.base_url + fname
+
+    def fetch(self, fname: str, save_path: str, pbar: Optional[tqdm] = None) -> Optional[str]:
+        return download_zip(self.base_url + fname, save_path, self.chunk_size, self.session, pbar)
+
+    def close(self):
+        self.session.close()
+
+
+class DirectoryTileSource(TileSource):
+    """Copy tiles from a local directory (eg, a pre-populated mirror of
+    the CGIAR website on a shared drive).  Tiles that are absent from the
+    directory are skipped, but as the mirror may be incomplete they are
+    not recorded as containing no land, so they are looked for again
+    (possibly from another source) next time.
+    """
+
+    authoritative = False
+
+    def __init__(self, path: str, chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+        if not os.path.isdir(path):
+            raise TileSourceError(f'Tile directory {path} does not exist.')
+        self.path = path
+        self.chunk_size = chunk_size
+
+    def describe(self, fname: str) -> str:
+        return os.path.join(self.path, fname)
+
+    def fetch(self, fname: str, save_path: str, pbar: Optional[tqdm] = None) -> Optional[str]:
+        src_path = os.path.join(self.path, fname)
+        try:
+            size = os.path.getsize(src_path)
+        except FileNotFoundError:
+            return None
+        if pbar is not None:
+            _add_to_total(pbar, size)
+        temp_save_path = save_path + '.part'
+        with open(src_path, 'rb') as fsrc, open(temp_save_path, 'wb') as fdst:
+            for chunk in iter(lambda: fsrc.read(self.chunk_size), b''):
+                fdst.write(chunk)
+                if pbar is not None:
+                    pbar.update(len(chunk))
+        os.replace(temp_save_path, save_path)
+        return save_path
+
+
+class OfflineTileSource(TileSource):
+    """A source that never fetches anything, so that only tiles that are
+    already cached can be used.
+    """
+
+    offline = True
+
+    def describe(self, fname: str) -> str:
+        return 'nowhere (offline mode)'
+
+    def fetch(self, fname: str, save_path: str, pbar: Optional[tqdm] = None) -> Optional[str]:
+        raise TileSourceError(f'{fname} is not cached and offline mode is enabled.')
+
+
+def get_tile_source(source: Union[str, TileSource, None] = None, default: Optional[str] = None,
+                    workers: int = DOWNLOAD_WORKERS) -> TileSource:
+    """Get a tile source.  source may be a TileSource, "offline", a
+    http(s):// URL, a file:// URL or a path to a local directory.  If
+    source is None, the BOTHER_TILE_SOURCE environment variable is used
+    if set, and otherwise default (a URL).
+    """
+    if isinstance(source, TileSource):
+        return source
+    if source is None:
+        source = os.environ.get(TILE_SOURCE_ENV_VAR) or default
+    if source is None:
+        raise TileSourceError('No tile source given.')
+    if source == OFFLINE:
+        return OfflineTileSource()
+    scheme = urlparse(source).scheme
+    if scheme in ('http', 'https'):
+        return HTTPTileSource(source, workers)
+    elif scheme == 'file':
+        return DirectoryTileSource(url2pathname(urlparse(source).path))
+    elif os.path.isdir(source):
+        return DirectoryTileSource(source)
+    raise TileSourceError(f'Unrecognised tile source: {source}.')
+
+def describe_tile_source(source: Union[str, TileSource, None] = None, default: Optional[str] = None) -> str:
+    """Describe the tile source that get_tile_source would return, without
+    creating it, eg to record where tiles came from.
+    """
+    if isinstance(source, TileSource):
+        return f'{type(source).__name__}({source.describe("")})'
+    return source or os.environ.get(TILE_SOURCE_ENV_VAR) or default
@@ -4,17 +4,31 @@ TIF file for the desired coordinates using that data.
 
 import os
 import math
+import time
 import shutil
 import zipfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Union, Iterable, Tuple, Dict
 
-import requests
+import numpy as np
 import appdirs
 import rasterio
-import rasterio.merge
+import rasterio.errors
+from rasterio import windows
+from rasterio.enums import Resampling
 from rasterio.io import MemoryFile
+from rasterio.transform import Affine
 from tqdm import tqdm
 
+from otter.bother_utils.raster import Raster
+from otter.bother_utils import scratch
+from otter.bother_utils.profiling import profile_stage
+from otter.bother_utils.catalog import TileCatalog, get_catalog, forget_catalog, is_valid_zip
+from otter.bother_utils import sources
+from otter.bother_utils.sources import TileSource, TileSourceError, get_tile_source, DOWNLOAD_WORKERS
+
 
 ZIP_BASE_URL = 'http://srtm.csi.cgiar.org/wp-content/uploads/files/srtm_5x5/TIFF/'
 ZIP_FNAME = 'srtm_{x:02d}_{y:02d}.zip'
@@ -23,10 +37,16 @@ TIF_FNAME = 'srtm_{x:02d}_{y:02d}.tif'
 TILE_X_BOUNDS = (1, 72)
 TILE_Y_BOUNDS = (1, 24)
 TILE_SHAPE = (6000, 6000)
+TILE_RES = 5 / TILE_SHAPE[0]
+OVERVIEW_FACTORS = (2, 4, 8, 16)
+STORE_MAX_TILES = 16
 SRTM_NODATA = -32768
 #SRTM_NODATA = 65535
 CACHE_DIR = appdirs.user_cache_dir('bother', appauthor=False)
 
+# download_zip used to be defined here; kept for code that imports it from this module
+download_zip = sources.download_zip
+
 
 def wrap_range(start: int, end: int, min_val: int = 1, max_val: int = 72) -> Iterable[int]:
     i = start
@@ -39,16 +59,10 @@ def wrap_range(start: int, end: int, min_val: int = 1, max_val: int = 72) -> Ite
         i += 1
 
 def is_cached(fname: str, cache_dir: str) -> bool:
-    try:
-        return fname in os.listdir(cache_dir)
-    except FileNotFoundError:
-        return False
+    return get_catalog(cache_dir).is_present(fname)
 
 def get_cached_files(cache_dir: str, ext: str = '') -> Iterable[str]:
-    try:
-        return list(filter(lambda f: f.endswith(ext), os.listdir(cache_dir)))
-    except FileNotFoundError:
-        return []
+    return get_catalog(cache_dir).files(ext=ext)
 
 def get_extract_dir(cache_dir: str) -> str:
     return os.path.join(cache_dir, 'extracted')
@@ -56,28 +70,19 @@ def get_extract_dir(cache_dir: str) -> str:
 def get_tif_fpath(x: int, y: int, cache_dir: str) -> str:
     return os.path.join(cache_dir, 'extracted', TIF_FNAME.format(x=x, y=y))
 
-def download_zip(url: str, save_path: str, chunk_size: int = 1024):
-    r = requests.get(url, stream=True)
-    if not r.ok:
-        if r.status_code == 404:
-            # 404 can be returned if we try fetch a tile that corresponds to
-            # a part of the world with no land, which is okay.
-            return None
-        else:
-            r.raise_for_status()
-    r.raise_for_status()
-    total_size_in_bytes = int(r.headers.get('content-length', 0))
-    
-    # Write to a temporary file so that incompletely downloaded tiles are
-    # not considered to have been cached
-    temp_save_path = save_path + ".part"
-    with tqdm(total=total_size_in_bytes, unit='iB', unit_scale=True) as pbar:
-        with open(temp_save_path, 'wb') as fd:
-            for chunk in r.iter_content(chunk_size=chunk_size):
-                pbar.update(len(chunk))
-                fd.write(chunk)
-    os.rename(temp_save_path, save_path)
-    return save_path
+def get_decoded_dir(cache_dir: str) -> str:
+    return os.path.join(cache_dir, 'decoded')
+
+def get_decoded_fpath(x: int, y: int, cache_dir: str) -> str:
+    return os.path.join(get_decoded_dir(cache_dir), TIF_FNAME.format(x=x, y=y))
+
+def get_tile_bounds(x: int, y: int) -> Tuple[float, float, float, float]:
+    """Return the (left, bottom, right, top) bounds of tile x, y, ie, the
+    inverse of get_xy_components.
+    """
+    left = (x - 1) * 5 - 180
+    top = 65 - y * 5
+    return left, top - 5, left + 5, top
 
 def get_xy_components(lon: float, lat: float) -> Tuple[int, int]:
     """For a given longitude and latitude, returns the relevant
@@ -119,50 +124,527 @@ def get_all_zip_fnames(left: float, bottom: float, right: float, top: float,
         fnames[(x, y)] = ZIP_FNAME.format(x=x, y=y)
     return fnames
 
-def fetch_all_zips(fnames: Dict[Tuple[int, int], str], cache_dir: str) -> Dict[Tuple[int, int], str]:
+def get_tiles_state(left: float, bottom: float, right: float, top: float,
+                    cache_dir: str = CACHE_DIR) -> Dict[str, Optional[str]]:
+    """Return the state in the catalog of cache_dir of each tile within
+    the given bounds: the SHA-256 of its cached zip file, 'ocean' if it is
+    known to contain no land or None if it has not been fetched yet.
+    """
+    catalog = get_catalog(cache_dir)
+    state = {}
+    for fname in get_all_zip_fnames(left, bottom, right, top).values():
+        if catalog.is_present(fname):
+            state[fname] = catalog.get(fname).get('sha256')
+        elif catalog.is_ocean(fname):
+            state[fname] = 'ocean'
+        else:
+            state[fname] = None
+    return state
+
+def _print_404_warning(fname: str):
+    print(f'WARNING: {fname} was not found at the tile source (eg, HTTP 404 response).')
+    print('This could mean that (1) this tile corresponds to a region of the earth '
+          'where there is no land; (2) this tile is outside the coverage area of the '
+          'SRTM data; or (3) there is some issue with the website (which may be '
+          'temporary).')
+    print('We will assume the cause is (1) and will proceed accordingly.')
+
+def _fetch_zip(fname: str, cache_dir: str, source: TileSource, pbar: tqdm,
+               catalog: TileCatalog, bounds: Tuple[float, float, float, float]) -> Optional[str]:
+    """Fetch a single tile into cache_dir, check that it is complete,
+    record it in the catalog and report its throughput.
+    """
+    tqdm.write(f'Downloading {fname} from {source.describe(fname)}.')
+    start = time.perf_counter()
+    fpath = source.fetch(fname, os.path.join(cache_dir, fname), pbar)
+    elapsed = time.perf_counter() - start
+    if fpath is None:
+        if source.authoritative:
+            catalog.record_ocean(fname, bounds)
+        else:
+            tqdm.write(f'{fname} was not found at {source.describe(fname)}; skipping it for now.')
+        return None
+    if not is_valid_zip(fpath):
+        catalog.record_corrupt(fname)
+        os.remove(fpath)
+        raise zipfile.BadZipFile(f'Downloaded {fname} is not a valid zip file.')
+    catalog.record_present(fname, fpath, bounds)
+    size_mb = os.path.getsize(fpath) / 1e6
+    tqdm.write(f'Downloaded {fname} ({size_mb:.1f} MB) in {elapsed:.1f}s '
+               f'({size_mb / max(elapsed, 1e-6):.1f} MB/s).')
+    return fpath
+
+def _split_cached(fnames: Dict[Tuple[int, int], str], cache_dir: str,
+                  catalog: TileCatalog) -> Tuple[Dict[Tuple[int, int], Optional[str]], Dict[Tuple[int, int], str]]:
+    """Split fnames into a dict mapping xy pairs to the paths of tiles
+    that are cached (or None for tiles known to contain no land) and a
+    dict of the tiles that need to be fetched.
+    """
+    fpaths = {}
+    to_fetch = {}
+    for xy in fnames:
+        fname = fnames[xy]
+        if catalog.is_present(fname):
+            print(f'{fname} was cached in {cache_dir}.')
+            catalog.touch(fname)
+            fpaths[xy] = os.path.join(cache_dir, fname)
+        elif catalog.is_ocean(fname):
+            print(f'{fname} is known to contain no land; skipping.')
+            catalog.touch(fname)
+            fpaths[xy] = None
+        else:
+            to_fetch[xy] = fname
+    return fpaths, to_fetch
+
+def _get_fetch_source(source: Union[str, TileSource, None], to_fetch: Dict[Tuple[int, int], str],
+                      cache_dir: str, workers: int) -> TileSource:
+    tile_source = get_tile_source(source, ZIP_BASE_URL, workers)
+    if tile_source.offline:
+        raise TileSourceError(f'Offline mode is enabled but the following tiles are not cached in '
+                              f'{cache_dir}: {", ".join(to_fetch.values())}.')
+    return tile_source
+
+def fetch_all_zips(fnames: Dict[Tuple[int, int], str], cache_dir: str, workers: int = DOWNLOAD_WORKERS,
+                   source: Union[str, TileSource, None] = None) -> Dict[Tuple[int, int], str]:
     """Takes a dict mapping xy pairs to zip filenames, downloads the
     relevant files if they are not already in the cache, and returns
     a dict mapping each xy pair to the absolute paths of the relevant
     zip file.
+
+    Missing tiles are downloaded concurrently by up to workers threads,
+    which share a single keep-alive session and a single progress bar.
+    Set workers to 1 to download the tiles one after another.
+
+    The cache's tile catalog is consulted instead of the cache directory
+    itself, and tiles that the catalog records as having no land are
+    not requested from the server again.
+
+    Tiles are fetched from source, which may be anything accepted by
+    get_tile_source (by default, the BOTHER_TILE_SOURCE environment
+    variable or ZIP_BASE_URL).  In offline mode, a TileSourceError is
+    raised straight away if any tile is not cached.
     """
     
-    fpaths = {}
-    cached = get_cached_files(cache_dir, '.zip')
-    for xy in fnames:
-        fname = fnames[xy]
-        fpath = os.path.join(cache_dir, fname)
-        if fname not in cached:
-            url = ZIP_BASE_URL+fname
-            print(f'Downloading {fname} from {url}.')
-            fpath = download_zip(url, fpath)
-            if fpath is None:
-                print(f'WARNING: Received HTTP 404 response when attempting to download {fname}.')
-                print('This could mean that (1) this tile corresponds to a region of the earth '
-                      'where there is no land; (2) this tile is outside the coverage area of the '
-                      'SRTM data; or (3) there is some issue with the website (which may be '
-                      'temporary).')
-                print('We will assume the cause is (1) and will proceed accordingly.')
-        else:
-            print(f'{fname} was cached in {cache_dir}.')
-        fpaths[xy] = fpath
-    return fpaths
+    os.makedirs(cache_dir, exist_ok=True)
+    catalog = get_catalog(cache_dir)
+    fpaths, to_fetch = _split_cached(fnames, cache_dir, catalog)
+
+    try:
+        if to_fetch:
+            workers = max(1, min(workers, len(to_fetch)))
+            tile_source = _get_fetch_source(source, to_fetch, cache_dir, workers)
+            try:
+                with tqdm(total=0, unit='iB', unit_scale=True) as pbar:
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        futures = {xy: executor.submit(_fetch_zip, fname, cache_dir, tile_source, pbar, catalog,
+                                                       get_tile_bounds(*xy))
+                                   for xy, fname in to_fetch.items()}
+                        for xy, future in futures.items():
+                            fpaths[xy] = future.result()
+            finally:
+                if tile_source is not source:
+                    tile_source.close()
+            for xy, fname in to_fetch.items():
+                if fpaths[xy] is None:
+                    _print_404_warning(fname)
+    finally:
+        catalog.save()
+
+    return {xy: fpaths[xy] for xy in fnames}
 
 def unzip_all(zip_files: Iterable[str], cache_dir: str) -> str:
     extract_dir = get_extract_dir(cache_dir)
     os.makedirs(extract_dir, exist_ok=True)
-    for fpath in zip_files:
-        if fpath is not None:
-            print(f'Extracting {fpath} to {extract_dir}.')
-            with zipfile.ZipFile(fpath, 'r') as zf:
-                zf.extractall(extract_dir)
+    with profile_stage('srtm_unzip'):
+        for fpath in zip_files:
+            if fpath is not None:
+                print(f'Extracting {fpath} to {extract_dir}.')
+                with zipfile.ZipFile(fpath, 'r') as zf:
+                    zf.extractall(extract_dir)
     return extract_dir
 
-def create_tif_file(left: float, bottom: float, right: float, top: float, to_file: Optional[str] = None,
-                    cache_dir: str = CACHE_DIR, nodata: int = SRTM_NODATA) ->  Union[str, MemoryFile]:
-    """Create a TIF file using SRTM data  for the box defined by left,
-    bottom, right, top.  If to_file is provided, saves the resulting
-    file to to_file and returns the path; otherwise, creates a
-    rasterio.io.MemoryFile and returns that.
+def get_vsizip_path(zip_fpath: str, x: int, y: int) -> str:
+    """Return a GDAL /vsizip/ path to the GeoTIFF for tile x, y inside
+    the zip file at zip_fpath, so that it can be opened by rasterio
+    without being extracted first.
+    """
+    tif_fname = TIF_FNAME.format(x=x, y=y)
+    with zipfile.ZipFile(zip_fpath, 'r') as zf:
+        # Only the central directory is read here, not the compressed data.
+        members = [m for m in zf.namelist() if os.path.basename(m) == tif_fname]
+    if not members:
+        raise FileNotFoundError(f'{tif_fname} not found in {zip_fpath}.')
+    return f'/vsizip/{os.path.abspath(zip_fpath)}/{members[0]}'
+
+def _open_source_tile(x: int, y: int, zip_fpath: str, cache_dir: str, nodata: int = SRTM_NODATA,
+                      extract: bool = False) -> Tuple[rasterio.io.DatasetReader, bool]:
+    tif_fpath = get_tif_fpath(x, y, cache_dir)
+    if os.path.exists(tif_fpath):
+        return rasterio.open(tif_fpath, 'r', nodata=nodata), False
+    if not extract:
+        try:
+            return rasterio.open(get_vsizip_path(zip_fpath, x, y), 'r', nodata=nodata), False
+        except (FileNotFoundError, zipfile.BadZipFile, rasterio.errors.RasterioIOError) as e:
+            print(f'Could not read {zip_fpath} in place ({e}); extracting instead.')
+    try:
+        unzip_all([zip_fpath], cache_dir)
+    except zipfile.BadZipFile:
+        # Make sure the tile is downloaded again next time
+        catalog = get_catalog(cache_dir)
+        catalog.record_corrupt(os.path.basename(zip_fpath))
+        catalog.save()
+        raise
+    return rasterio.open(tif_fpath, 'r', nodata=nodata), True
+
+def decode_tile(x: int, y: int, zip_fpath: str, cache_dir: str, nodata: int = SRTM_NODATA,
+                factors: Iterable[int] = OVERVIEW_FACTORS) -> Tuple[str, bool]:
+    """Write a decoded copy of tile x, y to the decoded directory of the
+    cache, as a tiled, compressed GeoTIFF with internal overviews at each
+    of the given decimation factors.  Returns the path to the decoded
+    file and whether the tile had to be extracted to decode it.
+    """
+    decoded_fpath = get_decoded_fpath(x, y, cache_dir)
+    os.makedirs(get_decoded_dir(cache_dir), exist_ok=True)
+    src, extracted = _open_source_tile(x, y, zip_fpath, cache_dir, nodata)
+    print(f'Building overviews {list(factors)} for {os.path.basename(decoded_fpath)}.')
+    with src, profile_stage('srtm_decode_tile'):
+        profile = src.profile
+        profile.update({
+            'driver': 'GTiff',
+            'tiled': True,
+            'blockxsize': 256,
+            'blockysize': 256,
+            'compress': 'deflate',
+            'predictor': 2,
+            'nodata': nodata
+        })
+        # Include the process ID so that concurrent jobs sharing the cache
+        # do not write to the same temporary file
+        temp_fpath = f'{decoded_fpath}.{os.getpid()}.part'
+        with rasterio.open(temp_fpath, 'w', **profile) as dst:
+            dst.write(src.read())
+            dst.build_overviews(list(factors), Resampling.average)
+            dst.update_tags(ns='rio_overview', resampling='average')
+    os.replace(temp_fpath, decoded_fpath)
+    return decoded_fpath, extracted
+
+def choose_overview_level(src: rasterio.io.DatasetReader, target_res: Optional[float]) -> Optional[int]:
+    """Return the index of the coarsest overview of src whose resolution
+    is still at least as fine as target_res, or None if there is no such
+    overview (in which case the full resolution data should be used).
+    """
+    if target_res is None:
+        return None
+    level = None
+    for i, factor in enumerate(src.overviews(1)):
+        if max(src.res) * factor <= target_res * (1 + 1e-9):
+            level = i
+    return level
+
+def get_target_res(left: float, bottom: float, right: float, top: float,
+                   out_shape: Optional[Tuple[int, int]] = None) -> Optional[float]:
+    """Return the finest resolution (in degrees) needed to produce a
+    mosaic of shape out_shape covering the given bounds, or None if no
+    out_shape is given.
+    """
+    if out_shape is None:
+        return None
+    height, width = out_shape
+    return min((right - left) / width, (top - bottom) / height)
+
+def open_tile(x: int, y: int, zip_fpath: str, cache_dir: str, nodata: int = SRTM_NODATA,
+              extract: bool = False, target_res: Optional[float] = None) -> Tuple[rasterio.io.DatasetReader, bool]:
+    """Open the GeoTIFF for tile x, y.  Returns the open dataset and a
+    flag indicating whether the tile had to be extracted to do so.
+
+    A decoded copy of the tile (see decode_tile) is used if present, and
+    is created first if target_res (in degrees) is at least twice as
+    coarse as the tile's resolution.  In that case the tile is opened at
+    the coarsest overview level that still meets target_res.
+
+    Otherwise, a previously extracted TIF file in the extract directory
+    is used if present.  Failing that, the TIF file is read directly
+    from inside the cached zip file via /vsizip/, falling back to
+    extracting the zip file if GDAL cannot read it that way (or if
+    extract is set).
+    """
+    decoded_fpath = get_decoded_fpath(x, y, cache_dir)
+    extracted = False
+    if (target_res is not None) and (target_res >= 2 * TILE_RES) and not os.path.exists(decoded_fpath):
+        decoded_fpath, extracted = decode_tile(x, y, zip_fpath, cache_dir, nodata)
+    if os.path.exists(decoded_fpath):
+        with rasterio.open(decoded_fpath, 'r') as src:
+            level = choose_overview_level(src, target_res)
+        if level is None:
+            return rasterio.open(decoded_fpath, 'r', nodata=nodata), extracted
+        return rasterio.open(decoded_fpath, 'r', nodata=nodata, overview_level=level), extracted
+    return _open_source_tile(x, y, zip_fpath, cache_dir, nodata, extract)
+
+class TileStore:
+    """Keeps decoded tiles in memory so that they can be mosaicked
+    repeatedly (eg, for several regions in a batch) without being read
+    and decompressed from the cache each time.  At most max_tiles tiles
+    are kept, discarding the least recently used.
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, nodata: int = SRTM_NODATA, max_tiles: int = STORE_MAX_TILES):
+        self.cache_dir = cache_dir
+        self.nodata = nodata
+        self.max_tiles = max_tiles
+        self._tiles: 'OrderedDict[Tuple[int, int], MemoryFile]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, xy: Tuple[int, int]) -> bool:
+        return xy in self._tiles
+
+    def _load(self, x: int, y: int, zip_fpath: str) -> MemoryFile:
+        src, extracted = open_tile(x, y, zip_fpath, self.cache_dir, self.nodata)
+        with src:
+            print(f'Loading {src.name} into memory.')
+            profile = src.profile
+            profile.update({'driver': 'GTiff', 'compress': None})
+            memfile = MemoryFile()
+            with memfile.open(**profile) as dst:
+                dst.write(src.read())
+        if extracted:
+            clear_cache(self.cache_dir, True)
+        return memfile
+
+    def open(self, x: int, y: int, zip_fpath: str) -> rasterio.io.DatasetReader:
+        """Open tile x, y, loading it from zip_fpath if it is not already
+        in memory.
+        """
+        with self._lock:
+            memfile = self._tiles.get((x, y))
+            if memfile is None:
+                memfile = self._tiles[(x, y)] = self._load(x, y, zip_fpath)
+                while len(self._tiles) > self.max_tiles:
+                    _, old = self._tiles.popitem(last=False)
+                    old.close()
+            self._tiles.move_to_end((x, y))
+            return memfile.open()
+
+    def close(self):
+        with self._lock:
+            for memfile in self._tiles.values():
+                memfile.close()
+            self._tiles.clear()
+
+def get_mosaic_grid(left: float, bottom: float, right: float, top: float, res: Tuple[float, float],
+                    out_shape: Optional[Tuple[int, int]] = None) -> Tuple[Affine, int, int]:
+    """Return the transform, height and width of the output grid for a
+    mosaic covering left, bottom, right, top.  The grid has resolution
+    res (as an (x, y) tuple), unless out_shape is given as (height,
+    width), in which case the resolution is chosen to fit that shape.
+    """
+    if out_shape is not None:
+        height, width = out_shape
+        xres = (right - left) / width
+        yres = (top - bottom) / height
+    else:
+        xres, yres = res
+        width = int(round((right - left) / xres))
+        height = int(round((top - bottom) / yres))
+    return Affine.translation(left, top) * Affine.scale(xres, -yres), height, width
+
+def read_tile_block(src: rasterio.io.DatasetReader, dst_shape: Tuple[int, int], dst_transform: Affine,
+                    nodata: int = SRTM_NODATA,
+                    resampling: Resampling = Resampling.nearest) -> Optional[Tuple[Tuple[slice, slice], np.ndarray]]:
+    """Read the part of src that falls within a grid of dst_shape with
+    transform dst_transform.  Only the window of src that intersects the
+    grid is decoded, and it is decimated to the resolution of the grid as
+    it is read.  Returns the rows and columns of the grid that it covers
+    and the data read, or None if src does not intersect the grid.
+    """
+    height, width = dst_shape
+    dst_left, dst_top = dst_transform * (0, 0)
+    dst_right, dst_bottom = dst_transform * (width, height)
+    
+    # Bounds of the region covered by both src and dst
+    ileft = max(src.bounds.left, dst_left)
+    iright = min(src.bounds.right, dst_right)
+    ibottom = max(src.bounds.bottom, dst_bottom)
+    itop = min(src.bounds.top, dst_top)
+    if (ileft >= iright) or (ibottom >= itop):
+        return None
+    
+    dst_window = windows.from_bounds(ileft, ibottom, iright, itop, dst_transform)
+    native = (math.isclose(dst_transform.a, src.transform.a, rel_tol=1e-6)
+              and math.isclose(dst_transform.e, src.transform.e, rel_tol=1e-6))
+    if native:
+        # Round offsets and lengths in the same way as rasterio.merge (and
+        # gdal_merge.py), so that the result is identical to merging the
+        # full tiles
+        row_start = math.floor(dst_window.row_off + 0.1)
+        col_start = math.floor(dst_window.col_off + 0.1)
+        row_stop = min(height, row_start + math.floor(dst_window.height + 0.5))
+        col_stop = min(width, col_start + math.floor(dst_window.width + 0.5))
+    else:
+        # When decimating, round the edges instead so that adjacent tiles
+        # meet without a gap of one (coarse) pixel between them
+        row_start = round(dst_window.row_off)
+        col_start = round(dst_window.col_off)
+        row_stop = min(height, round(dst_window.row_off + dst_window.height))
+        col_stop = min(width, round(dst_window.col_off + dst_window.width))
+    if (col_start >= col_stop) or (row_start >= row_stop):
+        return None
+    
+    if native:
+        src_window = windows.from_bounds(ileft, ibottom, iright, itop, src.transform)
+        boundless = False
+    else:
+        aligned = windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+        src_window = windows.from_bounds(*windows.bounds(aligned, dst_transform), src.transform)
+        boundless = True
+    data = src.read(1, window=src_window, out_shape=(row_stop - row_start, col_stop - col_start),
+                    resampling=resampling, boundless=boundless, fill_value=nodata)
+    return (slice(row_start, row_stop), slice(col_start, col_stop)), data
+
+def paste_tile_block(dst: np.ndarray, block: Tuple[Tuple[slice, slice], np.ndarray], nodata: int = SRTM_NODATA):
+    """Write a block returned by read_tile_block into dst in place,
+    without overwriting pixels that already hold data, so that where
+    tiles overlap the first one pasted wins (as in rasterio.merge).
+    """
+    (rows, cols), data = block
+    region = dst[rows, cols]
+    np.copyto(region, data, where=(region == nodata))
+
+def read_tile_window(src: rasterio.io.DatasetReader, dst: np.ndarray, dst_transform: Affine,
+                     nodata: int = SRTM_NODATA, resampling: Resampling = Resampling.nearest) -> bool:
+    """Read the part of src that falls within the grid of dst (a 2D array
+    with transform dst_transform) and write it into dst in place, without
+    overwriting pixels that already hold data (see read_tile_block).
+    Returns False if src does not intersect dst.
+    """
+    block = read_tile_block(src, dst.shape, dst_transform, nodata, resampling)
+    if block is None:
+        return False
+    paste_tile_block(dst, block, nodata)
+    return True
+
+def mosaic_tiles(srcs: Iterable[rasterio.io.DatasetReader], left: float, bottom: float, right: float,
+                 top: float, out_shape: Optional[Tuple[int, int]] = None, nodata: int = SRTM_NODATA,
+                 resampling: Resampling = Resampling.nearest) -> Tuple[np.ndarray, Affine]:
+    """Mosaic the tiles in srcs into a single array covering left,
+    bottom, right, top, in the same way as rasterio.merge.merge.  Only
+    the window of each tile that intersects the bounds is read, directly
+    into a preallocated output array.  If out_shape is given as (height,
+    width), each window is decimated to that output shape as it is read.
+    Returns an array of shape (1, height, width) and its transform.
+    """
+    srcs = list(srcs)
+    transform, height, width = get_mosaic_grid(left, bottom, right, top, srcs[0].res, out_shape)
+    data = scratch.full((1, height, width), nodata, srcs[0].dtypes[0])
+    for src in srcs:
+        read_tile_window(src, data[0], transform, nodata, resampling)
+    return data, transform
+
+def fetch_and_mosaic(fnames: Dict[Tuple[int, int], str], left: float, bottom: float, right: float, top: float,
+                     cache_dir: str = CACHE_DIR, nodata: int = SRTM_NODATA, workers: int = DOWNLOAD_WORKERS,
+                     extract: bool = False, out_shape: Optional[Tuple[int, int]] = None,
+                     resampling: Resampling = Resampling.nearest,
+                     source: Union[str, TileSource, None] = None) -> Tuple[np.ndarray, Affine, dict, bool]:
+    """Fetch the tiles in fnames (a dict mapping xy pairs to zip
+    filenames) and mosaic them as mosaic_tiles does, as a pipeline: each
+    tile is opened and its window decoded as soon as it is available,
+    while other tiles are still downloading.  Cached tiles are decoded
+    straight away.  Windows are written into the output array in the
+    order of fnames (as mosaic_tiles would write them), so that where
+    tiles overlap the result does not depend on which finished first; a
+    window that is ready before those of earlier tiles is held until
+    they have been written.
+
+    Returns the mosaic, its transform, the profile of the first tile read
+    and whether any tile had to be extracted.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    catalog = get_catalog(cache_dir)
+    fpaths, to_fetch = _split_cached(fnames, cache_dir, catalog)
+    mosaic = {}
+    lock = threading.Lock()
+    order = list(fnames)
+    # Windows decoded but not yet written (None for tiles with no window), and the index in order of the next
+    # tile to write
+    pending = {}
+    next_tile = [0]
+
+    def paste(xy: Tuple[int, int], block):
+        with lock:
+            pending[xy] = block
+            while (next_tile[0] < len(order)) and (order[next_tile[0]] in pending):
+                block = pending.pop(order[next_tile[0]])
+                if block is not None:
+                    paste_tile_block(mosaic['data'][0], block, nodata)
+                next_tile[0] += 1
+
+    def add_tile(xy: Tuple[int, int], fpath: Optional[str]) -> bool:
+        if fpath is None:
+            paste(xy, None)
+            return False
+        src, was_extracted = open_tile(*xy, fpath, cache_dir, nodata, extract,
+                                       get_target_res(left, bottom, right, top, out_shape))
+        with src:
+            with lock:
+                # The output grid is only known once the first tile is open
+                if not mosaic:
+                    transform, height, width = get_mosaic_grid(left, bottom, right, top, src.res, out_shape)
+                    mosaic['data'] = scratch.full((1, height, width), nodata, src.dtypes[0])
+                    mosaic['transform'] = transform
+                    mosaic['profile'] = src.profile
+            block = read_tile_block(src, mosaic['data'].shape[1:], mosaic['transform'], nodata, resampling)
+            paste(xy, block)
+            tqdm.write(f'Added {src.name} to mosaic.')
+        return was_extracted
+
+    def fetch_and_add(xy: Tuple[int, int], fname: str, tile_source: TileSource, pbar: tqdm) -> bool:
+        fpaths[xy] = _fetch_zip(fname, cache_dir, tile_source, pbar, catalog, get_tile_bounds(*xy))
+        return add_tile(xy, fpaths[xy])
+
+    tile_source = None
+    try:
+        if to_fetch:
+            tile_source = _get_fetch_source(source, to_fetch, cache_dir, max(1, min(workers, len(to_fetch))))
+        with tqdm(total=0, unit='iB', unit_scale=True, disable=not to_fetch) as pbar:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                futures = [executor.submit(fetch_and_add, xy, fname, tile_source, pbar)
+                           for xy, fname in to_fetch.items()]
+                futures += [executor.submit(add_tile, xy, fpath) for xy, fpath in fpaths.items()]
+                extracted = any([f.result() for f in futures])
+    finally:
+        if (tile_source is not None) and (tile_source is not source):
+            tile_source.close()
+        catalog.save()
+
+    for xy, fname in to_fetch.items():
+        if fpaths[xy] is None:
+            _print_404_warning(fname)
+    if not mosaic:
+        raise ValueError(f'No SRTM data found within bounds {(left, bottom, right, top)}.')
+    return mosaic['data'], mosaic['transform'], mosaic['profile'], extracted
+
+def create_raster(left: float, bottom: float, right: float, top: float, cache_dir: str = CACHE_DIR,
+                  nodata: int = SRTM_NODATA, workers: int = DOWNLOAD_WORKERS, extract: bool = False,
+                  out_shape: Optional[Tuple[int, int]] = None, resampling: Resampling = Resampling.nearest,
+                  source: Union[str, TileSource, None] = None, pipeline: bool = True,
+                  tile_store: Optional[TileStore] = None) -> Raster:
+    """Create an in-memory Raster using SRTM data for the box defined by
+    left, bottom, right, top.  workers is the number of tiles that may be
+    downloaded concurrently.
+
+    Tiles are read straight out of the cached zip files unless extract
+    is set, in which case they are extracted to the extract directory
+    first (and removed again afterwards).  Only the pixels of each tile
+    that fall within the bounds are read; if out_shape is given as
+    (height, width), they are decimated to that shape using resampling,
+    reading from the coarsest cached overview of each tile that is still
+    fine enough (see open_tile).  Missing tiles are fetched from source
+    (see fetch_all_zips).
+
+    By default, tiles are decoded and added to the mosaic as soon as each
+    one has been downloaded (see fetch_and_mosaic).  If pipeline is False,
+    all tiles are downloaded first and then mosaicked together.  If a
+    TileStore is given as tile_store, tiles are read from (and kept in)
+    that store rather than opened from the cache each time.
     """
     
     os.makedirs(cache_dir, exist_ok=True)
@@ -171,44 +653,71 @@ def create_tif_file(left: float, bottom: float, right: float, top: float, to_fil
     zip_fnames = {}
     for x, y in xy:
         zip_fnames[(x, y)] = ZIP_FNAME.format(x=x, y=y)
-    zip_fpaths = fetch_all_zips(zip_fnames, cache_dir)
-    unzip_all(zip_fpaths.values(), cache_dir)
-    srcs = []
-    for x, y in xy:
-        if zip_fpaths[(x, y)] is not None:
-            srcs.append(rasterio.open(get_tif_fpath(x, y, cache_dir), 'r', nodata=nodata))
-    print(f'Creating TIF file from following files: {[s.name for s in srcs]}.')
-    #print(f'Heights are: {[s.height for s in srcs]}.')
-    #print(f'Widths are: {[s.width for s in srcs]}.')
-    profile = srcs[0].profile
-    data, transform = rasterio.merge.merge(srcs, (left, bottom, right, top), nodata=nodata)
-    for src in srcs:
-        src.close()
-    clear_cache(cache_dir, True)
-    bands, height, width = data.shape   # No idea if this is the correct order for height and width, but they are both
-                                        # the same so it doesn't matter in this case
-    profile.update({
-        'height': height,
-        'width': width,
-        'transform': transform
-    })
-    print(f'Created TIF file with dimensions {width}x{height}.') 
+    if pipeline and (tile_store is None):
+        with profile_stage('srtm_fetch_and_merge') as stage:
+            data, transform, profile, extracted = fetch_and_mosaic(zip_fnames, left, bottom, right, top, cache_dir,
+                                                                   nodata, workers, extract, out_shape, resampling,
+                                                                   source)
+            stage.set_output(data)
+    else:
+        with profile_stage('srtm_fetch'):
+            zip_fpaths = fetch_all_zips(zip_fnames, cache_dir, workers, source)
+        srcs = []
+        extracted = False
+        with profile_stage('srtm_open_tiles'):
+            for x, y in xy:
+                if zip_fpaths[(x, y)] is None:
+                    continue
+                if tile_store is not None:
+                    src, was_extracted = tile_store.open(x, y, zip_fpaths[(x, y)]), False
+                else:
+                    src, was_extracted = open_tile(x, y, zip_fpaths[(x, y)], cache_dir, nodata, extract,
+                                                   get_target_res(left, bottom, right, top, out_shape))
+                srcs.append(src)
+                extracted = extracted or was_extracted
+        print(f'Creating TIF file from following files: {[s.name for s in srcs]}.')
+        #print(f'Heights are: {[s.height for s in srcs]}.')
+        #print(f'Widths are: {[s.width for s in srcs]}.')
+        profile = srcs[0].profile
+        with profile_stage('srtm_merge') as stage:
+            data, transform = mosaic_tiles(srcs, left, bottom, right, top, out_shape, nodata, resampling)
+            stage.set_output(data)
+        for src in srcs:
+            src.close()
+    if extracted:
+        clear_cache(cache_dir, True)
+    bands, height, width = data.shape
+    print(f'Created mosaic with dimensions {width}x{height}.')
+    return Raster(data[0], transform, profile['crs'], profile.get('nodata', nodata), profile)
+
+def create_tif_file(left: float, bottom: float, right: float, top: float, to_file: Optional[str] = None,
+                    cache_dir: str = CACHE_DIR, nodata: int = SRTM_NODATA,
+                    workers: int = DOWNLOAD_WORKERS, extract: bool = False,
+                    out_shape: Optional[Tuple[int, int]] = None,
+                    resampling: Resampling = Resampling.nearest,
+                    source: Union[str, TileSource, None] = None,
+                    pipeline: bool = True, tile_store: Optional[TileStore] = None) ->  Union[str, MemoryFile]:
+    """Create a TIF file using SRTM data  for the box defined by left,
+    bottom, right, top.  If to_file is provided, saves the resulting
+    file to to_file and returns the path; otherwise, creates a
+    rasterio.io.MemoryFile and returns that.  The other arguments are as
+    for create_raster.
+    """
+    raster = create_raster(left, bottom, right, top, cache_dir, nodata, workers, extract, out_shape, resampling,
+                           source, pipeline, tile_store)
+    print(f'Created TIF file with dimensions {raster.width}x{raster.height}.') 
     if to_file:
         print(f'Writing TIF file to {to_file}.')
-        with rasterio.open(to_file, 'w', **profile) as dst:
-            dst.write(data)
-        return to_file
+        return raster.to_file(to_file)
     else:
-        memfile = MemoryFile()
-        with memfile.open(**profile) as dst:
-            dst.write(data)
-        return memfile
+        return raster.to_memfile()
 
 def clear_cache(cache_dir: str = CACHE_DIR, extracted_only: bool = False):
     if extracted_only:
         to_remove = get_extract_dir(cache_dir)
     else:
         to_remove = cache_dir
+        forget_catalog(cache_dir)
     try:
         shutil.rmtree(to_remove)
     except FileNotFoundError:
@@ -0,0 +1,201 @@
+"""A content-addressed on-disk cache of the rasters output by each stage
+of the bother pipeline, so that rerunning bother with only later
+parameters changed (eg, crop or max_brightness) resumes from the last
+unchanged stage instead of starting again from the SRTM tiles.
+
+Each stage's output is stored under a key made from the key of its
+input and the stage's name and parameters, so a key identifies the
+whole chain of stages (and the source data) that produced a raster.
+"""
+
+import os
+import json
+import time
+import hashlib
+from typing import Callable, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+
+from otter.bother_utils.srtm import CACHE_DIR
+from otter.bother_utils.raster import Raster
+from otter.bother_utils import scratch
+from otter.bother_utils.profiling import profile_stage
+
+
+STAGE_CACHE_DIR = os.path.join(CACHE_DIR, 'stages')
+DEFAULT_STAGE_CACHE_SIZE = 1024 ** 3  # 1 GiB
+
+# Bump this whenever a change to a stage changes its output, so that
+# outputs cached by older versions are not reused.
+STAGE_CACHE_VERSION = 1
+
+
+class Stage(NamedTuple):
+    """A stage of the pipeline.  params must be JSON serialisable and
+    include everything that affects the output of func, which is called
+    with the output of the previous stage (or None for the first stage).
+    """
+    name: str
+    params: dict
+    func: Callable[[Optional[Raster]], Raster]
+
+
+def get_stage_key(input_key: Optional[str], name: str, params: dict) -> str:
+    """Return the cache key for the output of stage name with params,
+    applied to the raster with key input_key.
+    """
+    spec = {'version': STAGE_CACHE_VERSION, 'input': input_key, 'stage': name, 'params': params}
+    return hashlib.sha256(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+
+def get_stage_keys(stages: Sequence[Stage], input_key: Optional[str] = None) -> List[str]:
+    """Return the cache key for the output of each of stages, run in turn
+    on the raster with key input_key.
+    """
+    keys = []
+    key = input_key
+    for stage in stages:
+        key = get_stage_key(key, stage.name, stage.params)
+        keys.append(key)
+    return keys
+
+
+class StageCache:
+    """Rasters stored in cache_dir as a .npy file holding the data and a
+    .json file holding the transform, CRS and nodata value.  Once the
+    cache uses more than max_size bytes, the least recently used entries
+    are removed.
+    """
+
+    def __init__(self, cache_dir: str = STAGE_CACHE_DIR, max_size: int = DEFAULT_STAGE_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def _fpaths(self, key: str):
+        base = os.path.join(self.cache_dir, key)
+        return base + '.npy', base + '.json'
+
+    def __contains__(self, key: str) -> bool:
+        return all(os.path.exists(fpath) for fpath in self._fpaths(key))
+
+    def load(self, key: str) -> Optional[Raster]:
+        data_fpath, meta_fpath = self._fpaths(key)
+        try:
+            with open(meta_fpath, 'r') as f:
+                meta = json.load(f)
+            if scratch.is_active():
+                # Map the cached array and copy it into scratch space, rather than into memory
+                data = scratch.copy(np.load(data_fpath, mmap_mode='r', allow_pickle=False))
+            else:
+                data = np.load(data_fpath, allow_pickle=False)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        now = time.time()
+        for fpath in (data_fpath, meta_fpath):
+            os.utime(fpath, (now, now))
+        crs = CRS.from_user_input(meta['crs']) if meta['crs'] else None
+        return Raster(data, Affine(*meta['transform']), crs, meta['nodata'])
+
+    def save(self, key: str, raster: Raster):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data_fpath, meta_fpath = self._fpaths(key)
+        crs = raster.crs
+        meta = {
+            'transform': list(raster.transform)[:6],
+            'crs': crs.to_wkt() if hasattr(crs, 'to_wkt') else crs,
+            'nodata': raster.nodata
+        }
+        # Write the data first and the metadata last, so that an entry is
+        # only considered present once it is complete
+        part = f'.{os.getpid()}.part'
+        with open(data_fpath + part, 'wb') as f:
+            np.save(f, raster.data, allow_pickle=False)
+        os.replace(data_fpath + part, data_fpath)
+        with open(meta_fpath + part, 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_fpath + part, meta_fpath)
+
+    def get_size(self) -> int:
+        try:
+            return sum(e.stat().st_size for e in os.scandir(self.cache_dir) if e.is_file())
+        except FileNotFoundError:
+            return 0
+
+    def enforce_limit(self) -> List[str]:
+        """Remove least recently used entries until the cache uses at most
+        max_size bytes.  Returns the removed keys.
+        """
+        try:
+            entries = [e for e in os.scandir(self.cache_dir) if e.is_file() and not e.name.endswith('.part')]
+        except FileNotFoundError:
+            return []
+        total = sum(e.stat().st_size for e in entries)
+        last_used = {}
+        sizes = {}
+        for e in entries:
+            key = e.name.split('.')[0]
+            last_used[key] = max(last_used.get(key, 0), e.stat().st_mtime)
+            sizes[key] = sizes.get(key, 0) + e.stat().st_size
+
+        removed = []
+        for key in sorted(last_used, key=last_used.get):
+            if total <= self.max_size:
+                break
+            for e in entries:
+                if e.name.split('.')[0] == key:
+                    try:
+                        os.remove(e.path)
+                    except FileNotFoundError:
+                        pass
+            total -= sizes[key]
+            removed.append(key)
+        if removed:
+            print(f'Removed {len(removed)} entries from the stage cache; it now uses {total / 1e6:.1f} MB.')
+        return removed
+
+
+def _run_stage(stage: Stage, raster: Optional[Raster]) -> Raster:
+    with profile_stage(stage.name, raster) as profiled:
+        raster = stage.func(raster)
+        profiled.set_output(raster)
+    return raster
+
+def run_stages(stages: Sequence[Stage], cache: Optional[StageCache] = None, raster: Optional[Raster] = None,
+               input_key: Optional[str] = None) -> Raster:
+    """Run stages in turn and return the output of the last one.  If
+    cache is given, resume from the last stage whose output is cached and
+    cache the outputs of the stages that are run, printing whether each
+    stage was a cache hit.  raster is the input to the first stage; if it
+    was itself output by stages, pass the key of its last stage (see
+    get_stage_keys) as input_key.
+    """
+    if cache is None:
+        for stage in stages:
+            raster = _run_stage(stage, raster)
+        return raster
+
+    keys = get_stage_keys(stages, input_key)
+    start = 0
+    for i in reversed(range(len(stages))):
+        if keys[i] in cache:
+            with profile_stage('stage_cache_load') as profiled:
+                cached = cache.load(keys[i])
+                profiled.set_output(cached)
+            if cached is not None:
+                raster = cached
+                start = i + 1
+                break
+
+    for i, stage in enumerate(stages):
+        if i < start - 1:
+            print(f'Stage cache: {stage.name} skipped (a later stage is cached).')
+        elif i == start - 1:
+            print(f'Stage cache: {stage.name} hit.')
+        else:
+            print(f'Stage cache: {stage.name} miss.')
+            raster = _run_stage(stage, raster)
+            with profile_stage('stage_cache_save', raster):
+                cache.save(keys[i], raster)
+    cache.enforce_limit()
+    return raster
@@ -1,21 +1,56 @@
-from .build_info import build_info
-
-from .build_version import build_version
-
-from .build_main import build_main, build_towns_code, build_industry_code, build_canal_code, build_signs_code
-
-from .bother import bother
-
-from .georef_png import georef_png
-
-from .add_land import add_land
-
-from .add_water import add_water
-
-from .create_random_points import create_random_points
-
-from .get_map_coords import get_map_coords
-
-from .get_latlong_from_map import get_latlong_from_map
-
-from .town_data_to_json import town_data_to_json
\ No newline at end of file
+'''
+The public functions of otter, each imported from its submodule the first time it is used, so that
+importing otter (e.g. just to call build_info or build_version) does not load geopandas, rasterio,
+pandas and the other heavy dependencies of the functions that are not used.
+'''
+
+import sys
+import types
+import importlib
+
+
+# Public function name -> submodule that defines it
+_LAZY_FUNCTIONS = {
+    'build_info': 'build_info',
+    'build_version': 'build_version',
+    'build_main': 'build_main',
+    'build_towns_code': 'build_main',
+    'build_industry_code': 'build_main',
+    'build_canal_code': 'build_main',
+    'build_signs_code': 'build_main',
+    'bother': 'bother',
+    'bother_batch': 'bother_batch',
+    'georef_png': 'georef_png',
+    'add_land': 'add_land',
+    'add_water': 'add_water',
+    'create_random_points': 'create_random_points',
+    'get_map_coords': 'get_map_coords',
+    'get_latlong_from_map': 'get_latlong_from_map',
+    'town_data_to_json': 'town_data_to_json'
+}
+
+__all__ = list(_LAZY_FUNCTIONS)
+
+
+def __getattr__(name):
+    if name in _LAZY_FUNCTIONS:
+        module = importlib.import_module(f'.{_LAZY_FUNCTIONS[name]}', __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+class _LazyModule(types.ModuleType):
+
+    def __setattr__(self, name, value):
+        # Importing a submodule sets it as an attribute of this package, which would hide the function
+        # of the same name (e.g. otter.otter.bother), so leave those to __getattr__ instead
+        if name in _LAZY_FUNCTIONS and isinstance(value, types.ModuleType):
+            return
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _LazyModule
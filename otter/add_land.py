@@ -65,11 +65,11 @@ def add_land(ras, shp_path, outpath, elevation=1, select_col=None, select_val=No
     with rio.open(ras) as src:
         # ras_crs = src.crs
         arr = src.read()
-        out_image, out_transformation = rio.mask.mask(src, land_shapes, crop=False)
+        out_image, out_transformation = rio.mask.mask(src, land_shapes, crop=False, filled=False) # masked outside shapes
         out_meta = src.meta
         
     print('Setting land to elevation...')
-    land_cells_idx = ~np.isnan(out_image)
+    land_cells_idx = ~np.ma.getmaskarray(out_image)
     arr[land_cells_idx] = elevation
     
     print('Writing editted raster...')
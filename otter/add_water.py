@@ -85,11 +85,11 @@ def add_water(ras, shp_path, outpath, select_col=None, select_val=None, buffer=N
             water_shapes = buff_geo.tolist()
         
         arr = src.read()
-        out_image, out_transformation = rio.mask.mask(src, water_shapes, crop=False) # returns only values underlaying feature, otherwise 0
+        out_image, out_transformation = rio.mask.mask(src, water_shapes, crop=False, filled=False) # masked outside features
         out_meta = src.meta
         
     print('Setting water to sea-level...')
-    water_cells_idx = ~np.isnan(out_image)
+    water_cells_idx = ~np.ma.getmaskarray(out_image)
     arr[water_cells_idx] = 0 # set cells to 0
     
     print('Writing editted raster...')
@@ -13,24 +13,36 @@ TODO:
 import sys
 import logging
 import math
-import time
 import os
 import os.path
-import tempfile
-from typing import Optional, Set, Tuple, List
+from contextlib import nullcontext
+from typing import Callable, NamedTuple, Optional, Set, Tuple, List
 
+import numpy as np
 from PIL import Image
-from rasterio.io import MemoryFile
+import rasterio
+from rasterio import windows
 
 from pyproj import CRS
 from pyproj.exceptions import CRSError
 
-from otter.bother_utils.srtm import create_tif_file, clear_cache
-from otter.bother_utils.heightmap import (remove_sea, resample, reproject_raster, set_lakes_to_elev, raise_undersea_land,
-                                    raise_low_pixels, to_png, crop_modes, crop_image, scale_image_f, png_to_file)
-
-import geopandas as gpd
-import pandas as pd
+from otter.bother_utils.srtm import (CACHE_DIR, ZIP_BASE_URL, create_raster, clear_cache, fetch_all_zips,
+                                     get_all_zip_fnames, get_tiles_state)
+from otter.bother_utils.sources import describe_tile_source
+from otter.bother_utils.raster import Grid, Raster
+from otter.bother_utils.catalog import file_sha256
+from otter.bother_utils.blocks import get_kernel, get_stats
+from otter.bother_utils.brightness import get_histogram, parse_curve
+from otter.bother_utils.profiling import Profiler, profile_stage
+from otter.bother_utils.scratch import ScratchSpace
+from otter.bother_utils.stage_cache import DEFAULT_STAGE_CACHE_SIZE, Stage, StageCache, get_stage_keys, run_stages
+from otter.bother_utils.cache import DEFAULT_CACHE_SIZE, enforce_cache_limit, pin_region
+from otter.bother_utils.heightmap import (remove_sea, resample, reproject_raster, warp_to_grid, set_lakes_to_elev,
+                                    set_water_to_elev, fill_nodata_voids, as_dtype,
+                                    raise_undersea_land, raise_low_pixels, to_png, crop_modes, crop_image, scale_image_f,
+                                    png_to_file, get_resample_grid, get_reproject_grid, get_resampling,
+                                    reproject_to_grid, get_crop_box, get_source_window, raise_undersea_stage,
+                                    raise_low_stage, to_png_stages)
 
 # EPSG codes
 WGS84 = 4326  # Mercator - The default CRS used in the STRM data
@@ -40,9 +52,55 @@ def error(msg: str):
     print(f'ERROR: {msg}', file=sys.stderr)
     sys.exit(1)
 
+
+class _Warp(NamedTuple):
+    """A stage that changes the grid of the raster, with the function
+    giving its output grid for a given input grid, the CRS it assumes for
+    its input (if not the input's own) and its resampling method.
+    """
+    stage: Stage
+    get_grid: Callable[[Grid], Grid]
+    src_crs: Optional[str]
+    resampling: Optional[str]
+
+def get_crop_stages(grid: Grid, source_stages: List[Stage], warps: List[_Warp], width: int, height: int,
+                    mode: str) -> List[Stage]:
+    """Return stages that, applied to a raster with the given grid, crop
+    it to the window of its grid needed to compute the crop (width x
+    height, mode) of the output of warps, run source_stages on that
+    window, and then compute only that crop of the output of each warp.
+    """
+    grids = [grid]
+    for warp in warps:
+        grids.append(warp.get_grid(grids[-1]))
+    left, top, right, bottom = get_crop_box(grids[-1].width, grids[-1].height, width, height, mode)
+    window = windows.Window(left, top, right - left, bottom - top)
+    # Work back from the crop to the window of each earlier grid needed to compute it
+    targets = [grids[-1].window(window)]
+    for warp, src_grid in zip(reversed(warps), reversed(grids[:-1])):
+        window = get_source_window(targets[0], src_grid, warp.src_crs)
+        targets.insert(0, src_grid.window(window))
+    print(f'Cropping raster to {window.width}x{window.height} before processing it.')
+
+    stages = [Stage('crop_window', {'window': [window.col_off, window.row_off, window.width, window.height]},
+                    lambda r: r.window(window))]
+    stages.extend(source_stages)
+    for warp, src_grid, dst_grid, target in zip(warps, grids, grids[1:], targets[1:]):
+        # Use the resampling method that would be used for the whole raster
+        method = get_resampling(warp.resampling, src_grid.shape, dst_grid.shape)
+        params = dict(warp.stage.params, grid=list(target.transform)[:6] + [target.width, target.height])
+        stages.append(Stage(warp.stage.name, params,
+                            lambda r, target=target, method=method, src_crs=warp.src_crs:
+                                reproject_to_grid(r, target, method, src_crs)))
+    return stages
+
 def bother(outfile, bounds=None, outfile_tif=None, infile_tif=None, scale_data=None, epsg='4326', raise_low=0, 
            raise_undersea=None, no_sea=None, lakes=None, max_brightness=255, infile_png=None, crop=None,
-           scale_image=None):
+           scale_image=None, cache_size=DEFAULT_CACHE_SIZE, clear_srtm_cache=False, pin=False,
+           tile_source=None, tile_store=None, workers=1, map_size=None, resampling=None, stage_cache=False,
+           stage_cache_size=DEFAULT_STAGE_CACHE_SIZE, profile=False, profile_json=None, profile_trace=None,
+           crop_pushdown=True, lake_method='flat', fill_voids=False, brightness='linear',
+           dtype=None, scratch_dir=None):
     '''
     Run bother to download SRTM elevation data.
 
@@ -78,9 +136,15 @@ def bother(outfile, bounds=None, outfile_tif=None, infile_tif=None, scale_data=N
     **lakes** : *int, optional*;
         Detect lakes and set to 0; provided value is the minimum number of contiguous pixels needed. The default is None.
         
+    **lake_method** : *str, optional*;
+        How lakes are detected: 'flat' finds regions of exactly the same elevation; 'flood' fills depressions and finds flat filled basins, which copes with noisy lake surfaces and ignores flat land that is not a basin, but is slower: rasters up to about 7 million pixels are filled in a few seconds using about 150 bytes of memory per pixel, and larger ones in about 2 seconds per million pixels using about 8 (see benchmarks/lakes.py). The default is 'flat'.
+        
     **max_brightness** : *int, optional*;
         Set the highest point of the elevation to the provided value rather than 255. The default is None.
         
+    **brightness** : *str, optional*;
+        Curve mapping elevation to brightness: 'linear', 'percentile[:LOW,HIGH]' (stretch between two percentiles of elevation, so that a few high peaks do not darken the rest of the map), 'gamma[:GAMMA]' or 'piecewise:ELEV:BRIGHTNESS,ELEV:BRIGHTNESS,...'; see bother_utils.brightness. The default is 'linear'.
+        
     **infile_png** : *str, path, optional*;
         Path to output png file. The default is None.
         
@@ -89,10 +153,61 @@ def bother(outfile, bounds=None, outfile_tif=None, infile_tif=None, scale_data=N
         
     **scale_image** : *str, optional*;
         Scale the resulting image to WIDTH x HEIGHT. The default is None.
+        
+    **cache_size** : *int, optional*;
+        Maximum size of the SRTM tile cache in bytes; least recently used tiles are evicted beyond that. If None, the cache size is not checked. The default is 2 GiB.
+        
+    **clear_srtm_cache** : *bool, optional*;
+        Delete the whole SRTM tile cache when finished. The default is False.
+        
+    **pin** : *bool, optional*;
+        Pin the tiles covering bounds in the cache so that they are never evicted. The default is False.
+        
+    **tile_source** : *str, optional*;
+        Where to fetch SRTM tiles that are not cached: a http(s):// URL, a file:// URL or directory containing the tile zip files, or 'offline' to only use cached tiles. The default is None, which uses the BOTHER_TILE_SOURCE environment variable if set and the CGIAR website otherwise.
+        
+    **tile_store** : *TileStore, optional*;
+        Keep decoded SRTM tiles in this in-memory store, so that they can be reused by later calls (see bother_batch). The default is None.
+        
+    **workers** : *int, optional*;
+        Number of processes to use for lake detection. With more than 1, lakes are found tile by tile, which also suits rasters too large to label in one go. The default is 1.
+        
+    **map_size** : *str, optional*;
+        Final size of the heightmap as WIDTHxHEIGHT (e.g. 2048x1024). The elevation data is reprojected to epsg and resampled to exactly that size in a single pass, rather than with scale_data, reprojection and scale_image in turn, which cannot be used with it. The default is None.
+        
+    **resampling** : *str, optional*;
+        Resampling method used with map_size, e.g. 'average', 'bilinear' or 'cubic'. The default is None, which uses average when reducing the resolution and bilinear otherwise.
+        
+    **stage_cache** : *bool, str or StageCache, optional*;
+        Cache the raster output by each stage on disk, so that rerunning with only later parameters changed (e.g. crop, scale_image or max_brightness) resumes from the last unchanged stage. May also be a directory in which to keep the cache. Each cached stage takes as much disk space as its output raster. The default is False.
+        
+    **stage_cache_size** : *int, optional*;
+        Maximum size of the stage cache in bytes; least recently used outputs are removed beyond that. The default is 1 GiB.
+        
+    **profile** : *bool, optional*;
+        Record the wall time, CPU time, memory use and input and output shapes of every stage, print a summary and return the report as a dict. The default is False.
+        
+    **profile_json** : *str, path, optional*;
+        Write the profiling report to this JSON file (implies profile). The default is None.
+        
+    **profile_trace** : *str, path, optional*;
+        Write the profiling report to this file in the Chrome trace format, which can be opened in chrome://tracing or https://ui.perfetto.dev (implies profile). The default is None.
+
+    **fill_voids** : *bool, optional*;
+        Fill voids in the SRTM data (regions without data that are enclosed by land, eg in mountains) by interpolating from the land around them, so that they are not rendered as sea. Regions without data that touch the edge of the map are kept as ocean. The default is False.
+        
+    **dtype** : *str, optional*;
+        Data type in which to hold elevations through the pipeline. SRTM data is 'int16'; a float32 infile_tif can be converted to 'int16' (rounding to whole metres) for half the memory. Each stage keeps the data type of its input and modifies it in place where it can. The default is None, which keeps the data type of the source.
+        
+    **scratch_dir** : *str, path, bool, optional*;
+        Keep the intermediate rasters in memory-mapped files in this directory (or, if True, the system's temporary directory) rather than in memory, so that the OS can page them out and maps too large for RAM can still be built. The files are removed automatically. Lake detection and filling voids still need several times the size of the raster in memory. The default is None, which keeps everything in memory.
+        
+    **crop_pushdown** : *bool, optional*;
+        With crop, only compute the part of the raster needed for the cropped image: the source is cut down to the window the crop needs and filling voids, reprojection, lake detection and the other stages only run on that (with no_sea, the stages up to remove_sea, which needs the minimum of the whole raster, still run in full). Brightness is still scaled to the elevation range of the whole region, taken before reprojection and lake detection (and including 0, the brightness of lakes, if lakes is set), so it may differ very slightly from the uncropped image. Lakes and voids crossing the edge of the window are only found if their part within it is big enough. With lake_method='flood' or a percentile brightness curve, lakes (and the stages before them) are found on the whole region, so that they and the brightness are the same as in the uncropped image. The default is True.
 
     Returns
     -------
-    Writes GeoTIFF and/or PNG.
+    Writes GeoTIFF and/or PNG. If profiling, returns the profiling report.
 
     '''
     
@@ -107,6 +222,10 @@ def bother(outfile, bounds=None, outfile_tif=None, infile_tif=None, scale_data=N
         error('bounds, infile_tif and infile_png are mutually exclusive.')
     
     if bounds is not None:
+        if not isinstance(bounds, list):
+            # Only needed for GeoDataframe or shapefile bounds, and slow to import
+            import geopandas as gpd
+        
         ## check if list of lat,long
         if isinstance(bounds, list):
             if len(bounds) != 4:
@@ -153,12 +272,12 @@ def bother(outfile, bounds=None, outfile_tif=None, infile_tif=None, scale_data=N
             error(f'Mode must be one of {crop_modes}.')
         res = res.split('x')
         try:
-            width = int(res[0])
-            height = int(res[1])
+            crop_width = int(res[0])
+            crop_height = int(res[1])
         except (IndexError, ValueError):
             error('Size for cropped image must be in form "WIDTHxHEIGHT", where WIDTH and HEIGHT are integers.')
-        if (width <= 0) or (height <= 0):
-            error(f'Invalid dimensions for cropping: {width}x{height}.')
+        if (crop_width <= 0) or (crop_height <= 0):
+            error(f'Invalid dimensions for cropping: {crop_width}x{crop_height}.')
             
         
     if scale_image:
@@ -173,11 +292,35 @@ def bother(outfile, bounds=None, outfile_tif=None, infile_tif=None, scale_data=N
             error(f'Invalid dimensions for scaling: {width}x{height}.')
             
     
+    if map_size:
+        if (scale_data is not None) or scale_image:
+            error('map_size cannot be used with scale_data or scale_image.')
+        res = map_size.split('x')
+        try:
+            map_width = int(res[0])
+            map_height = int(res[1])
+        except (IndexError, ValueError):
+            error('Map size must be in form "WIDTHxHEIGHT", where WIDTH and HEIGHT are integers.')
+        if (map_width <= 0) or (map_height <= 0):
+            error(f'Invalid dimensions for map size: {map_width}x{map_height}.')
+            
+    
     '''
     Set defaults if params given as boolean
     '''
     if lakes == True:
         lakes = 80
+    if lake_method not in ('flat', 'flood'):
+        error("lake_method must be 'flat' or 'flood'.")
+    try:
+        parse_curve(brightness)
+    except ValueError as e:
+        error(str(e))
+    if dtype is not None:
+        try:
+            dtype = np.dtype(dtype).name
+        except TypeError:
+            error(f'Invalid dtype {dtype}.')
     if raise_undersea == True:
         raise_undersea == 1
     if raise_low == True:
@@ -187,72 +330,175 @@ def bother(outfile, bounds=None, outfile_tif=None, infile_tif=None, scale_data=N
     '''
     Parse arguments - adapted from parse_namespace
     '''
-    tmp_file = None
-    
-    ## if bouding box is provided, create a tif from SRTM data
-    if bounds:
-        if outfile_tif:
-            to_file = os.path.abspath(outfile_tif)
-        else:
-            to_file = os.path.join(tempfile.gettempdir(), f'othg_{time.time()}.tif')
-            tmp_file = to_file
-        lat1, lon1, lat2, lon2 = bounds
-        tif_file = create_tif_file(lon1, lat1, lon2, lat2, to_file)
-    ## else if bounds is None, use existing infile_tif file
-    else:
-        tif_file = infile_tif
+    profiling = bool(profile or profile_json or profile_trace)
+    scratch_space = ScratchSpace(None if scratch_dir is True else scratch_dir) if scratch_dir else None
+    with Profiler() if profiling else nullcontext() as profiler, scratch_space or nullcontext():
+        if stage_cache is True:
+            stage_cache = StageCache(max_size=stage_cache_size)
+        elif isinstance(stage_cache, str):
+            stage_cache = StageCache(stage_cache, stage_cache_size)
+        elif not stage_cache:
+            stage_cache = None
 
-    if tif_file:
-        with open(tif_file, 'rb') as f:
-            #memfile = handle_nodata(MemoryFile(f))
-            memfile = MemoryFile(f)
-            
-            ## get infile crs
-            with memfile.open() as msrc:
-                msrc_crs = msrc.crs 
-            
+        ## if bouding box is provided, create a raster from SRTM data
+        stages = []
+        # The output of the stages run so far (if any) and its key in the stage cache
+        raster = None
+        input_key = None
+        if bounds:
+            lat1, lon1, lat2, lon2 = bounds
+            if pin:
+                pin_region(lon1, lat1, lon2, lat2)
+            params = {'bounds': [lon1, lat1, lon2, lat2]}
+            if stage_cache is not None:
+                # Key the mosaic on where the tiles come from and on the cached tiles themselves, so that it is
+                # rebuilt if the source changes or a tile is downloaded again.  Fetch the tiles first, so that
+                # the key is made from the tiles the mosaic is built from, even on the first run.
+                fetch_all_zips(get_all_zip_fnames(lon1, lat1, lon2, lat2), CACHE_DIR, source=tile_source)
+                params['source'] = describe_tile_source(tile_source, ZIP_BASE_URL)
+                params['tiles'] = get_tiles_state(lon1, lat1, lon2, lat2)
+            stages.append(Stage('create_raster', params,
+                                lambda _: create_raster(lon1, lat1, lon2, lat2, source=tile_source, tile_store=tile_store)))
+            if outfile_tif:
+                raster = run_stages(stages, stage_cache)
+                with profile_stage('write_tif', raster):
+                    raster.to_file(os.path.abspath(outfile_tif))
+                input_key = get_stage_keys(stages)[-1]
+                stages = []
+            src_crs = WGS84
+        ## else if bounds is None, use existing infile_tif file
+        elif infile_tif:
+            # Only hash the file when the key is used
+            params = {'sha256': file_sha256(infile_tif)} if stage_cache is not None else {'path': infile_tif}
+            stages.append(Stage('read_tif', params, lambda _: Raster.from_file(infile_tif)))
+            with rasterio.open(infile_tif) as src:
+                src_crs = src.crs
+
+        cropped = False
+        if bounds or infile_tif:
+            # Each stage's input is an intermediate raster that is not used again (or has already been cached),
+            # so the stages below modify it in place rather than allocating another full-size array
+            if dtype is not None:
+                stages.append(Stage('as_dtype', {'dtype': dtype}, lambda r: as_dtype(r, dtype)))
+            # Stages on the grid of the source that can run on just the window of it needed for a crop
+            source_stages = []
+            if fill_voids:
+                source_stages.append(Stage('fill_nodata_voids', {}, fill_nodata_voids))
+            warps = []
             if scale_data is not None:
-                memfile = resample(memfile, scale_data)
+                warps.append(_Warp(Stage('resample', {'scale_factor': scale_data}, lambda r: resample(r, scale_data)),
+                                   lambda g: get_resample_grid(g, scale_data), None, 'bilinear'))
             if no_sea:
-                memfile = remove_sea(memfile)
+                # remove_sea needs the minimum of the whole raster, so always run it (and the stages before it) in full
+                stages.extend(source_stages)
+                stages.extend(warp.stage for warp in warps)
+                source_stages = []
+                warps = []
+                stages.append(Stage('remove_sea', {}, lambda r: remove_sea(r, inplace=True)))
+            if map_size:
+                # Reproject and resample to the final map size in one pass
+                warps.append(_Warp(Stage('warp_to_grid', {'size': [map_width, map_height], 'epsg': str(epsg),
+                                                          'resampling': resampling},
+                                         lambda r: warp_to_grid(r, map_width, map_height, dst_crs=f'EPSG:{epsg}',
+                                                                resampling=resampling)),
+                                   lambda g: get_reproject_grid(g, f'EPSG:{epsg}', width=map_width, height=map_height),
+                                   None, resampling))
             # The SRTM data already uses WGS84 so no need to reproject to that 
             # if the infile is also WGS84, also no need to reproject; this should preserve input dimensions
-            if (epsg and (epsg != str(WGS84))) or (msrc_crs != WGS84):  
-                memfile = reproject_raster(memfile, dst_crs=f'EPSG:{epsg}')
-            if lakes:
-                memfile = set_lakes_to_elev(memfile, lakes)
+            elif (epsg and (epsg != str(WGS84))) or (src_crs != WGS84):  
+                warps.append(_Warp(Stage('reproject_raster', {'epsg': str(epsg)},
+                                         lambda r: reproject_raster(r, dst_crs=f'EPSG:{epsg}')),
+                                   lambda g: get_reproject_grid(g, f'EPSG:{epsg}', f'EPSG:{WGS84}'),
+                                   f'EPSG:{WGS84}', 'bilinear'))
+            later_stages = []
+            if lakes and (lake_method == 'flood'):
+                later_stages.append(Stage('set_water_to_elev', {'min_size': lakes},
+                                          lambda r: set_water_to_elev(r, lakes, inplace=True)))
+            elif lakes:
+                later_stages.append(Stage('set_lakes_to_elev', {'min_lake_size': lakes},
+                                          lambda r: set_lakes_to_elev(r, lakes, workers=workers, inplace=True)))
+            
+            png_histogram = None
+            low_stats = None
+            if crop and crop_pushdown:
+                if lakes and ((lake_method == 'flood') or (parse_curve(brightness)[0] == 'percentile')):
+                    # Depressions can drain across the edge of a window, and percentiles of brightness depend on
+                    # the number of lake pixels in the whole region, so then find lakes (and run the stages
+                    # before them) in full
+                    stages = stages + source_stages + [warp.stage for warp in warps] + later_stages
+                    source_stages, warps, later_stages = [], [], []
+                # Run the stages that need the whole raster in full, and the rest only on the window
+                # of the raster needed for the crop
+                raster = run_stages(stages, stage_cache, raster, input_key)
+                with profile_stage('brightness_stats', raster):
+                    # Scale brightness to the elevation range of the whole region
+                    value_stages = [raise_undersea_stage(raise_undersea)] if raise_undersea is not None else []
+                    if raise_low is not None:
+                        value_stages.append(raise_low_stage(raise_low, max_brightness))
+                    stats = get_stats(raster.data, value_stages)
+                    if raise_low is not None:
+                        low_stats = stats[-1:]
+                    floor_stage = to_png_stages(not raise_low, max_brightness)[0]
+                    png_histogram = get_histogram(raster.data, get_kernel(raster.data, value_stages + [floor_stage],
+                                                                          stats=stats + [None]))
+                    if later_stages:
+                        # Lakes will be set to nodata, which is shown as 0
+                        png_histogram = png_histogram.including(0)
+                input_key = (get_stage_keys(stages, input_key) or [input_key])[-1]
+                stages = get_crop_stages(raster.grid, source_stages, warps, crop_width, crop_height, mode) + later_stages
+                cropped = True
+            else:
+                stages = stages + source_stages + [warp.stage for warp in warps] + later_stages
             if raise_undersea is not None:
-                memfile = raise_undersea_land(memfile, raise_undersea)
+                stages.append(Stage('raise_undersea_land', {'raise_to': raise_undersea},
+                                    lambda r: raise_undersea_land(r, raise_undersea, inplace=True)))
             if raise_low is not None:
                 print(type(max_brightness))
-                memfile = raise_low_pixels(memfile, raise_low, max_brightness)
-            im = to_png(memfile, not raise_low, max_brightness)
-    elif infile_png:
-        im = Image.open(infile_png)
+                stages.append(Stage('raise_low_pixels', {'max_no_raise': raise_low, 'max_brightness': max_brightness},
+                                    lambda r: raise_low_pixels(r, raise_low, max_brightness, stats=low_stats,
+                                                               inplace=True)))
+            raster = run_stages(stages, stage_cache, raster, input_key)
+            with profile_stage('to_png', raster) as stage:
+                im = to_png(raster, not raise_low, max_brightness, curve=brightness, histogram=png_histogram)
+                stage.set_output(im)
+        elif infile_png:
+            im = Image.open(infile_png)
         
-    if crop:
-        res, mode = crop
-        res = res.split('x')
-        width = int(res[0])
-        height = int(res[1])
-        im = crop_image(im, width, height, mode)
-    if scale_image:
-        res = scale_image.split('x')
-        width = int(res[0])
-        height = int(res[1])
-        im = scale_image_f(im, width, height)
+        if crop and not cropped:
+            with profile_stage('crop_image', im) as stage:
+                im = crop_image(im, crop_width, crop_height, mode)
+                stage.set_output(im)
+        if scale_image:
+            res = scale_image.split('x')
+            width = int(res[0])
+            height = int(res[1])
+            with profile_stage('scale_image', im) as stage:
+                im = scale_image_f(im, width, height)
+                stage.set_output(im)
         
-    if outfile.endswith('.png'):
-        save_to = outfile
-    else:
-        save_to = outfile + '.png'
+        if outfile.endswith('.png'):
+            save_to = outfile
+        else:
+            save_to = outfile + '.png'
         
-    try:
-        png_to_file(im, save_to)
-    except FileNotFoundError:
-        error(f'Could not save to {save_to}.  Check that the directory to which you want to save exists.')
+        try:
+            with profile_stage('png_to_file', im):
+                png_to_file(im, save_to)
+        except FileNotFoundError:
+            error(f'Could not save to {save_to}.  Check that the directory to which you want to save exists.')
+    
+    if scratch_space is not None:
+        print(f'Used {scratch_space.nbytes / 1e6:.1f} MB of scratch space.')
+    
+    if clear_srtm_cache:
+        clear_cache()
+    elif cache_size is not None:
+        enforce_cache_limit(cache_size)
     
-    if tmp_file:
-        os.remove(tmp_file)
-    if clear_cache:
-        clear_cache()
\ No newline at end of file
+    if profiling:
+        profiler.print_summary()
+        if profile_json:
+            profiler.write_json(profile_json)
+        if profile_trace:
+            profiler.write_chrome_trace(profile_trace)
+        return profiler.report()
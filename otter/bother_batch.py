@@ -0,0 +1,147 @@
+'''
+This script contains a function to run bother for many regions in one go, e.g. to generate
+all of the heightmaps for a release. The SRTM tiles needed by all of the regions are fetched once
+up front, and decoded tiles are kept in memory and reused by every job that needs them.
+
+It can also be run from the command line with a JSON file describing the jobs:
+
+    python -m otter.otter.bother_batch jobs.json --workers 4
+
+where jobs.json is either a list of jobs or an object with "defaults" and "jobs" keys. Each job is
+an object of keyword arguments to bother (at least outfile and bounds).
+
+'''
+
+
+import sys
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Dict, Tuple, List
+
+from otter.bother_utils.srtm import CACHE_DIR, STORE_MAX_TILES, TileStore, get_all_zip_fnames, fetch_all_zips
+from otter.bother_utils.cache import DEFAULT_CACHE_SIZE, enforce_cache_limit
+from otter.otter.bother import bother
+
+
+# Keyword arguments to bother that bother_batch sets itself, so jobs may not
+BATCH_KEYS = ('tile_store', 'cache_size', 'clear_srtm_cache')
+
+# Tile store of the current (worker) process, kept across all jobs the process runs
+_tile_store = None
+
+def _init_worker(cache_dir: str, max_tiles: int):
+    global _tile_store
+    _tile_store = TileStore(cache_dir, max_tiles=max_tiles)
+
+def _run_job(job: dict) -> str:
+    print(f'Running bother job for {job["outfile"]}.')
+    bother(**job, tile_store=_tile_store, cache_size=None, clear_srtm_cache=False)
+    return job['outfile']
+
+def get_job_tiles(job: dict) -> Dict[Tuple[int, int], str]:
+    '''
+    Return a dict mapping xy pairs to the zip filenames of the SRTM tiles needed by a job, or an
+    empty dict if the job's bounds are not given as a list (in which case they are fetched by the job itself).
+    '''
+    bounds = job.get('bounds')
+    if not isinstance(bounds, (list, tuple)) or len(bounds) != 4:
+        return {}
+    lat1, lon1, lat2, lon2 = bounds
+    return get_all_zip_fnames(lon1, lat1, lon2, lat2)
+
+def bother_batch(jobs, defaults=None, workers=1, tile_source=None, max_tiles=STORE_MAX_TILES,
+                 cache_size=DEFAULT_CACHE_SIZE):
+    '''
+    Run bother for a list of regions, sharing SRTM tiles between them.
+
+    Parameters
+    ----------
+    **jobs** : *list of dict*;
+        Keyword arguments to bother for each region; each must include outfile and bounds (or infile_tif), and none may set tile_store, cache_size or clear_srtm_cache.
+
+    **defaults** : *dict, optional*;
+        Keyword arguments to bother shared by all jobs; values given in a job take precedence. The default is None.
+
+    **workers** : *int, optional*;
+        Number of processes to run jobs in. With 1, jobs run one after another in this process. The default is 1.
+
+    **tile_source** : *str, optional*;
+        Where to fetch missing SRTM tiles from; see bother. The default is None.
+
+    **max_tiles** : *int, optional*;
+        Maximum number of decoded tiles each process keeps in memory. The default is 16.
+
+    **cache_size** : *int, optional*;
+        Maximum size of the SRTM tile cache in bytes, enforced once all jobs have finished. The default is 2 GiB.
+
+    Returns
+    -------
+    List of the outfile of each job, in the order given.
+
+    '''
+
+    jobs = [{**(defaults or {}), **job} for job in jobs]
+    for job in jobs:
+        if 'outfile' not in job:
+            raise ValueError('Each job must include an outfile.')
+        reserved = [key for key in BATCH_KEYS if key in job]
+        if reserved:
+            raise ValueError(f'Jobs may not set {", ".join(reserved)}, which bother_batch sets itself '
+                             f'(set the size of the SRTM cache with its cache_size instead).')
+        job.setdefault('tile_source', tile_source)
+
+    ## Plan and fetch the union of the tiles needed by all jobs, once
+    job_tiles = [get_job_tiles(job) for job in jobs]
+    fnames = {}
+    for tiles in job_tiles:
+        fnames.update(tiles)
+    print(f'Running {len(jobs)} bother jobs requiring {len(fnames)} SRTM tiles.')
+    if fnames:
+        fetch_all_zips(fnames, CACHE_DIR, source=tile_source)
+
+    ## Run jobs that share tiles next to each other so that they are still in memory
+    order = sorted(range(len(jobs)), key=lambda i: sorted(job_tiles[i]))
+    ordered_jobs = [jobs[i] for i in order]
+    try:
+        if workers <= 1:
+            _init_worker(CACHE_DIR, max_tiles)
+            try:
+                outfiles = [_run_job(job) for job in ordered_jobs]
+            finally:
+                _tile_store.close()
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(CACHE_DIR, max_tiles)) as executor:
+                outfiles = list(executor.map(_run_job, ordered_jobs))
+    finally:
+        if cache_size is not None:
+            enforce_cache_limit(cache_size)
+
+    results = [None] * len(jobs)
+    for i, outfile in zip(order, outfiles):
+        results[i] = outfile
+    return results
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Run bother for many regions, sharing SRTM tiles between them.')
+    parser.add_argument('jobs_file', help='JSON file containing a list of jobs, or an object with "defaults" '
+                                          'and "jobs" keys.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes to run jobs in.')
+    parser.add_argument('--tile-source', help='Where to fetch missing SRTM tiles from (URL, directory or '
+                                              '"offline").')
+    parser.add_argument('--max-tiles', type=int, default=STORE_MAX_TILES,
+                        help='Maximum number of decoded tiles each process keeps in memory.')
+    args = parser.parse_args(argv)
+
+    with open(args.jobs_file, 'r') as f:
+        spec = json.load(f)
+    if isinstance(spec, list):
+        spec = {'jobs': spec}
+
+    outfiles = bother_batch(spec['jobs'], spec.get('defaults'), args.workers, args.tile_source, args.max_tiles)
+    for outfile in outfiles:
+        print(outfile)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -14,8 +14,6 @@ TODO (gamescript):
 
 
 import os
-import numpy as np
-import pandas as pd
 import warnings
 
 
@@ -815,6 +813,8 @@ def build_towns_code(towns, town_x_header='X', town_y_header='Y', town_size_head
 
     '''
     
+    import pandas as pd
+    
     print('Building code to add towns...')
     
     ### Check town data structures
@@ -1127,6 +1127,9 @@ def build_industry_code(industry, ind_x_header='X',ind_y_header='Y',ind_name_hea
 
     '''
     
+    import numpy as np
+    import pandas as pd
+    
     print('Building code to add industries...')
     
     ### Check industry data structures
@@ -1383,6 +1386,8 @@ def build_canal_code(canals, x_header='X', y_header='Y'):
 
     '''
     
+    import pandas as pd
+    
     print('Building code to add canals...')
     
     ### Check town data structures
@@ -1545,6 +1550,8 @@ def build_signs_code(signs, x_header='X', y_header='Y', label_header='label'):
 
     '''
     
+    import pandas as pd
+    
     print('Building code to add signs...')
     
     ### Check town data structures
@@ -11,7 +11,7 @@ from rasterio.control import GroundControlPoint
 import numpy as np
 
 
-def georef_png(bother_tif, bother_png, png_scale, new_tif, crs='epsg:4326'):
+def georef_png(bother_tif, bother_png, png_scale, new_tif, crs='epsg:4326', dtype='float32'):
     '''
     Georefenece the png output from bother and convert to tif for editing.
     The resulting tif can be used used to extract game-grid row,col indices for towns and industry.
@@ -32,6 +32,9 @@ def georef_png(bother_tif, bother_png, png_scale, new_tif, crs='epsg:4326'):
         
     **crs** : *str, optional*;
         coordinate reference system by EPSG code. The default is 'epsg:4326'.
+        
+    **dtype** : *str, optional*;
+        data type of the new tif. 'float32' tifs have NaN as nodata. The PNG's greyscale values also fit in 'uint8', which takes a quarter of the memory and disk space but has no nodata value. The default is 'float32'.
 
     Returns
     -------
@@ -59,7 +62,9 @@ def georef_png(bother_tif, bother_png, png_scale, new_tif, crs='epsg:4326'):
 
     with rio.open(bother_png, 'r') as png:
         d = png.read()
-    d2 = d.astype(np.float32)
+    d2 = d.astype(dtype, copy=False)
+    # NaN can only mark nodata in floating point rasters; a greyscale PNG has none
+    nodata = np.nan if np.issubdtype(d2.dtype, np.floating) else None
     # write to new tif
     with rio.open(new_tif, 
                   'w',
@@ -69,7 +74,7 @@ def georef_png(bother_tif, bother_png, png_scale, new_tif, crs='epsg:4326'):
                   count=1,# numebr of bands
                   dtype=d2.dtype,
                   crs=crs,
-                  nodata=np.nan,
+                  nodata=nodata,
                   transform=transform) as dst:
         
         dst.write(d2)
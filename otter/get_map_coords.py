@@ -187,14 +187,14 @@ def get_map_coords(ras, coords, outpath=None, lat_col=None, long_col=None,
             if (s.is_empty) or (not s.is_valid):
                 continue
             s = [s]
-            out_image, out_transformation = rio.mask.mask(src, s, crop=False) # nan where not overlapping
-            idx = ~np.isnan(out_image) # find where not 0
+            out_image, out_transformation = rio.mask.mask(src, s, crop=False, filled=False) # masked where not overlapping
+            idx = ~np.ma.getmaskarray(out_image) # find where overlapping
             
             if not idx.any():
                 warnings.warn('Point outside of map. Skipping.')
                 continue
             
-            if 0 in out_image:
+            if (out_image[idx] == 0).any():
                 warnings.warn('Point on water. Flagging.')
                 water[i] = 1
                 
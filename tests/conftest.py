@@ -0,0 +1,86 @@
+"""Make this checkout importable as the otter package, whatever the
+directory it is checked out to is called (the repository root is the
+package itself, and its otter/ subpackage would otherwise shadow it).
+"""
+
+import os
+import sys
+import zipfile
+import importlib.util
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _import_root_as_otter():
+    module = sys.modules.get('otter')
+    if (module is not None) and (os.path.dirname(os.path.abspath(module.__file__)) == ROOT):
+        return
+    spec = importlib.util.spec_from_file_location('otter', os.path.join(ROOT, '__init__.py'),
+                                                  submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['otter'] = module
+    spec.loader.exec_module(module)
+
+_import_root_as_otter()
+
+
+# Helpers shared by the tests, which import them with "from conftest import"
+
+import numpy as np
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+
+from otter.bother_utils.srtm import SRTM_NODATA
+from otter.bother_utils.raster import Raster
+from otter.bother_utils.heightmap import get_all_lakes
+
+
+N = SRTM_NODATA
+
+
+def make_raster(data, transform=None, nodata=N):
+    """Wrap data in an EPSG:4326 Raster, by default of 0.01 degree pixels
+    with its top left corner at 20E 11N.
+    """
+    if transform is None:
+        transform = from_origin(20.0, 11.0, 0.01, 0.01)
+    return Raster(data, transform, CRS.from_epsg(4326), nodata)
+
+def make_dem(size, seed=0, nodata=N):
+    """Create a size x size int16 DEM with terraces (flat regions of many
+    sizes, some of them lakes), noisy hillsides and a nodata border, like
+    SRTM data at the edge of a tile.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    surface = np.zeros((size, size))
+    for _ in range(6):
+        fx, fy, phase = rng.uniform(1, 8), rng.uniform(1, 8), rng.uniform(0, 2 * np.pi)
+        surface += np.sin(2 * np.pi * (fx * x + fy * y) + phase)
+    dem = (surface * size / 20).round()
+    noisy = surface > 1
+    dem[noisy] += rng.integers(-3, 4, np.count_nonzero(noisy))
+    # Lakes of all sizes either side of the usual minimum, some of them touching
+    for _ in range(size // 5):
+        row, col, radius = rng.integers(0, size), rng.integers(0, size), rng.uniform(2, 10)
+        r = int(radius)
+        window = np.s_[max(row - r, 0):min(row + r + 1, size), max(col - r, 0):min(col + r + 1, size)]
+        rows, cols = np.ogrid[window]
+        dem[window][(rows - row) ** 2 + (cols - col) ** 2 <= radius ** 2] = dem[row, col]
+    dem = dem.astype(np.int16)
+    dem[:, :size // 20] = nodata
+    return dem
+
+def legacy_mask(data, min_size):
+    """Mask of the lakes found by the original flood fill (get_all_lakes)."""
+    mask = np.zeros(data.shape, dtype=np.bool_)
+    for lake in get_all_lakes(data, min_size):
+        rows, cols = zip(*lake)
+        mask[rows, cols] = True
+    return mask
+
+def write_zip(fpath):
+    """Write a small valid zip file, standing in for a cached tile."""
+    with zipfile.ZipFile(fpath, 'w') as zf:
+        zf.writestr('tile.tif', b'not really a tif')
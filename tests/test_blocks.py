@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from otter.bother_utils.blocks import (block_histogram, block_min_max, get_stats, iter_windows, run_pointwise,
+                                       run_pointwise_file)
+from otter.bother_utils.heightmap import raise_undersea_stage, raise_low_stage, remove_sea_stage, to_png_stages
+
+from conftest import N
+
+
+def make_data(nodata=True):
+    rng = np.random.default_rng(0)
+    data = rng.integers(-50, 3000, (100, 130)).astype(np.int16)
+    if nodata:
+        data[rng.random(data.shape) < 0.05] = N
+    return data
+
+def make_stages(nodata=True):
+    """Stages with and without statistics, of which remove_sea cannot be
+    given nodata.
+    """
+    stages = [raise_undersea_stage(), raise_low_stage(5, 255, noisy=True)] + to_png_stages(True)
+    return stages if nodata else [remove_sea_stage()] + stages
+
+def run_whole(data, stages):
+    """Run stages over the whole of data at once."""
+    for stage in stages:
+        kernel = stage.make_kernel(data.min(), data.max()) if stage.needs_stats else stage.make_kernel()
+        data = kernel(data.copy())
+    return data
+
+
+def test_iter_windows_covers_the_array_once():
+    covered = np.zeros((10, 13), dtype=np.int64)
+    for window in iter_windows(covered.shape, (3, 4)):
+        covered[window] += 1
+    assert (covered == 1).all()
+
+@pytest.mark.parametrize('nodata', [True, False])
+@pytest.mark.parametrize('block_shape, threads', [((7, 5), 1), ((7, 5), 3), ((1, 200), 2), ((64, 64), 4)])
+def test_running_by_blocks_matches_running_on_the_whole_raster(nodata, block_shape, threads):
+    data = make_data(nodata)
+    original = data.copy()
+    expected = run_whole(data, make_stages(nodata))
+    result = run_pointwise(data, make_stages(nodata), dtype=np.uint8, block_shape=block_shape, threads=threads)
+    np.testing.assert_array_equal(result, expected)
+    np.testing.assert_array_equal(data, original)
+
+    # Written back over the input
+    inplace = run_pointwise(data, make_stages(nodata), data, block_shape=block_shape, threads=threads)
+    assert inplace is data
+    np.testing.assert_array_equal(data, expected)
+
+def test_block_statistics_match_those_of_the_whole_raster():
+    data = make_data()
+
+    def kernel(block):
+        return block // 3
+
+    assert block_min_max(data, block_shape=(7, 5)) == (data.min(), data.max())
+    assert block_min_max(data, kernel, (7, 5)) == ((data // 3).min(), (data // 3).max())
+    low, counts = block_histogram(data, kernel, (7, 5), threads=3)
+    whole = data // 3
+    assert low == whole.min()
+    np.testing.assert_array_equal(counts, np.bincount((whole.astype(np.int64) - low).ravel()))
+
+def test_a_crop_run_with_the_stats_of_the_whole_raster_matches_a_crop_of_it():
+    data = make_data()
+    stages = make_stages()
+    stats = get_stats(data, stages, (7, 5))
+    crop = np.s_[20:50, 30:100]
+    cropped = run_pointwise(data[crop], stages, dtype=np.uint8, block_shape=(7, 5), stats=stats)
+    np.testing.assert_array_equal(cropped, run_whole(data, stages)[crop])
+
+def test_running_a_file_by_blocks_matches_running_an_array(tmp_path):
+    data = make_data()
+    infile = str(tmp_path / 'in.tif')
+    profile = {'driver': 'GTiff', 'width': data.shape[1], 'height': data.shape[0], 'count': 1, 'dtype': 'int16',
+               'crs': 'EPSG:4326', 'transform': from_origin(20.0, 11.0, 0.01, 0.01), 'nodata': N,
+               'tiled': True, 'blockxsize': 32, 'blockysize': 32}
+    with rasterio.open(infile, 'w', **profile) as dst:
+        dst.write(data, 1)
+    outfile = run_pointwise_file(infile, str(tmp_path / 'out.tif'), make_stages(), dtype='uint8', threads=3)
+    with rasterio.open(outfile) as src:
+        np.testing.assert_array_equal(src.read(1), run_whole(data, make_stages()))
@@ -0,0 +1,12 @@
+import pytest
+
+from otter.otter.bother_batch import bother_batch
+
+
+@pytest.mark.parametrize('key', ['tile_store', 'cache_size', 'clear_srtm_cache'])
+def test_jobs_may_not_set_keys_that_the_batch_sets(tmp_path, key):
+    jobs = [{'outfile': str(tmp_path / 'a.png'), 'bounds': [10, 20, 11, 21]}]
+    with pytest.raises(ValueError, match=key):
+        bother_batch(jobs, defaults={key: None}, cache_size=None)
+    with pytest.raises(ValueError, match=key):
+        bother_batch([dict(jobs[0], **{key: None})], cache_size=None)
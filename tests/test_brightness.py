@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from otter.bother_utils.brightness import CURVES, Histogram, get_histogram, get_lut, parse_curve
+from otter.bother_utils.heightmap import to_png
+
+from conftest import N, make_raster
+
+
+def old_to_png(data, zero_floor=False, max_brightness=255, nodata=N):
+    """to_png as it was before brightness went through a lookup table."""
+    data = data.copy()
+    data[data == nodata] = 0
+    if zero_floor:
+        data[data < 0] = 0
+    max_elev = data.max()
+    min_elev = data.min()
+    scale_factor = max_brightness / (max_elev - min_elev)
+    if min_elev > 0:
+        floor = min_elev + 1
+    else:
+        floor = min_elev
+    return ((data - floor) * scale_factor).astype(np.uint8)
+
+
+@pytest.mark.parametrize('low, high, dtype', [(-50, 3000, np.int16), (200, 900, np.int16), (-400, 8000, np.int32),
+                                              (-50, 3000, np.float32)])
+@pytest.mark.parametrize('zero_floor', [False, True])
+@pytest.mark.parametrize('max_brightness', [255, 200])
+def test_linear_brightness_matches_the_old_to_png(low, high, dtype, zero_floor, max_brightness):
+    rng = np.random.default_rng(low + high)
+    data = rng.integers(low, high, (90, 110)).astype(dtype)
+    data[rng.random(data.shape) < 0.05] = N
+    image = np.asarray(to_png(make_raster(data), zero_floor, max_brightness))
+    np.testing.assert_array_equal(image, old_to_png(data, zero_floor, max_brightness))
+
+@pytest.mark.parametrize('curve', ['percentile:2,98', 'gamma:0.5', 'gamma:2', 'piecewise:0:0,500:200,3000:255'])
+def test_curves_map_elevation_to_brightness_monotonically(curve):
+    assert parse_curve(curve)[0] in CURVES
+    data = np.random.default_rng(0).integers(0, 3000, (50, 50)).astype(np.int16)
+    name, params = parse_curve(curve)
+    lut = get_lut(get_histogram(data), 255, name, **params)
+    assert lut.dtype == np.uint8
+    assert (np.diff(lut.astype(np.int16)) >= 0).all()
+    image = np.asarray(to_png(make_raster(data), True, curve=curve))
+    assert image.min() == lut[0] and image.max() == lut[-1]
+
+def test_histogram_including_an_elevation_extends_its_range():
+    histogram = Histogram(5, np.array([2, 0, 3]))
+    below = histogram.including(0)
+    assert (below.offset, below.min, below.max) == (0, 0, 7)
+    np.testing.assert_array_equal(below.counts, [1, 0, 0, 0, 0, 2, 0, 3])
+    np.testing.assert_array_equal(histogram.including(6).counts, [2, 1, 3])
+    np.testing.assert_array_equal(histogram.including(5).counts, histogram.counts)
+    assert histogram.including(9).max == 9
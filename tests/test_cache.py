@@ -0,0 +1,60 @@
+import os
+
+from otter.bother_utils.cache import enforce_cache_limit, get_cache_size, get_pinned_tiles, pin_region, unpin_region
+from otter.bother_utils.catalog import get_catalog
+from otter.bother_utils.srtm import ZIP_FNAME, get_tile_bounds
+
+
+TILES = [(10, 5), (11, 5), (12, 5), (13, 5)]
+FNAMES = [ZIP_FNAME.format(x=x, y=y) for x, y in TILES]
+
+
+def fill_cache(cache_dir, size=1000):
+    """Cache a zip file of size bytes for each of TILES, used least
+    recently in the order given.
+    """
+    catalog = get_catalog(cache_dir)
+    for i, fname in enumerate(FNAMES):
+        fpath = os.path.join(cache_dir, fname)
+        with open(fpath, 'wb') as f:
+            f.write(b'\0' * size)
+        catalog.record_present(fname, fpath)
+        catalog.tiles[fname]['atime'] = 1000 + i
+    catalog.save()
+    return catalog
+
+def tile_region(x, y):
+    """Bounds of a region within tile x, y only."""
+    left, bottom, right, top = get_tile_bounds(x, y)
+    return left + 0.1, bottom + 0.1, right - 0.1, top - 0.1
+
+
+def test_least_recently_used_tiles_are_evicted_first(tmp_path):
+    cache_dir = str(tmp_path)
+    catalog = fill_cache(cache_dir)
+    assert get_cache_size(cache_dir) == 4000
+    assert enforce_cache_limit(2500, cache_dir) == FNAMES[:2]
+    assert get_cache_size(cache_dir) == 2000
+    assert not os.path.exists(os.path.join(cache_dir, FNAMES[0]))
+    assert catalog.get(FNAMES[0]) is None and catalog.is_present(FNAMES[2])
+    assert enforce_cache_limit(2500, cache_dir) == []
+
+def test_pinned_tiles_are_never_evicted(tmp_path):
+    cache_dir = str(tmp_path)
+    fill_cache(cache_dir)
+    pin_region(*tile_region(*TILES[0]), cache_dir)
+    pin_region(*tile_region(*TILES[2]), cache_dir)
+    assert get_pinned_tiles(cache_dir) == {FNAMES[0], FNAMES[2]}
+    # Stays over budget rather than evict the pinned tiles
+    assert enforce_cache_limit(0, cache_dir) == [FNAMES[1], FNAMES[3]]
+    assert get_cache_size(cache_dir) == 2000
+
+    unpin_region(*tile_region(*TILES[0]), cache_dir)
+    assert enforce_cache_limit(1000, cache_dir) == [FNAMES[0]]
+
+def test_corrupt_tiles_are_evicted_even_within_budget(tmp_path):
+    cache_dir = str(tmp_path)
+    catalog = fill_cache(cache_dir)
+    catalog.record_corrupt(FNAMES[3])
+    assert enforce_cache_limit(10000, cache_dir) == [FNAMES[3]]
+    assert get_catalog(cache_dir).get(FNAMES[3]) is None
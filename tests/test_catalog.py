@@ -0,0 +1,78 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from otter.bother_utils.catalog import STATUS_CORRUPT, STATUS_OCEAN, TileCatalog, file_sha256, get_catalog
+from otter.bother_utils.sources import TileSource
+from otter.bother_utils.srtm import fetch_all_zips
+
+from conftest import write_zip
+
+
+def record_many(cache_dir, worker, n):
+    catalog = TileCatalog(cache_dir)
+    for i in range(n):
+        catalog.record_ocean(f'tile_{worker}_{i}.zip')
+        catalog.save()
+
+class FailingSource(TileSource):
+    """A source that must not be asked for anything."""
+
+    def describe(self, fname):
+        return 'nowhere'
+
+    def fetch(self, fname, save_path, pbar=None):
+        raise AssertionError(f'{fname} should not have been fetched.')
+
+
+def test_concurrent_saves_keep_the_tiles_of_every_process(tmp_path):
+    workers, n = 4, 50
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(record_many, str(tmp_path), worker, n) for worker in range(workers)]:
+            future.result()
+    catalog = TileCatalog(str(tmp_path))
+    assert len(catalog.files('ocean')) == workers * n
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['catalog.json']
+
+def test_save_merges_with_changes_saved_by_another_catalog(tmp_path):
+    first = TileCatalog(str(tmp_path))
+    second = TileCatalog(str(tmp_path))
+    first.record_ocean('a.zip')
+    first.save()
+    second.record_ocean('b.zip')
+    second.save()
+    assert sorted(get_catalog(str(tmp_path)).files('ocean')) == ['a.zip', 'b.zip']
+    second.forget('a.zip')
+    second.save()
+    assert sorted(TileCatalog(str(tmp_path)).files('ocean')) == ['b.zip']
+
+def test_save_does_nothing_without_changes(tmp_path):
+    catalog = TileCatalog(str(tmp_path))
+    catalog.save()
+    assert not (tmp_path / 'catalog.json').exists()
+
+def test_catalog_records_the_status_of_tiles_and_adopts_existing_zips(tmp_path):
+    write_zip(tmp_path / 'a.zip')
+    catalog = TileCatalog(str(tmp_path))
+    assert catalog.is_present('a.zip')
+    assert catalog.get('a.zip')['sha256'] == file_sha256(str(tmp_path / 'a.zip'))
+    catalog.record_ocean('b.zip')
+    catalog.record_corrupt('a.zip')
+    catalog.save()
+
+    reloaded = TileCatalog(str(tmp_path))
+    assert reloaded.is_ocean('b.zip') and not reloaded.is_present('b.zip')
+    assert reloaded.status('a.zip') == STATUS_CORRUPT and not reloaded.is_present('a.zip')
+    assert reloaded.status('c.zip') is None
+    assert reloaded.files(STATUS_OCEAN) == ['b.zip']
+
+def test_fetch_all_zips_skips_cached_and_ocean_tiles(tmp_path):
+    catalog = get_catalog(str(tmp_path))
+    write_zip(tmp_path / 'land.zip')
+    catalog.record_present('land.zip', str(tmp_path / 'land.zip'))
+    catalog.record_ocean('sea.zip')
+    catalog.save()
+    atime = catalog.get('sea.zip')['atime']
+
+    fpaths = fetch_all_zips({(1, 1): 'land.zip', (2, 1): 'sea.zip'}, str(tmp_path), source=FailingSource())
+    assert fpaths == {(1, 1): os.path.join(str(tmp_path), 'land.zip'), (2, 1): None}
+    assert get_catalog(str(tmp_path)).get('sea.zip')['atime'] >= atime
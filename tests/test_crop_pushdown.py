@@ -0,0 +1,88 @@
+import importlib
+
+import numpy as np
+import pytest
+import rasterio
+from PIL import Image
+from rasterio.transform import from_origin
+
+from otter.bother_utils.brightness import lut_kernel
+
+from conftest import N
+
+
+def write_dem(path, with_sea=False):
+    """Write a 200x200 DEM of land sloping up to the east, with a flat
+    lake of 40x40 pixels in the middle and, optionally, sea along its
+    western edge.
+    """
+    rows, cols = np.mgrid[0:200, 0:200]
+    data = (50 + 5 * cols + rows).astype(np.int16)
+    data[80:120, 80:120] = 300
+    if with_sea:
+        data[:, :20] = 0
+    profile = {'driver': 'GTiff', 'width': 200, 'height': 200, 'count': 1, 'dtype': 'int16',
+               'crs': 'EPSG:4326', 'transform': from_origin(20.0, 11.0, 0.005, 0.005), 'nodata': N}
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(data, 1)
+
+
+def run_both(tmp_path, with_sea, **kwargs):
+    """Return the images made by bother with and without crop_pushdown."""
+    bother = importlib.import_module('otter.otter.bother').bother
+    infile = str(tmp_path / 'dem.tif')
+    write_dem(infile, with_sea)
+    images = []
+    for crop_pushdown in (False, True):
+        outfile = str(tmp_path / f'pushdown_{crop_pushdown}.png')
+        bother(outfile, infile_tif=infile, crop=['120x120', 'c'], crop_pushdown=crop_pushdown, cache_size=None,
+               **kwargs)
+        images.append(np.asarray(Image.open(outfile)).astype(np.int16))
+    assert images[0].shape[:2] == (120, 120)
+    return images
+
+
+@pytest.mark.parametrize('with_sea, kwargs', [
+    (False, {'lakes': 100}),
+    (False, {'lakes': 100, 'lake_method': 'flood'}),
+    (False, {'lakes': 100, 'scale_data': 1.3, 'fill_voids': True}),
+    (True, {'lakes': 100, 'raise_undersea': 1, 'raise_low': 20}),
+    (True, {'no_sea': True, 'brightness': 'percentile:5,95'}),
+    (False, {'epsg': '3857', 'lakes': 20, 'brightness': 'percentile:5,95'}),
+])
+def test_pushed_down_crop_matches_cropping_the_whole_image(tmp_path, with_sea, kwargs):
+    full, pushed_down = run_both(tmp_path, with_sea, **kwargs)
+    np.testing.assert_array_equal(pushed_down, full)
+    if kwargs.get('lakes') == 100:
+        assert (pushed_down[50:70, 50:70] == 0).all()
+
+@pytest.mark.parametrize('kwargs', [
+    {'epsg': '3857', 'lakes': 100},
+    {'epsg': '3857', 'scale_data': 0.8, 'lakes': 20, 'brightness': 'gamma:2'},
+    {'map_size': '150x160', 'epsg': '3857', 'raise_low': 20},
+])
+def test_pushed_down_crop_through_a_reprojection_is_within_a_grey_level(tmp_path, kwargs):
+    # The elevation range used for brightness is taken before reprojection
+    full, pushed_down = run_both(tmp_path, False, **kwargs)
+    assert np.abs(pushed_down - full).max() <= 1
+    if kwargs.get('lakes') == 100:
+        assert (pushed_down[50:70, 50:70] == 0).all()
+
+def test_lakes_are_only_found_in_the_window_needed_for_the_crop(tmp_path, monkeypatch):
+    bother_module = importlib.import_module('otter.otter.bother')
+    set_lakes_to_elev = bother_module.set_lakes_to_elev
+    shapes = []
+
+    def recording_set_lakes_to_elev(raster, *args, **kwargs):
+        shapes.append(raster.shape)
+        return set_lakes_to_elev(raster, *args, **kwargs)
+
+    monkeypatch.setattr(bother_module, 'set_lakes_to_elev', recording_set_lakes_to_elev)
+    run_both(tmp_path, False, lakes=100, epsg='3857')
+    full_shape, window_shape = shapes
+    assert window_shape == (120, 120)
+    assert full_shape[0] * full_shape[1] > 2 * 120 * 120
+
+def test_lut_kernel_clamps_elevations_outside_the_table():
+    kernel = lut_kernel(np.array([10, 20, 30], dtype=np.uint8), 5)
+    np.testing.assert_array_equal(kernel(np.array([0, 4, 5, 7, 8, 100])), [10, 10, 10, 30, 30, 30])
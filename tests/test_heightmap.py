@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+from rasterio.warp import transform_bounds
+
+from otter.bother_utils.heightmap import (as_dtype, remove_sea, raise_undersea_land, raise_low_pixels,
+                                          set_lakes_to_elev, set_water_to_elev, fill_nodata_voids, label_nodata, warp_to_grid)
+
+from conftest import N, make_raster
+
+
+def make_basin(dtype=np.int16):
+    """A basin flat at 12 (spilling over at 20) within a ring flat at 30,
+    with sea and low land around the edge.
+    """
+    data = np.array([[-5, 0, 3, 40, 2, 4, 1],
+                     [7, 30, 30, 20, 30, 30, 80],
+                     [9, 30, 12, 12, 12, 30, 70],
+                     [2, 30, 12, 12, 12, 30, 90],
+                     [6, 30, 12, 12, 12, 30, 60],
+                     [8, 30, 30, 30, 30, 30, 50],
+                     [-2, 60, 4, 50, 100, 9, 5]]).astype(dtype)
+    return make_raster(data)
+
+STAGES = {
+    'remove_sea': lambda r, **kw: remove_sea(r, **kw),
+    'raise_undersea_land': lambda r, **kw: raise_undersea_land(r, 1, **kw),
+    'raise_low_pixels': lambda r, **kw: raise_low_pixels(r, 5, 255, **kw),
+    'set_lakes_to_elev': lambda r, **kw: set_lakes_to_elev(r, 9, **kw),
+    'set_water_to_elev': lambda r, **kw: set_water_to_elev(r, 9, **kw),
+}
+
+
+@pytest.mark.parametrize('name', STAGES)
+def test_stages_leave_their_input_unchanged_unless_inplace(name):
+    stage = STAGES[name]
+    raster = make_basin()
+    original = raster.data.copy()
+    result = stage(raster)
+    np.testing.assert_array_equal(raster.data, original)
+    assert not np.shares_memory(result.data, raster.data)
+    assert result.data.dtype == original.dtype
+    assert not np.array_equal(result.data, original)
+
+    inplace = stage(raster, inplace=True)
+    assert np.shares_memory(inplace.data, raster.data)
+    np.testing.assert_array_equal(inplace.data, result.data)
+
+def test_as_dtype_converts_a_copy_and_keeps_nodata():
+    raster = make_basin(np.float32)
+    raster.data[0, 0] = np.nan
+    raster.data[0, 4] = N
+    raster.data[1, 0] = 2.6
+    original = raster.data.copy()
+    result = as_dtype(raster, 'int16')
+    np.testing.assert_array_equal(raster.data, original)
+    assert result.data.dtype == np.int16
+    assert result.data[0, 0] == N
+    assert result.data[0, 4] == N
+    assert result.data[1, 0] == 3
+
+def test_label_nodata_tells_voids_from_ocean():
+    data = np.full((6, 6), 10, dtype=np.int16)
+    data[0, :3] = N
+    data[1, 3] = N
+    data[3:5, 2:4] = N
+    labels, is_ocean = label_nodata(data, N)
+    # The pixel touching the ocean diagonally is part of it
+    assert labels[1, 3] == labels[0, 0]
+    assert is_ocean[labels[0, 0]] and is_ocean[labels[1, 3]]
+    assert not is_ocean[labels[3, 2]]
+    assert (labels[3:5, 2:4] == labels[3, 2]).all()
+    assert (labels[data != N] == 0).all()
+
+def test_fill_nodata_voids_interpolates_voids_and_keeps_ocean():
+    data = np.tile(100 + 10 * np.arange(8, dtype=np.int16), (8, 1))
+    data[:, 0] = N
+    data[3:5, 3:5] = N
+    data[6, 6] = N
+    raster = make_raster(data)
+    original = data.copy()
+    filled = fill_nodata_voids(raster, N).data
+    np.testing.assert_array_equal(raster.data, original)
+    assert filled.dtype == data.dtype
+    assert (filled[:, 0] == N).all()
+    np.testing.assert_array_equal(filled[data != N], data[data != N])
+    # Filled from the land either side, which rises by 10 per column
+    assert (filled[3:5, 3:5] >= 120).all() and (filled[3:5, 3:5] <= 150).all()
+    assert 140 <= filled[6, 6] <= 180
+
+    kept = fill_nodata_voids(raster, N, max_void_size=1).data
+    assert (kept[3:5, 3:5] == N).all()
+    assert kept[6, 6] != N
+
+@pytest.mark.parametrize('width, height, dst_crs', [(37, 23, None), (301, 199, None), (37, 23, 'EPSG:3857'),
+                                                    (250, 251, 'EPSG:3857')])
+def test_warp_to_grid_gives_exactly_the_requested_size(width, height, dst_crs):
+    rows, cols = np.mgrid[0:90, 0:120]
+    data = (100 + rows + 2 * cols).astype(np.int16)
+    data[:5, :5] = N
+    raster = make_raster(data)
+    warped = warp_to_grid(raster, width, height, dst_crs)
+    assert warped.shape == (height, width)
+    assert warped.data.dtype == data.dtype
+    assert warped.nodata == N
+    assert str(warped.crs) == str(dst_crs or raster.crs)
+    # The warped raster covers the same area as the original
+    expected = transform_bounds(raster.crs, warped.crs, *raster.grid.bounds)
+    pixel = max(abs(warped.transform.a), abs(warped.transform.e))
+    np.testing.assert_allclose(warped.grid.bounds, expected, atol=pixel)
+    land = warped.data[warped.data != N]
+    assert land.min() >= 100 and land.max() <= data.max()
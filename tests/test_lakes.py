@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from otter.bother_utils.heightmap import (fill_depressions, fill_depressions_mst, fill_depressions_queue, find_water,
+                                          find_lakes, find_lakes_tiled)
+
+from conftest import N, make_dem, legacy_mask
+
+# Fill with the minimum spanning tree, and with Priority-Flood
+BUDGETS = [None, 0]
+
+
+@pytest.mark.parametrize('memory_budget', BUDGETS)
+def test_fill_depressions_fills_a_pit_to_its_lowest_outlet(memory_budget):
+    data = np.array([[5, 5, 5, 5, 5],
+                     [5, 1, 2, 1, 5],
+                     [5, 2, 0, 2, 4],
+                     [5, 1, 2, 1, 5],
+                     [5, 5, 5, 5, 5]], dtype=np.int16)
+    expected = np.full_like(data, 5)
+    expected[1:4, 1:4] = 4
+    expected[2, 4] = 4
+    filled = fill_depressions(data, N, memory_budget)
+    np.testing.assert_array_equal(filled, expected)
+    assert filled.dtype == data.dtype
+    assert data[2, 2] == 0
+
+@pytest.mark.parametrize('memory_budget', BUDGETS)
+def test_fill_depressions_drains_diagonally_and_into_nodata(memory_budget):
+    # The pit drains to the edge through the diagonal gap at 3, and the
+    # pit beside the nodata pixel drains into it
+    data = np.array([[9, 9, 9, 9, 9, 9],
+                     [9, 1, 9, 9, 2, 9],
+                     [9, 9, 3, 9, 9, N],
+                     [9, 9, 9, 3, 9, 9]], dtype=np.int16)
+    expected = data.copy()
+    expected[1, 1] = 3
+    np.testing.assert_array_equal(fill_depressions(data, N, memory_budget), expected)
+
+@pytest.mark.parametrize('memory_budget', BUDGETS)
+def test_fill_depressions_leaves_surfaces_without_depressions_alone(memory_budget):
+    rows, cols = np.mgrid[0:6, 0:7]
+    for data in (np.zeros((4, 4), dtype=np.int16), (rows + cols).astype(np.float32),
+                 np.full((3, 3), N, dtype=np.int16), np.array([[7]], dtype=np.int16)):
+        np.testing.assert_array_equal(fill_depressions(data, N, memory_budget), data)
+
+def test_fill_depressions_methods_agree():
+    dem = make_dem(120)
+    rng = np.random.default_rng(0)
+    noisy = rng.integers(-3, 6, (40, 30)).astype(np.int16)
+    noisy[rng.random(noisy.shape) < 0.1] = N
+    for data in (dem, dem.astype(np.float32), dem.astype(np.int32) * 1000, noisy):
+        filled = fill_depressions_queue(data, N)
+        assert filled.dtype == data.dtype
+        np.testing.assert_array_equal(filled, fill_depressions_mst(data, N))
+
+def test_find_water_finds_a_noisy_basin_but_not_flat_land():
+    data = np.full((12, 12), 10, dtype=np.int16)
+    data[:, 6:] = 20
+    data[2:8, 7:11] = np.random.default_rng(0).integers(5, 9, (6, 4))
+    # The basin spills over at 15, into the flat land at 10
+    data[2, 6] = 15
+    expected = np.zeros(data.shape, dtype=np.bool_)
+    expected[2:8, 7:11] = True
+    expected[2, 6] = True
+    mask, n_water = find_water(data, 20, N)
+    assert n_water == 1
+    np.testing.assert_array_equal(mask, expected)
+
+def test_find_lakes_tiled_joins_lakes_across_tile_seams():
+    # A U-shaped lake of 11 pixels, no more than 4 of them in any one 3x3 tile
+    data = np.arange(36, dtype=np.int16).reshape(6, 6) + 10
+    for row, col in [(1, 1), (2, 1), (3, 1), (4, 1), (4, 2), (4, 3), (4, 4), (3, 4), (2, 4), (1, 4), (0, 4)]:
+        data[row, col] = 5
+    data[0, 0] = N
+    mask, n_lakes = find_lakes_tiled(data, 11, N, tile_size=3)
+    assert n_lakes == 1
+    np.testing.assert_array_equal(mask, data == 5)
+    assert find_lakes_tiled(data, 12, N, tile_size=3)[1] == 0
+
+def test_find_lakes_tiled_matches_a_single_pass():
+    dem = make_dem(300)
+    expected, n_expected = find_lakes(dem, 40)
+    np.testing.assert_array_equal(expected, legacy_mask(dem, 40))
+    for tile_size, workers in [(7, 1), (64, 1), (100, 2), (1000, 1)]:
+        mask, n_lakes = find_lakes_tiled(dem, 40, tile_size=tile_size, workers=workers)
+        assert n_lakes == n_expected
+        np.testing.assert_array_equal(mask, expected)
@@ -0,0 +1,48 @@
+import json
+
+import numpy as np
+
+from otter.bother_utils.profiling import Profiler, profile_stage
+
+from conftest import make_raster
+
+
+def run_stages():
+    raster = make_raster(np.zeros((100, 200), dtype=np.int16))
+    with profile_stage('outer', raster) as outer:
+        with profile_stage('inner', raster) as inner:
+            data = np.ones((1000, 1000), dtype=np.float64)
+            inner.set_output(data)
+        del data
+        outer.set_output(raster.data[:10])
+
+
+def test_stages_are_not_recorded_without_an_active_profiler():
+    run_stages()
+    with Profiler() as profiler:
+        pass
+    assert profiler.report()['stages'] == []
+
+def test_profiler_records_each_stage_with_its_memory_use(tmp_path):
+    with Profiler() as profiler:
+        run_stages()
+    report = profiler.report()
+    assert [r['name'] for r in report['stages']] == ['outer', 'inner']
+    outer, inner = report['stages']
+    assert outer['input'] == {'shape': [100, 200], 'dtype': 'int16', 'nbytes': 40000}
+    assert inner['output']['shape'] == [1000, 1000]
+    assert outer['output']['shape'] == [10, 200]
+    assert outer['wall_s'] >= inner['wall_s'] >= 0
+    # The inner stage's 8 MB array counts towards the peak of both stages
+    assert inner['traced_peak_bytes'] >= 8e6 and outer['traced_peak_bytes'] >= 8e6
+    assert outer['traced_delta_bytes'] < 1e6
+
+    with open(profiler.write_chrome_trace(str(tmp_path / 'trace.json'))) as f:
+        assert [e['name'] for e in json.load(f)['traceEvents']] == ['inner', 'outer']
+    with open(profiler.write_json(str(tmp_path / 'report.json'))) as f:
+        assert json.load(f)['stages'][0]['name'] == 'outer'
+
+def test_profiler_can_skip_tracing_memory():
+    with Profiler(trace_memory=False) as profiler:
+        run_stages()
+    assert all('traced_peak_bytes' not in r for r in profiler.report()['stages'])
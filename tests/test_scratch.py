@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+
+from otter.bother_utils import scratch
+from otter.bother_utils.heightmap import raise_undersea_land
+
+from conftest import make_raster
+
+
+def test_arrays_are_only_memory_mapped_within_a_scratch_space(tmp_path):
+    assert not scratch.is_active()
+    assert not isinstance(scratch.empty((3, 4), np.int16), np.memmap)
+
+    with scratch.ScratchSpace(str(tmp_path)) as space:
+        assert scratch.is_active()
+        full = scratch.full((30, 40), 7, np.int16)
+        assert isinstance(full, np.memmap) and (full == 7).all()
+        zeros = scratch.full((30, 40), 0, np.float32)
+        assert (zeros == 0).all()
+        copied = scratch.copy(np.arange(12).reshape(3, 4))
+        assert isinstance(copied, np.memmap)
+        np.testing.assert_array_equal(copied, np.arange(12).reshape(3, 4))
+        assert scratch.empty((0, 5), np.int16).shape == (0, 5)
+        assert space.nbytes == full.nbytes + zeros.nbytes + copied.nbytes
+        if os.name == 'posix':
+            # The files are unlinked as soon as they are mapped
+            assert os.listdir(tmp_path) == []
+
+        with scratch.ScratchSpace(str(tmp_path / 'inner')) as inner:
+            scratch.empty((2, 2), np.int16)
+        assert inner.nbytes == 8 and space.nbytes == full.nbytes + zeros.nbytes + copied.nbytes
+        assert scratch.is_active()
+    assert not scratch.is_active()
+
+def test_stages_write_their_output_to_scratch_space(tmp_path):
+    data = np.random.default_rng(0).integers(-50, 100, (60, 80)).astype(np.int16)
+    expected = raise_undersea_land(make_raster(data)).data
+    with scratch.ScratchSpace(str(tmp_path)):
+        result = raise_undersea_land(make_raster(data)).data
+    assert isinstance(result, np.memmap)
+    np.testing.assert_array_equal(result, expected)
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from otter.bother_utils.catalog import get_catalog
+from otter.bother_utils.sources import (TILE_SOURCE_ENV_VAR, DirectoryTileSource, HTTPTileSource, OfflineTileSource,
+                                        TileSource, TileSourceError, get_tile_source)
+from otter.bother_utils.srtm import fetch_all_zips
+
+from conftest import write_zip
+
+
+FNAMES = {(1, 1): 'a.zip', (2, 1): 'b.zip'}
+
+
+class EmptySource(TileSource):
+    """An authoritative source that has no tiles at all."""
+
+    def describe(self, fname):
+        return 'the empty source'
+
+    def fetch(self, fname, save_path, pbar=None):
+        return None
+
+
+def test_get_tile_source_understands_each_kind_of_source(tmp_path, monkeypatch):
+    assert isinstance(get_tile_source('offline'), OfflineTileSource)
+    assert isinstance(get_tile_source(str(tmp_path)), DirectoryTileSource)
+    assert get_tile_source(tmp_path.as_uri()).path == str(tmp_path)
+    with get_tile_source('https://example.com/tiles') as source:
+        assert isinstance(source, HTTPTileSource)
+        assert source.describe('a.zip') == 'https://example.com/tiles/a.zip'
+    with pytest.raises(TileSourceError):
+        get_tile_source(str(tmp_path / 'missing'))
+    monkeypatch.setenv(TILE_SOURCE_ENV_VAR, 'offline')
+    assert isinstance(get_tile_source(None, 'https://example.com/tiles'), OfflineTileSource)
+
+def test_offline_mode_fails_before_fetching_anything(tmp_path):
+    cache_dir = str(tmp_path)
+    write_zip(tmp_path / 'a.zip')
+    get_catalog(cache_dir).record_present('a.zip', str(tmp_path / 'a.zip'))
+    assert fetch_all_zips({(1, 1): 'a.zip'}, cache_dir, source='offline') == {(1, 1): str(tmp_path / 'a.zip')}
+    with pytest.raises(TileSourceError, match='b.zip'):
+        fetch_all_zips(FNAMES, cache_dir, source='offline')
+    assert not (tmp_path / 'b.zip').exists()
+
+def test_only_authoritative_sources_record_missing_tiles_as_ocean(tmp_path):
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    write_zip(mirror / 'a.zip')
+    cache_dir = str(tmp_path / 'cache')
+    fpaths = fetch_all_zips(FNAMES, cache_dir, source=str(mirror))
+    assert fpaths == {(1, 1): os.path.join(cache_dir, 'a.zip'), (2, 1): None}
+    catalog = get_catalog(cache_dir)
+    assert catalog.is_present('a.zip') and catalog.status('b.zip') is None
+
+    fetch_all_zips(FNAMES, cache_dir, source=EmptySource())
+    assert catalog.is_ocean('b.zip')
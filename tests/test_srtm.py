@@ -0,0 +1,99 @@
+import io
+import os
+import time
+import zipfile
+
+import numpy as np
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+
+from otter.bother_utils.srtm import (ZIP_FNAME, TIF_FNAME, SRTM_NODATA, get_tile_bounds, fetch_and_mosaic,
+                                     mosaic_tiles, choose_overview_level, get_target_res, get_decoded_fpath,
+                                     open_tile)
+from otter.bother_utils.sources import DirectoryTileSource
+
+
+TILES = [(10, 5), (11, 5), (10, 6), (11, 6)]
+SIZE = 60
+
+
+def write_tile_zip(dirpath, x, y):
+    """Write a tile like the CGIAR ones, which are one pixel wider and
+    taller than their 5 degree square and so overlap their neighbours.
+    Each tile has different values, so that the overlaps differ.
+    """
+    left, bottom, right, top = get_tile_bounds(x, y)
+    res = (right - left) / SIZE
+    data = np.random.default_rng(x * 100 + y).integers(0, 3000, (SIZE + 1, SIZE + 1)).astype(np.int16)
+    profile = {'driver': 'GTiff', 'width': SIZE + 1, 'height': SIZE + 1, 'count': 1, 'dtype': 'int16',
+               'crs': 'EPSG:4326', 'transform': from_origin(left, top, res, res), 'nodata': SRTM_NODATA}
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dst:
+            dst.write(data, 1)
+        tif_bytes = memfile.read()
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        zf.writestr(TIF_FNAME.format(x=x, y=y), tif_bytes)
+    with open(os.path.join(dirpath, ZIP_FNAME.format(x=x, y=y)), 'wb') as f:
+        f.write(buf.getvalue())
+
+
+class ReversedDirectorySource(DirectoryTileSource):
+    """Delivers the first tiles last."""
+
+    def fetch(self, fname, save_path, pbar=None):
+        time.sleep(0.1 * (len(TILES) - [ZIP_FNAME.format(x=x, y=y) for x, y in TILES].index(fname)))
+        return super().fetch(fname, save_path, pbar)
+
+
+def test_fetch_and_mosaic_matches_sequential_merge_where_tiles_overlap(tmp_path):
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    for x, y in TILES:
+        write_tile_zip(mirror, x, y)
+    left, _, _, top = get_tile_bounds(10, 5)
+    _, bottom, right, _ = get_tile_bounds(11, 6)
+    bounds = (left + 1, bottom + 1, right - 1, top - 1)
+    fnames = {xy: ZIP_FNAME.format(x=xy[0], y=xy[1]) for xy in TILES}
+
+    data, transform, _, _ = fetch_and_mosaic(fnames, *bounds, cache_dir=str(tmp_path / 'cache'), workers=4,
+                                             source=ReversedDirectorySource(str(mirror)))
+
+    srcs = [rasterio.open(f'zip://{mirror / fname}!/{TIF_FNAME.format(x=x, y=y)}') for (x, y), fname in fnames.items()]
+    try:
+        expected, expected_transform = mosaic_tiles(srcs, *bounds)
+    finally:
+        for src in srcs:
+            src.close()
+    assert transform == expected_transform
+    np.testing.assert_array_equal(data, expected)
+
+def test_choose_overview_level_picks_the_coarsest_overview_fine_enough(tmp_path):
+    fpath = str(tmp_path / 'overviews.tif')
+    profile = {'driver': 'GTiff', 'width': 64, 'height': 64, 'count': 1, 'dtype': 'int16',
+               'crs': 'EPSG:4326', 'transform': from_origin(20.0, 11.0, 0.01, 0.01), 'nodata': SRTM_NODATA}
+    with rasterio.open(fpath, 'w', **profile) as dst:
+        dst.write(np.zeros((64, 64), dtype=np.int16), 1)
+        dst.build_overviews([2, 4, 8])
+    with rasterio.open(fpath) as src:
+        levels = [choose_overview_level(src, res) for res in (None, 0.015, 0.02, 0.035, 0.04, 1.0)]
+    assert levels == [None, None, 0, 0, 1, 2]
+    assert get_target_res(20.0, 10.0, 22.0, 11.0, (50, 100)) == 0.02
+    assert get_target_res(20.0, 10.0, 22.0, 11.0) is None
+
+def test_open_tile_reads_a_decoded_overview_for_coarse_output(tmp_path):
+    write_tile_zip(tmp_path, 10, 5)
+    zip_fpath = str(tmp_path / ZIP_FNAME.format(x=10, y=5))
+    left, bottom, right, top = get_tile_bounds(10, 5)
+    with open_tile(10, 5, zip_fpath, str(tmp_path))[0] as src:
+        assert src.shape == (SIZE + 1, SIZE + 1)
+        full = src.read(1)
+    assert not os.path.exists(get_decoded_fpath(10, 5, str(tmp_path)))
+
+    # A quarter of the tile's resolution is coarse enough for the overview at factor 4
+    target_res = get_target_res(left, bottom, right, top, (SIZE // 4, SIZE // 4))
+    with open_tile(10, 5, zip_fpath, str(tmp_path), target_res=target_res)[0] as src:
+        assert src.shape == ((SIZE + 1 + 3) // 4, (SIZE + 1 + 3) // 4)
+        assert abs(src.read(1).mean() - full.mean()) < 50
+    assert os.path.exists(get_decoded_fpath(10, 5, str(tmp_path)))
@@ -0,0 +1,129 @@
+import os
+import importlib
+
+import numpy as np
+from rasterio.transform import from_origin
+
+from otter.bother_utils.catalog import get_catalog
+from otter.bother_utils.sources import DirectoryTileSource, describe_tile_source
+from otter.bother_utils.srtm import get_tiles_state, get_all_zip_fnames
+from otter.bother_utils.stage_cache import Stage, StageCache, get_stage_keys, run_stages
+
+from conftest import make_raster
+
+
+def make_ramp(left=20.0, top=11.0, height=100, width=120):
+    data = (np.arange(height * width).reshape(height, width) % 700).astype(np.int16)
+    return make_raster(data, from_origin(left, top, 1 / width, 1 / height))
+
+def counting_stages(calls, offset=1):
+    def source(_):
+        calls.append('source')
+        return make_ramp()
+
+    def add(r):
+        calls.append('add')
+        return r.replace(r.data + offset)
+
+    return [Stage('source', {}, source), Stage('add', {'offset': offset}, add)]
+
+
+def test_keys_change_with_params_and_with_earlier_stages():
+    keys = get_stage_keys(counting_stages([], 1))
+    assert len(set(keys)) == 2
+    changed = get_stage_keys(counting_stages([], 2))
+    assert changed[0] == keys[0]
+    assert changed[1] != keys[1]
+    # A different input changes the key of every later stage
+    assert get_stage_keys(counting_stages([], 1)[1:], 'other input')[0] != keys[1]
+    assert get_stage_keys(counting_stages([], 1)[1:], keys[0]) == keys[1:]
+
+def test_run_stages_resumes_from_cache_and_reruns_changed_stages(tmp_path):
+    cache = StageCache(str(tmp_path))
+    calls = []
+    first = run_stages(counting_stages(calls, 1), cache)
+    assert calls == ['source', 'add']
+
+    calls.clear()
+    again = run_stages(counting_stages(calls, 1), cache)
+    assert calls == []
+    np.testing.assert_array_equal(again.data, first.data)
+
+    calls.clear()
+    changed = run_stages(counting_stages(calls, 2), cache)
+    assert calls == ['add']
+    np.testing.assert_array_equal(changed.data, first.data + 1)
+
+def test_tiles_state_changes_when_a_tile_is_downloaded_again(tmp_path):
+    bounds = (20.5, 10.5, 20.6, 10.6)
+    fname, = get_all_zip_fnames(*bounds).values()
+    assert get_tiles_state(*bounds, cache_dir=str(tmp_path)) == {fname: None}
+
+    fpath = tmp_path / fname
+    fpath.write_bytes(b'first download')
+    catalog = get_catalog(str(tmp_path))
+    catalog.record_present(fname, str(fpath))
+    first = get_tiles_state(*bounds, cache_dir=str(tmp_path))
+
+    fpath.write_bytes(b'second download')
+    catalog.record_present(fname, str(fpath))
+    second = get_tiles_state(*bounds, cache_dir=str(tmp_path))
+    assert None not in (first[fname], second[fname])
+    assert first != second
+
+    catalog.record_ocean(fname)
+    assert get_tiles_state(*bounds, cache_dir=str(tmp_path)) == {fname: 'ocean'}
+
+def test_tile_source_is_described_for_the_cache_key(tmp_path, monkeypatch):
+    monkeypatch.delenv('BOTHER_TILE_SOURCE', raising=False)
+    assert describe_tile_source(None, 'http://default/') == 'http://default/'
+    assert describe_tile_source('http://mirror/', 'http://default/') == 'http://mirror/'
+    assert str(tmp_path) in describe_tile_source(DirectoryTileSource(str(tmp_path)))
+    monkeypatch.setenv('BOTHER_TILE_SOURCE', 'http://env/')
+    assert describe_tile_source(None, 'http://default/') == 'http://env/'
+
+def test_bother_builds_the_mosaic_once_when_writing_a_tif(tmp_path, monkeypatch):
+    bother_module = importlib.import_module('otter.otter.bother')
+    calls = []
+
+    def create_raster(left, bottom, right, top, **kwargs):
+        calls.append((left, bottom, right, top))
+        return make_ramp(left, top)
+
+    monkeypatch.setattr(bother_module, 'create_raster', create_raster)
+    monkeypatch.setattr(bother_module, 'get_tiles_state', lambda *bounds: {})
+    for crop in (None, ('50x40', 'c')):
+        calls.clear()
+        bother_module.bother(str(tmp_path / 'out.png'), bounds=[10, 20, 11, 21], outfile_tif=str(tmp_path / 'out.tif'),
+                             raise_undersea=1, crop=crop, cache_size=None)
+        assert len(calls) == 1
+        assert os.path.exists(tmp_path / 'out.tif')
+
+def test_bother_hits_the_stage_cache_on_the_run_after_a_cold_one(tmp_path, monkeypatch):
+    bother_module = importlib.import_module('otter.otter.bother')
+    fetched = []
+    built = []
+
+    def create_raster(left, bottom, right, top, **kwargs):
+        built.append((left, bottom, right, top))
+        return make_ramp(left, top)
+
+    monkeypatch.setattr(bother_module, 'fetch_all_zips', lambda fnames, cache_dir, source=None: fetched.append(fnames))
+    monkeypatch.setattr(bother_module, 'get_tiles_state', lambda *bounds: {'tile.zip': 'sha' if fetched else None})
+    monkeypatch.setattr(bother_module, 'create_raster', create_raster)
+    for _ in range(2):
+        bother_module.bother(str(tmp_path / 'out.png'), bounds=[10, 20, 11, 21], raise_undersea=1, cache_size=None,
+                             stage_cache=str(tmp_path / 'stages'))
+    assert len(built) == 1
+
+def test_bother_only_hashes_the_input_tif_for_the_stage_cache(tmp_path, monkeypatch):
+    bother_module = importlib.import_module('otter.otter.bother')
+    infile = str(tmp_path / 'in.tif')
+    make_ramp().to_file(infile)
+    hashed = []
+    monkeypatch.setattr(bother_module, 'file_sha256', lambda fpath: hashed.append(fpath) or 'sha')
+    bother_module.bother(str(tmp_path / 'out.png'), infile_tif=infile, cache_size=None)
+    assert hashed == []
+    bother_module.bother(str(tmp_path / 'out.png'), infile_tif=infile, cache_size=None,
+                         stage_cache=str(tmp_path / 'stages'))
+    assert hashed == [infile]